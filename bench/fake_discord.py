@@ -0,0 +1,85 @@
+"""benchmark 用的假 Discord ctx，只實作 GameCore 會呼叫到的介面"""
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import List, Optional
+
+
+class FakeMessage:
+    def __init__(self, content: str = "", latency: float = 0.0) -> None:
+        self.content = content
+        self.reactions: List[str] = []
+        self.edits = 0
+        self._latency = latency
+
+    async def add_reaction(self, emoji: str) -> None:
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        self.reactions.append(emoji)
+
+    async def edit(self, content: Optional[str] = None, **_: object) -> "FakeMessage":
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        self.edits += 1
+        if content is not None:
+            self.content = content
+        return self
+
+
+class FakeChannel:
+    """同一個 session 的所有 ctx 共用，追蹤尚未處理完的玩家訊息"""
+
+    def __init__(self, channel_id: int, latency: float = 0.0) -> None:
+        self.id = channel_id
+        self.latency = latency
+        self.sent: List[FakeMessage] = []
+        self._pending: List["FakeContext"] = []
+
+    async def send(self, content: str = "", **_: object) -> FakeMessage:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message = FakeMessage(content, self.latency)
+        self.sent.append(message)
+        return message
+
+    def track(self, ctx: "FakeContext") -> None:
+        self._pending.append(ctx)
+
+    def complete_through(self, ctx: "FakeContext") -> None:
+        # 合併處理時只有最後一則的 ctx 會被用來回覆，排在它之前的訊息一起算完成
+        if ctx not in self._pending:
+            ctx.mark_done()
+            return
+        index = self._pending.index(ctx)
+        done, self._pending = self._pending[:index + 1], self._pending[index + 1:]
+        for item in done:
+            item.mark_done()
+
+
+class FakeContext:
+    """模擬 commands.Context：send 轉給 channel，message 可加 reaction"""
+
+    def __init__(self, channel: FakeChannel, content: str, author_id: int = 0) -> None:
+        self.channel = channel
+        self.guild = None
+        self.author = type("FakeAuthor", (), {"id": author_id, "display_name": f"player-{author_id}"})()
+        self.message = FakeMessage(content, channel.latency)
+        self.created = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.replies = 0
+        self._done = asyncio.Event()
+        channel.track(self)
+
+    async def send(self, content: str = "", **kwargs: object) -> FakeMessage:
+        self.replies += 1
+        return await self.channel.send(content, **kwargs)
+
+    def mark_done(self) -> None:
+        if self.finished is None:
+            self.finished = time.perf_counter()
+        self._done.set()
+
+    async def wait_done(self) -> float:
+        await self._done.wait()
+        return self.finished - self.created
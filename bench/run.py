@@ -0,0 +1,210 @@
+"""離線 benchmark：用本機 Gemini stub 與假 Discord ctx 壓測 GameCore / google_request
+
+    python -m bench.run --sessions 20 --turns 5
+    python -m bench.run --mode request --sessions 50 --rate-429 0.1
+    python -m bench.run --streaming --json bench_output.json
+
+不需要 DISCORD_TOKEN 或 GOOGLE_API_KEY；其餘設定 (HTTP_MAX_CONNECTIONS、
+HISTORY_TOKEN_BUDGET...) 照常從環境變數讀取，方便比較各項調整前後的差異。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+# 必須在載入 request/game 模組前設定，模組層級的單例會在 import 時讀取
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ["GOOGLE_API_KEY"] = os.environ.get("BENCH_API_KEY", "bench-key")
+os.environ.setdefault("CONVERSATION_BACKEND", "memory")
+
+from bench.fake_discord import FakeChannel, FakeContext  # noqa: E402
+from bench.stub_server import GeminiStubServer, add_stub_arguments, stub_config_from_args  # noqa: E402
+
+QUANTILES = (0.5, 0.95, 0.99)
+# GameCore 回覆給玩家的失敗訊息開頭
+FAILURE_PREFIXES = ("發生錯誤", "模型回應逾時", "模型服務暫時不穩定")
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0, "mean": 0.0, "max": 0.0, **{f"p{int(q * 100)}": 0.0 for q in QUANTILES}}
+    ordered = sorted(values)
+    stats = {"count": len(ordered), "mean": sum(ordered) / len(ordered), "max": ordered[-1]}
+    for q in QUANTILES:
+        stats[f"p{int(q * 100)}"] = ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    return stats
+
+
+def _player_message(session_index: int, turn: int) -> str:
+    return f"玩家{session_index} 第{turn + 1}回合：我小心地推開門，看看裡面有什麼。"
+
+
+async def _run_core(args: argparse.Namespace) -> Tuple[List[float], int]:
+    from game.game_core import GameCore
+    from game.outbox import outbox
+
+    class BenchGameCore(GameCore):
+        async def _process_turn(self, ctx, message, session_id):
+            try:
+                await super()._process_turn(ctx, message, session_id)
+                # 回覆在背景送出，等送完才算這個回合完成
+                await outbox.drain(ctx)
+            finally:
+                ctx.channel.complete_through(ctx)
+
+    core = BenchGameCore()
+    latencies: List[float] = []
+    errors = 0
+
+    async def player(index: int) -> None:
+        nonlocal errors
+        channel = FakeChannel(index, latency=args.discord_latency)
+        contexts: List[FakeContext] = []
+        for turn in range(args.turns):
+            ctx = FakeContext(channel, _player_message(index, turn), author_id=index)
+            contexts.append(ctx)
+            # 每個玩家一個頻道，session 由頻道決定
+            await core.send_message(ctx, ctx.message.content)
+            if not args.burst:
+                latencies.append(await ctx.wait_done())
+                if args.think:
+                    await asyncio.sleep(args.think)
+        if args.burst:
+            for ctx in contexts:
+                try:
+                    latencies.append(await asyncio.wait_for(ctx.wait_done(), timeout=args.timeout))
+                except asyncio.TimeoutError:
+                    # 佇列滿被拒收的訊息永遠不會完成
+                    errors += 1
+        errors += sum(1 for message in channel.sent if message.content.startswith(FAILURE_PREFIXES))
+
+    await asyncio.gather(*(player(i) for i in range(args.sessions)))
+    for task in list(core._workers.values()):
+        task.cancel()
+    return latencies, errors
+
+
+async def _run_request(args: argparse.Namespace) -> Tuple[List[float], int]:
+    from game.func_tool import read_system_prompt
+    from request.google_chat import google_request
+    from request.model import ChatRequest
+
+    latencies: List[float] = []
+    errors = 0
+
+    async def player(index: int) -> None:
+        nonlocal errors
+        session_id = f"bench-{index}"
+        for turn in range(args.turns):
+            req = ChatRequest(
+                prompt=_player_message(index, turn),
+                session_id=session_id,
+                system_prompt=await read_system_prompt(session_id),
+            )
+            started = time.perf_counter()
+            try:
+                await google_request(req)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+            if args.think:
+                await asyncio.sleep(args.think)
+
+    await asyncio.gather(*(player(i) for i in range(args.sessions)))
+    return latencies, errors
+
+
+def _stage_report() -> Dict[str, Dict[str, float]]:
+    from request.metrics import metrics
+
+    stages: Dict[str, Dict[str, float]] = {}
+    for key, stats in metrics.percentiles("stage_seconds").items():
+        stages[dict(key).get("stage", "?")] = stats
+    return dict(sorted(stages.items()))
+
+
+def _print_report(result: Dict[str, Any]) -> None:
+    lat = result["latency_seconds"]
+    print(f"mode={result['mode']} sessions={result['sessions']} turns={result['turns']} "
+          f"streaming={result['streaming']} function_calling={result['function_calling']}")
+    print(f"completed={lat['count']} errors={result['errors']} wall={result['wall_seconds']:.2f}s "
+          f"throughput={result['throughput_per_second']:.2f} msg/s")
+    print(f"latency ms: p50={lat['p50'] * 1000:.0f} p95={lat['p95'] * 1000:.0f} "
+          f"p99={lat['p99'] * 1000:.0f} max={lat['max'] * 1000:.0f}")
+    print(f"stub: {json.dumps(result['stub'], ensure_ascii=False)}")
+    print(f"{'stage':<20}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in result["stages"].items():
+        print(f"{name:<20}{stats['count']:>7}{stats['p50'] * 1000:>9.1f}{stats['p95'] * 1000:>9.1f}{stats['p99'] * 1000:>9.1f}")
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    os.environ["GEMINI_STREAMING"] = "1" if args.streaming else "0"
+    os.environ["GEMINI_FUNCTION_CALLING"] = "1" if args.function_calling else "0"
+    os.environ.setdefault("STREAM_EDIT_INTERVAL_SECONDS", "0.2")
+
+    async with GeminiStubServer(stub_config_from_args(args)) as stub:
+        os.environ["GEMINI_BASE_URL"] = stub.base_url
+
+        from request.http_client import http_client_manager
+        from request.memory import conversation_store
+
+        await http_client_manager.start()
+        # 模型相關的 print 很多，預設丟掉避免干擾輸出與耗時
+        sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        started = time.perf_counter()
+        try:
+            with sink:
+                runner = _run_core if args.mode == "core" else _run_request
+                latencies, errors = await runner(args)
+        finally:
+            wall = time.perf_counter() - started
+            await http_client_manager.close()
+            conversation_store.close()
+
+        return {
+            "mode": args.mode,
+            "sessions": args.sessions,
+            "turns": args.turns,
+            "streaming": args.streaming,
+            "function_calling": args.function_calling,
+            "wall_seconds": wall,
+            "throughput_per_second": len(latencies) / wall if wall else 0.0,
+            "errors": errors,
+            "latency_seconds": _percentiles(latencies),
+            "stages": _stage_report(),
+            "stub": stub.stats.as_dict(),
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmark against a local Gemini stub")
+    parser.add_argument("--mode", choices=("core", "request"), default="core",
+                        help="core: 經過 GameCore.send_message；request: 直接呼叫 google_request")
+    parser.add_argument("--sessions", type=int, default=10, help="同時進行的 session 數")
+    parser.add_argument("--turns", type=int, default=5, help="每個 session 送出的訊息數")
+    parser.add_argument("--think", type=float, default=0.0, help="玩家收到回覆後到下一則訊息的間隔 (秒)")
+    parser.add_argument("--burst", action="store_true", help="每個 session 一次送出所有訊息，不等回覆")
+    parser.add_argument("--timeout", type=float, default=120.0, help="burst 模式等待單則訊息的上限 (秒)")
+    parser.add_argument("--discord-latency", type=float, default=0.0, help="假 Discord send/edit 的延遲 (秒)")
+    parser.add_argument("--streaming", action="store_true", help="使用 streamGenerateContent")
+    parser.add_argument("--function-calling", action="store_true", help="使用原生 function calling")
+    parser.add_argument("--json", dest="json_path", help="另外把結果寫成 JSON 檔")
+    parser.add_argument("--verbose", action="store_true", help="保留模組內的 print 輸出")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    _print_report(result)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""模擬 Gemini generateContent / streamGenerateContent 的本機 HTTP stub
+
+可單獨啟動讓真正的 bot 指過來 (GEMINI_BASE_URL=http://127.0.0.1:8089/v1beta)：
+
+    python -m bench.stub_server --port 8089 --latency 0.4 --rate-5xx 0.05
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from request.logger_setup import logger
+from request.tokens import estimate_tokens
+
+_MODEL_PATH = re.compile(r"/models/([^/:]+):(generateContent|streamGenerateContent)$")
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+_SAMPLE_TEXT = (
+    "潮濕的石階向下延伸，火把的光在牆上投出搖晃的影子。"
+    "你聽見遠處傳來鐵鍊拖地的聲音，空氣裡混著鐵鏽與霉味。"
+    "前方的門半掩著，門縫下透出微弱的綠光。"
+)
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.3
+    jitter: float = 0.1
+    # 一部分請求特別慢，用來觀察尾端延遲與避險請求
+    slow_rate: float = 0.0
+    slow_latency: float = 5.0
+    # 串流時每個片段之間的間隔
+    chunk_delay: float = 0.05
+    chunks: int = 4
+    rate_429: float = 0.0
+    rate_5xx: float = 0.0
+    # 這些模型一律回傳 503，用來測試換模型
+    failing_models: Tuple[str, ...] = ()
+    # 429 回應附帶的 RetryInfo.retryDelay (秒)，None 表示不附
+    retry_after: Optional[float] = None
+    # 有宣告 tools 時回傳 functionCall 的機率
+    function_call_rate: float = 0.3
+    # 沒有 tools 時在文字裡夾帶 ☆DICE:{n}☆ 的機率
+    dice_rate: float = 0.3
+    text: str = _SAMPLE_TEXT
+    seed: Optional[int] = None
+
+
+@dataclass
+class StubStats:
+    requests: Counter = field(default_factory=Counter)
+    statuses: Counter = field(default_factory=Counter)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"requests": dict(self.requests), "statuses": {str(k): v for k, v in self.statuses.items()}}
+
+
+def _usage(body: Dict[str, Any], text: str) -> Dict[str, Any]:
+    prompt = estimate_tokens(json.dumps(body.get("contents") or [], ensure_ascii=False))
+    output = estimate_tokens(text)
+    usage = {"promptTokenCount": prompt, "candidatesTokenCount": output, "totalTokenCount": prompt + output}
+    if body.get("cachedContent"):
+        usage["cachedContentTokenCount"] = 512
+    return usage
+
+
+def _last_parts(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    contents = body.get("contents") or []
+    if not contents:
+        return []
+    return contents[-1].get("parts") or []
+
+
+class GeminiStubServer:
+    """只實作 benchmark 需要的 API 子集，HTTP/1.1 keep-alive 讓 httpx 連線池可以重用"""
+
+    def __init__(self, config: Optional[StubConfig] = None) -> None:
+        self.config = config or StubConfig()
+        self.stats = StubStats()
+        self._random = random.Random(self.config.seed)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._cache_seq = 0
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1beta"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> "GeminiStubServer":
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info("Gemini stub server listening on %s", self.base_url)
+        return self
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> "GeminiStubServer":
+        return await self.start()
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
+
+    # ---- HTTP ----
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, _ = lines[0].split(" ", 2)
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    def _write_response(self, writer: asyncio.StreamWriter, status: int, payload: Any) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, 'Error')}\r\n".encode("ascii")
+            + b"Content-Type: application/json; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+            + body
+        )
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    return
+                method, target, headers, raw = request
+                path = target.split("?", 1)[0]
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    self.stats.statuses[400] += 1
+                    self._write_response(writer, 400, {"error": {"code": 400, "message": "invalid JSON"}})
+                    await writer.drain()
+                    continue
+                await self._dispatch(writer, method, path, body)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # 關閉時還在模擬延遲的連線；正常結束 task，避免 asyncio 在 callback 裡印出錯誤
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, writer: asyncio.StreamWriter, method: str, path: str, body: Dict[str, Any]) -> None:
+        if path.endswith("/cachedContents") and method == "POST":
+            self.stats.requests["cachedContents.create"] += 1
+            self._cache_seq += 1
+            self.stats.statuses[200] += 1
+            self._write_response(writer, 200, {"name": f"cachedContents/stub-{self._cache_seq}", "model": body.get("model")})
+            return
+        if "/cachedContents/" in path and method == "PATCH":
+            self.stats.requests["cachedContents.patch"] += 1
+            self.stats.statuses[200] += 1
+            self._write_response(writer, 200, {"name": path[path.index("cachedContents/"):]})
+            return
+
+        match = _MODEL_PATH.search(path)
+        if method != "POST" or match is None:
+            self.stats.statuses[404] += 1
+            self._write_response(writer, 404, {"error": {"code": 404, "message": f"no route for {method} {path}"}})
+            return
+
+        model, action = match.groups()
+        self.stats.requests[action] += 1
+        cfg = self.config
+        latency = cfg.slow_latency if self._random.random() < cfg.slow_rate else cfg.latency
+        await asyncio.sleep(max(0.0, latency + self._random.uniform(-cfg.jitter, cfg.jitter)))
+
+        if model in cfg.failing_models:
+            self.stats.statuses[503] += 1
+            self._write_response(writer, 503, {"error": {"code": 503, "message": f"stub model {model} is down"}})
+            return
+
+        roll = self._random.random()
+        if roll < cfg.rate_429:
+            self.stats.statuses[429] += 1
+            error: Dict[str, Any] = {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}
+            if cfg.retry_after is not None:
+                error["details"] = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{cfg.retry_after}s"}]
+            self._write_response(writer, 429, {"error": error})
+            return
+        if roll < cfg.rate_429 + cfg.rate_5xx:
+            status = self._random.choice((500, 503))
+            self.stats.statuses[status] += 1
+            self._write_response(writer, status, {"error": {"code": status, "message": "stub injected failure"}})
+            return
+
+        self.stats.statuses[200] += 1
+        parts = self._build_parts(body)
+        if action == "generateContent":
+            text = "".join(p.get("text", "") for p in parts)
+            self._write_response(writer, 200, {
+                "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}],
+                "usageMetadata": _usage(body, text),
+                "modelVersion": model,
+            })
+            return
+        await self._write_stream(writer, model, body, parts)
+
+    def _build_parts(self, body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        cfg = self.config
+        last = _last_parts(body)
+        answering_tool = any("function_response" in p or "functionResponse" in p for p in last)
+        has_tools = bool(body.get("tools") or body.get("cachedContent"))
+
+        if has_tools and not answering_tool and self._random.random() < cfg.function_call_rate:
+            return [
+                {"text": "你試著撬開門鎖。"},
+                {"functionCall": {"name": "perform_d100_check", "args": {"success_rate": self._random.randint(5, 95)}}},
+            ]
+        text = cfg.text
+        if not has_tools and not answering_tool and self._random.random() < cfg.dice_rate:
+            text += f"☆DICE:{{{self._random.randint(5, 95)}}}☆"
+        return [{"text": text}]
+
+    async def _write_stream(self, writer: asyncio.StreamWriter, model: str, body: Dict[str, Any], parts: List[Dict[str, Any]]) -> None:
+        cfg = self.config
+        text = "".join(p.get("text", "") for p in parts)
+        calls = [p for p in parts if "functionCall" in p]
+        step = max(1, -(-len(text) // max(1, cfg.chunks)))
+        pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            chunk_parts: List[Dict[str, Any]] = [{"text": piece}] if piece else []
+            if last:
+                chunk_parts.extend(calls)
+            event: Dict[str, Any] = {
+                "candidates": [{"content": {"role": "model", "parts": chunk_parts}}],
+                # usageMetadata 是累計值，跟真實 API 一樣每個片段都附上
+                "usageMetadata": _usage(body, "".join(pieces[:index + 1])),
+                "modelVersion": model,
+            }
+            if last:
+                event["candidates"][0]["finishReason"] = "STOP"
+            data = f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+            writer.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            await writer.drain()
+            if not last:
+                await asyncio.sleep(cfg.chunk_delay)
+        writer.write(b"0\r\n\r\n")
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = StubConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="每個請求的基本延遲 (秒)")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="延遲的隨機抖動 (秒)")
+    parser.add_argument("--slow-rate", type=float, default=defaults.slow_rate, help="特別慢的請求比例")
+    parser.add_argument("--slow-latency", type=float, default=defaults.slow_latency, help="慢請求的延遲 (秒)")
+    parser.add_argument("--chunk-delay", type=float, default=defaults.chunk_delay, help="串流片段間隔 (秒)")
+    parser.add_argument("--chunks", type=int, default=defaults.chunks, help="串流回應切成幾段")
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429, help="回傳 429 的機率")
+    parser.add_argument("--rate-5xx", type=float, default=defaults.rate_5xx, help="回傳 500/503 的機率")
+    parser.add_argument("--failing-models", default="", help="一律回傳 503 的模型，逗號分隔")
+    parser.add_argument("--retry-after", type=float, default=None, help="429 回應建議的 retryDelay (秒)")
+    parser.add_argument("--function-call-rate", type=float, default=defaults.function_call_rate)
+    parser.add_argument("--dice-rate", type=float, default=defaults.dice_rate)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def stub_config_from_args(args: argparse.Namespace) -> StubConfig:
+    return StubConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        chunk_delay=args.chunk_delay,
+        chunks=args.chunks,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        failing_models=tuple(m.strip() for m in args.failing_models.split(",") if m.strip()),
+        retry_after=args.retry_after,
+        function_call_rate=args.function_call_rate,
+        dice_rate=args.dice_rate,
+        seed=args.seed,
+    )
+
+
+async def _serve_forever(config: StubConfig, host: str, port: int) -> None:
+    server = await GeminiStubServer(config).start(host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local Gemini API stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve_forever(stub_config_from_args(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
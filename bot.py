@@ -5,19 +5,62 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 
+# 先載入 .env，讓各模組在 import 時就能讀到設定
+load_dotenv()
+
+from request.http_client import http_client_manager
+from request.memory import conversation_store
+from request.state_store import state_store
+from request.summarizer import rolling_summarizer
+from game.prompt_registry import prompt_registry
+from game.outbox import outbox
+from game.snapshot import checkpointer
+from request.config import get_metrics_port, get_shard_count, get_shard_ids
+from request.metrics import start_metrics_server
+
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='$', intents=intents)
+if get_shard_count():
+    # 分片模式：這個行程只連線 SHARD_IDS 指定的 shard (見 launcher.py)，guild 依 shard 分配到各行程
+    bot = commands.AutoShardedBot(
+        command_prefix='$',
+        intents=intents,
+        shard_count=get_shard_count(),
+        shard_ids=get_shard_ids(),
+    )
+else:
+    bot = commands.Bot(command_prefix='$', intents=intents)
 
 @bot.event
 async def on_ready():
-    print(f'We have logged in as {bot.user}')
+    print(f'We have logged in as {bot.user} (shards: {sorted(bot.shards) if bot.shard_count else "-"})')
     
 async def setup_hook():
+    await http_client_manager.start()
+    rolling_summarizer.attach()
+    await checkpointer.start()
+    await prompt_registry.start()
     await bot.load_extension('cogs.hello')
     await bot.load_extension('cogs.fight')
+    await bot.load_extension('cogs.admin')
+    await bot.load_extension('cogs.campaign')
+    if get_metrics_port():
+        await start_metrics_server(get_metrics_port())
 bot.setup_hook = setup_hook
 
-load_dotenv()
+_bot_close = bot.close
+
+async def close():
+    # 先把排隊中的訊息送完，之後連線就關了
+    await outbox.close()
+    await rolling_summarizer.close()
+    await prompt_registry.close()
+    await http_client_manager.close()
+    await checkpointer.close()
+    conversation_store.close()
+    state_store.close()
+    await _bot_close()
+bot.close = close
+
 bot.run(os.getenv('DISCORD_TOKEN'))
\ No newline at end of file
@@ -0,0 +1,83 @@
+from discord.ext import commands
+from typing import Optional
+
+from game.session_manager import session_manager
+from request.metrics import metrics
+from request.rate_limiter import rate_limiter
+from request.response_cache import response_cache
+from request.resilience import circuit_breakers
+
+
+def _format_stats(session_id: str) -> str:
+    lines = ["**各階段耗時 (ms)**", "```", f"{'stage':<20}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}"]
+    stages = metrics.percentiles("stage_seconds")
+    turns = metrics.percentiles("turn_seconds")
+    rows = sorted(stages.items(), key=lambda item: dict(item[0]).get("stage", ""))
+    rows += [((("stage", "turn"),), stats) for stats in turns.values()]
+    for key, stats in rows:
+        name = dict(key).get("stage", "?")
+        lines.append(
+            f"{name:<20}{stats['count']:>7}{stats['p50'] * 1000:>9.0f}{stats['p95'] * 1000:>9.0f}{stats['p99'] * 1000:>9.0f}"
+        )
+    lines.append("```")
+
+    tokens = metrics.counters("tokens")
+    if tokens:
+        lines.append("**Token 用量**")
+        lines.append("```")
+        for key, value in sorted(tokens.items()):
+            labels = dict(key)
+            lines.append(f"{labels.get('model', '?'):<28}{labels.get('kind', '?'):<8}{int(value):>10}")
+        lines.append("```")
+
+    retries = sum(metrics.counters("http_retries").values())
+    errors = sum(metrics.counters("http_errors").values())
+    lines.append(f"HTTP 重試: {int(retries)}，連線錯誤: {int(errors)}")
+    for model, state in sorted(rate_limiter.snapshot().items()):
+        limit = f"{state['rpm_limit']:.1f}" if state["rpm_limit"] else "∞"
+        lines.append(
+            f"{model}: 排隊 {int(state['queue_depth'])}，近一分鐘 {int(state['requests_last_minute'])} 次 / "
+            f"{int(state['tokens_last_minute'])} tokens，上限 {limit} rpm"
+        )
+    for key, state in sorted(circuit_breakers.snapshot().items()):
+        p95 = state.get("p95")
+        lines.append(f"{key}: 斷路器 {state['state']}" + (f"，p95 {p95 * 1000:.0f} ms" if p95 is not None else ""))
+    totals = metrics.session_totals(session_id)
+    lines.append(
+        f"{session_id}: {int(totals.get('turns', 0))} 回合，"
+        f"{int(totals.get('total_tokens', 0))} tokens (快取 {int(totals.get('cached_tokens', 0))})"
+    )
+    lines.append(f"進行中的戰役: {len(session_manager.active())}")
+    return "\n".join(lines)
+
+
+class Admin(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @commands.command()
+    @commands.has_permissions(manage_guild=True)
+    async def stats(self, ctx):
+        await ctx.send(_format_stats(await session_manager.session_id_for(ctx)))
+
+    @commands.command()
+    @commands.has_permissions(manage_guild=True)
+    async def cache(self, ctx, command: Optional[str] = None, state: Optional[str] = None):
+        """$cache 查看回應快取；$cache <指令> on|off 切換該指令是否使用快取；$cache clear 清空"""
+        if command == "clear":
+            response_cache.clear()
+            await ctx.send("回應快取已清空")
+            return
+        if command and state in ("on", "off"):
+            response_cache.set_enabled(command, state == "on")
+            await ctx.send(f"{command} 的回應快取已{'開啟' if state == 'on' else '關閉'}")
+            return
+
+        hits = {dict(key).get("tier", "?"): int(value) for key, value in metrics.counters("response_cache").items()}
+        await ctx.send(
+            f"回應快取: {len(response_cache)} 筆，完全命中 {hits.get('exact', 0)}，"
+            f"相似命中 {hits.get('similar', 0)}，未命中 {hits.get('miss', 0)}"
+        )
+
+async def setup(bot):
+    await bot.add_cog(Admin(bot))
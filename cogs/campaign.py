@@ -0,0 +1,81 @@
+import tempfile
+
+import discord
+from discord.ext import commands
+from typing import Optional
+
+from game.prompt_registry import prompt_registry
+from game.session_manager import session_manager
+from game.snapshot import SnapshotError, export_session, import_session, snapshot_filename
+
+
+class Campaign(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @commands.command()
+    async def campaign(self, ctx, *, campaign_id: Optional[str] = None):
+        """$campaign 查看目前頻道的 session；$campaign <id> 綁定戰役；$campaign off 解除綁定"""
+        if not campaign_id:
+            await ctx.send(f'目前頻道的 session: {await session_manager.session_id_for(ctx)}')
+            return
+
+        campaign_id = campaign_id.strip()
+        if campaign_id.lower() == "off":
+            session_id = await session_manager.unbind(ctx)
+            await ctx.send(f'已解除戰役綁定，這個頻道改用自己的 session: {session_id}')
+            return
+
+        session_id = await session_manager.bind(ctx, campaign_id)
+        await ctx.send(f'這個頻道已綁定戰役 {campaign_id} (session: {session_id})')
+
+    @commands.command()
+    @commands.has_permissions(manage_guild=True)
+    async def prompt(self, ctx, name: Optional[str] = None):
+        """$prompt 查看目前 session 的 system prompt；$prompt <名稱> 改用 prompt/<名稱>.txt；$prompt default 改回預設"""
+        session_id = await session_manager.session_id_for(ctx)
+        if not name:
+            names = ", ".join(prompt_registry.available()) or "無"
+            await ctx.send(f'{session_id} 使用的 prompt: {await prompt_registry.session_prompt_name(session_id)} (可用: {names})')
+            return
+
+        if not await prompt_registry.assign(session_id, name.strip()):
+            await ctx.send(f'找不到 prompt: {name}')
+            return
+        await ctx.send(f'{session_id} 之後改用 prompt: {name.strip()}')
+
+    @commands.command(name="export")
+    async def export_snapshot(self, ctx):
+        """$export 把目前 session 的歷史、摘要與戰鬥狀態匯出成快照檔"""
+        session_id = await session_manager.session_id_for(ctx)
+        # 小檔留在記憶體，大的戰役才落到暫存檔
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as buffer:
+            records = await export_session(session_id, buffer)
+            buffer.seek(0)
+            await ctx.send(
+                f'已匯出 {session_id} ({records} 筆紀錄)',
+                file=discord.File(buffer, filename=snapshot_filename(session_id)),
+            )
+
+    @commands.command(name="import")
+    @commands.has_permissions(manage_guild=True)
+    async def import_snapshot(self, ctx):
+        """$import 並附上快照檔，取代目前 session 的歷史與戰鬥狀態"""
+        if not ctx.message.attachments:
+            await ctx.send('請附上 $export 匯出的快照檔')
+            return
+
+        session_id = await session_manager.session_id_for(ctx)
+        with tempfile.TemporaryFile() as f:
+            await ctx.message.attachments[0].save(f)
+            f.seek(0)
+            try:
+                info = await import_session(f, session_id)
+            except SnapshotError as exc:
+                await ctx.send(f'匯入失敗: {exc}')
+                return
+        fight = '，含戰鬥狀態' if info.fight else ''
+        await ctx.send(f'已匯入 {info.turns} 個回合到 {session_id}{fight}')
+
+async def setup(bot):
+    await bot.add_cog(Campaign(bot))
@@ -1,7 +1,11 @@
 from discord.ext import commands
 from typing import Optional
 
+from game.dice import DiceError, dice_engine
+from game.fight_manager import fight_manager
 from game.game_core import game_core
+from game.outbox import outbox
+from game.session_manager import session_manager
 
 
 class Fight(commands.Cog):
@@ -34,5 +38,56 @@ class Fight(commands.Cog):
         game_core.enter_message("002", message)
         #fight_manager.enter_message(ctx.author.id, message)
 
+    @commands.command()
+    async def npc(self, ctx, name: Optional[str] = None, hp: Optional[int] = None, initiative: int = 0):
+        if not name or hp is None:
+            await ctx.send('用法: $npc 名字 血量 [先攻]')
+            return
+
+        session_id = await session_manager.session_id_for(ctx)
+        await fight_manager.add_character(name, hp, scope=session_id, initiative=initiative)
+        await ctx.send(f'{name} 加入戰鬥 (血量 {hp}，先攻 {initiative})')
+
+    @commands.command()
+    async def hp(self, ctx):
+        status = await fight_manager.get_character_status(await session_manager.session_id_for(ctx))
+        await ctx.send(status or '目前沒有進行中的戰鬥')
+
+    @commands.command(name='next')
+    async def next_turn(self, ctx):
+        character = await fight_manager.next_turn(await session_manager.session_id_for(ctx))
+        await ctx.send(f'輪到 {character.name}' if character else '沒有可以行動的角色')
+
+    @commands.command()
+    async def dice(self, ctx, *expressions: str):
+        if not expressions:
+            await ctx.send('用法: $dice 3d6+2 adv 6d10>=8 ...')
+            return
+
+        session_id = await session_manager.session_id_for(ctx)
+        try:
+            results = dice_engine.roll_many(expressions, session_id)
+        except DiceError as e:
+            await ctx.send(str(e))
+            return
+        await outbox.send(ctx, "\n".join(r.describe() for r in results))
+
+    @commands.command()
+    @commands.has_permissions(manage_guild=True)
+    async def seed(self, ctx, seed: Optional[int] = None):
+        session_id = await session_manager.session_id_for(ctx)
+        if seed is None:
+            await ctx.send(f'目前的擲骰種子: {dice_engine.seed_of(session_id)}')
+            return
+
+        dice_engine.seed(session_id, seed)
+        await ctx.send(f'擲骰種子設為 {seed}，之後的擲骰可以用同一個種子重現')
+
+    @commands.command()
+    async def rolls(self, ctx, count: int = 10):
+        session_id = await session_manager.session_id_for(ctx)
+        entries = dice_engine.history(session_id)[-max(1, count):]
+        await outbox.send(ctx, "\n".join(e.detail for e in entries) or '還沒有擲骰紀錄')
+
 async def setup(bot):
     await bot.add_cog(Fight(bot))
\ No newline at end of file
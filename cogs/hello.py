@@ -2,8 +2,10 @@ from discord.ext import commands
 import json
 from typing import Optional
 
+from game.outbox import outbox
 from request.google_chat import google_request
 from request.model import ChatRequest
+from request.logger_setup import logger
 
 class Hello(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -19,16 +21,17 @@ class Hello(commands.Cog):
             await ctx.send('用法: $chat 你的訊息')
             return
         
-        print(f"傳送message給模型: {message}")
+        logger.info("傳送message給模型: %s", message)
         req = ChatRequest(
             prompt=message,
             session_id=str(ctx.author.id),
             system_prompt="請全程使用中文輸出模型內容。",
+            cache_command="chat",
         )
         resp = await google_request(req)
-        print(f"模型回傳: {resp}")
+        logger.debug("模型回傳", extra={"payload": resp})
         text = resp.get("text") or ""
-        await ctx.send(text or "（無回覆）")
+        await outbox.send(ctx, text or "（無回覆）")
         
 async def setup(bot):
     await bot.add_cog(Hello(bot))
\ No newline at end of file
@@ -0,0 +1,258 @@
+"""擲骰引擎：解析標準骰子表示法，一次呼叫擲完一整批骰子，每個 session 有自己的可重現 RNG
+
+支援的寫法 (不分大小寫):
+    d100, 3d6+2, 4d6kh3 (取最高 3 顆), 2d20kl1 (取最低 1 顆), adv / dis (2d20 取高 / 取低),
+    6d10>=8 (骰池，計算達標的顆數)
+
+同一批裡相同面數的骰子一次抽出；安裝 NumPy 且數量夠多時走向量化路徑。
+同一個種子在同一種路徑下會得到相同的序列，每次擲骰也會記在 session 的紀錄裡供重播。
+"""
+from __future__ import annotations
+
+import hashlib
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from request.config import get_dice_seed, get_dice_log_size
+
+try:
+    import numpy as np
+except ImportError:  # NumPy 是選用相依
+    np = None
+
+# 同一種面數要抽的骰子數量達到這個值才改用 NumPy
+VECTOR_THRESHOLD = 64
+MAX_DICE = 10000
+MAX_SIDES = 10000
+MAX_SESSIONS = 1024
+
+_ALIASES = {"adv": "2d20kh1", "dis": "2d20kl1"}
+
+_NOTATION = re.compile(
+    r"^(?P<count>\d*)d(?P<sides>\d+|%)"
+    r"(?:k(?P<keep>[hl]?)(?P<keep_n>\d+))?"
+    r"(?:(?P<cmp>>=|<=|>|<)(?P<target>\d+))?"
+    r"(?P<mod>(?:[+-]\d+)*)$"
+)
+
+
+class DiceError(ValueError):
+    """骰子表示法無法解析或超出範圍"""
+
+
+@dataclass(frozen=True)
+class DiceExpression:
+    text: str
+    count: int
+    sides: int
+    keep: Optional[str] = None
+    keep_n: int = 0
+    cmp: Optional[str] = None
+    target: int = 0
+    modifier: int = 0
+
+    def evaluate(self, rolls: Sequence[int]) -> "RollResult":
+        kept = list(rolls)
+        if self.keep:
+            kept = sorted(kept, reverse=self.keep == "h")[:self.keep_n]
+        if self.cmp:
+            successes = sum(1 for value in kept if _compare(value, self.cmp, self.target))
+            return RollResult(self.text, tuple(rolls), tuple(kept), successes + self.modifier, pool=True)
+        return RollResult(self.text, tuple(rolls), tuple(kept), sum(kept) + self.modifier)
+
+
+def _compare(value: int, op: str, target: int) -> bool:
+    if op == ">=":
+        return value >= target
+    if op == "<=":
+        return value <= target
+    if op == ">":
+        return value > target
+    return value < target
+
+
+@lru_cache(maxsize=512)
+def parse(notation: str) -> DiceExpression:
+    text = notation.strip().lower().replace(" ", "")
+    m = _NOTATION.match(_ALIASES.get(text, text))
+    if not m:
+        raise DiceError(f"無法解析的骰子表示法: {notation}")
+    count = int(m.group("count") or 1)
+    sides = 100 if m.group("sides") == "%" else int(m.group("sides"))
+    if not 1 <= count <= MAX_DICE or not 1 <= sides <= MAX_SIDES:
+        raise DiceError(f"骰子數量或面數超出範圍: {notation}")
+    keep = None
+    keep_n = 0
+    if m.group("keep_n"):
+        keep = m.group("keep") or "h"
+        keep_n = min(int(m.group("keep_n")), count)
+    modifier = sum(int(part) for part in re.findall(r"[+-]\d+", m.group("mod") or ""))
+    return DiceExpression(
+        text=text,
+        count=count,
+        sides=sides,
+        keep=keep,
+        keep_n=keep_n,
+        cmp=m.group("cmp"),
+        target=int(m.group("target") or 0),
+        modifier=modifier,
+    )
+
+
+@dataclass(frozen=True)
+class RollResult:
+    expression: str
+    rolls: Tuple[int, ...]
+    kept: Tuple[int, ...]
+    total: int
+    pool: bool = False
+
+    def describe(self) -> str:
+        shown = _format_values(self.rolls)
+        if self.kept != self.rolls:
+            shown += f" 取 {_format_values(self.kept)}"
+        if self.pool:
+            return f"🎲{self.expression}: {shown} 成功 {self.total}"
+        return f"🎲{self.expression}: {shown} = {self.total}"
+
+
+def _format_values(values: Sequence[int], limit: int = 20) -> str:
+    # 大量骰子只顯示前面幾顆，避免訊息過長
+    text = ", ".join(map(str, values[:limit]))
+    return f"[{text}, ...]" if len(values) > limit else f"[{text}]"
+
+
+@dataclass(frozen=True)
+class RollLogEntry:
+    at: float
+    kind: str
+    detail: str
+
+
+class _SessionDice:
+    __slots__ = ("seed", "rng", "np_rng", "log")
+
+    def __init__(self, seed: Optional[int], log_size: int) -> None:
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed) if np is not None else None
+        self.log: Deque[RollLogEntry] = deque(maxlen=log_size)
+
+
+def d100_status(roll: int, success_rate: int) -> str:
+    # 1 大成功、100 大失敗，其餘與成功率比較
+    if roll == 1:
+        return f"🎲擲骰大成功, 成功率:{success_rate}"
+    if roll == 100:
+        return f"🎲擲骰大失敗, 成功率:{success_rate}"
+    if roll <= success_rate:
+        return f"🎲擲骰成功, 成功率:{success_rate}"
+    return f"🎲擲骰失敗, 成功率:{success_rate}"
+
+
+class DiceEngine:
+    def __init__(self, base_seed: Optional[int] = None, log_size: int = 200) -> None:
+        self._base_seed = base_seed
+        self._log_size = log_size
+        self._sessions: "OrderedDict[str, _SessionDice]" = OrderedDict()
+        # 明確指定過種子的 session 不參與淘汰，否則種子與擲骰紀錄被丟掉後就無法重播
+        self._seeded: Dict[str, _SessionDice] = {}
+
+    def _default_seed(self, session_id: str) -> Optional[int]:
+        if self._base_seed is None:
+            return None
+        # 由全域種子與 session id 推導，重啟後同一個 session 仍得到同一個序列
+        digest = hashlib.sha256(f"{self._base_seed}:{session_id}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def _session(self, session_id: Optional[str]) -> _SessionDice:
+        key = session_id or ""
+        state = self._seeded.get(key)
+        if state is not None:
+            return state
+        state = self._sessions.get(key)
+        if state is None:
+            state = self._insert(key, _SessionDice(self._default_seed(key), self._log_size))
+        else:
+            self._sessions.move_to_end(key)
+        return state
+
+    def _insert(self, key: str, state: _SessionDice) -> _SessionDice:
+        # 超過上限時淘汰最久沒用的 session
+        self._sessions[key] = state
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > MAX_SESSIONS:
+            self._sessions.popitem(last=False)
+        return state
+
+    def seed(self, session_id: Optional[str], seed: Optional[int]) -> None:
+        """重設 session 的 RNG；同一個種子之後的擲骰序列相同，紀錄一併清空
+
+        seed 為 None 時改回預設種子，session 重新參與淘汰。
+        """
+        key = session_id or ""
+        self._sessions.pop(key, None)
+        if seed is None:
+            self._seeded.pop(key, None)
+        else:
+            self._seeded[key] = _SessionDice(seed, self._log_size)
+
+    def seed_of(self, session_id: Optional[str]) -> Optional[int]:
+        return self._session(session_id).seed
+
+    def history(self, session_id: Optional[str]) -> List[RollLogEntry]:
+        return list(self._session(session_id).log)
+
+    @staticmethod
+    def _draw(state: _SessionDice, sides: int, n: int) -> List[int]:
+        if state.np_rng is not None and n >= VECTOR_THRESHOLD:
+            return state.np_rng.integers(1, sides + 1, size=n).tolist()
+        randint = state.rng.randint
+        return [randint(1, sides) for _ in range(n)]
+
+    def _draw_batch(self, state: _SessionDice, requests: Sequence[Tuple[int, int]]) -> List[List[int]]:
+        """requests 是 (面數, 顆數)；相同面數的骰子合併成一次抽取再切回各自的份"""
+        totals: Dict[int, int] = {}
+        for sides, count in requests:
+            totals[sides] = totals.get(sides, 0) + count
+        pools = {sides: self._draw(state, sides, n) for sides, n in totals.items()}
+        offsets = dict.fromkeys(totals, 0)
+        result: List[List[int]] = []
+        for sides, count in requests:
+            start = offsets[sides]
+            result.append(pools[sides][start:start + count])
+            offsets[sides] = start + count
+        return result
+
+    def roll_many(self, notations: Iterable[str], session_id: Optional[str] = None) -> List[RollResult]:
+        expressions = [parse(n) for n in notations]
+        state = self._session(session_id)
+        draws = self._draw_batch(state, [(e.sides, e.count) for e in expressions])
+        results = [e.evaluate(rolls) for e, rolls in zip(expressions, draws)]
+        now = time.time()
+        for result in results:
+            state.log.append(RollLogEntry(now, "roll", result.describe()))
+        return results
+
+    def roll(self, notation: str, session_id: Optional[str] = None) -> RollResult:
+        return self.roll_many([notation], session_id)[0]
+
+    def d100_checks(self, success_rates: Sequence[int], session_id: Optional[str] = None) -> List[str]:
+        """一次擲完一整組 D100 檢定，回傳每個檢定的結果文字"""
+        state = self._session(session_id)
+        rolls = self._draw(state, 100, len(success_rates))
+        now = time.time()
+        messages = []
+        for roll, rate in zip(rolls, success_rates):
+            message = d100_status(roll, rate)
+            state.log.append(RollLogEntry(now, "d100", f"{message} (擲出 {roll})"))
+            messages.append(message)
+        return messages
+
+
+dice_engine = DiceEngine(get_dice_seed(), get_dice_log_size())
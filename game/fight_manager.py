@@ -1,39 +1,322 @@
 
+import asyncio
+import contextlib
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
-from ast import Dict
+from request.state_store import FieldChanges, StateStore, state_store
+
+
+DEFAULT_SCOPE = "default"
+
+DamageResult = Dict[str, str]
+
+# 共用 store 中每場戰鬥是一組欄位：版本號、先攻順序、輪到誰與回合數各一欄，每個角色一欄
+VERSION_FIELD = "version"
+ORDER_FIELD = "order"
+TURN_FIELD = "turn"
+CHARACTER_PREFIX = "c:"
 
 
 class Character:
-    def __init__(self, name: str, hp: int):
+    __slots__ = ("name", "hp", "max_hp", "initiative")
+
+    def __init__(self, name: str, hp: int, max_hp: Optional[int] = None, initiative: int = 0):
         self.name = name
         self.hp = hp
-        self.max_hp = hp
+        self.max_hp = hp if max_hp is None else max_hp
+        self.initiative = initiative
+
+    @property
+    def alive(self) -> bool:
+        return self.hp > 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "hp": self.hp, "max_hp": self.max_hp, "initiative": self.initiative}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Character":
+        return cls(data["name"], int(data["hp"]), int(data.get("max_hp", data["hp"])), int(data.get("initiative", 0)))
+
+
+class Encounter:
+    """一場戰鬥：名字 -> 角色的索引、先攻順序與目前輪到誰，狀態文字快取到下次變動為止"""
+
+    __slots__ = ("characters", "order", "turn", "round", "version", "_status", "_dirty")
+
+    def __init__(self) -> None:
+        self.characters: Dict[str, Character] = {}
+        # 先攻順序只在加入/移除角色時重排
+        self.order: List[str] = []
+        self.turn = 0
+        self.round = 1
+        self.version = 0
+        self._status: Optional[str] = None
+        # 上次寫回 store 之後變動過的欄位
+        self._dirty: Set[str] = set()
+
+    def _changed(self, *fields: str) -> None:
+        self._status = None
+        self._dirty.update(fields)
+
+    def _sorted_order(self) -> List[str]:
+        # sorted 是穩定排序，先攻相同時維持加入順序
+        return sorted(self.characters, key=lambda name: -self.characters[name].initiative)
+
+    def _reorder(self) -> None:
+        # 戰鬥還沒開始輪轉時從先攻最高的開始；已經開始就維持輪到的角色不變
+        started = self.turn > 0 or self.round > 1
+        current = self.current if started else None
+        self.order = self._sorted_order()
+        self.turn = self.order.index(current.name) if current is not None and current.name in self.characters else 0
+        self._changed(ORDER_FIELD, TURN_FIELD)
+
+    def add(self, name: str, hp: int, initiative: int = 0) -> Character:
+        character = Character(name, hp, initiative=initiative)
+        self.characters[name] = character
+        self._dirty.add(CHARACTER_PREFIX + name)
+        self._reorder()
+        return character
+
+    def remove(self, name: str) -> bool:
+        if self.characters.pop(name, None) is None:
+            return False
+        self._dirty.add(CHARACTER_PREFIX + name)
+        self._reorder()
+        return True
+
+    def apply_damage(self, target: str, damage: int) -> DamageResult:
+        character = self.characters.get(target)
+        if character is None:
+            return {"status": "not_found", "result": f"{target} 不存在"}
+        character.hp -= damage
+        self._changed(CHARACTER_PREFIX + target)
+        if character.hp <= 0:
+            return {"status": "dead", "result": f"{target} 死亡"}
+        return {"status": "damage", "result": f"{target} 受到 {damage} 點傷害，剩餘血量 {character.hp}"}
+
+    @property
+    def current(self) -> Optional[Character]:
+        if not self.order:
+            return None
+        return self.characters.get(self.order[self.turn % len(self.order)])
+
+    def next_turn(self) -> Optional[Character]:
+        """輪到下一個還活著的角色，繞回開頭時回合數加一"""
+        for _ in range(len(self.order)):
+            self.turn += 1
+            if self.turn >= len(self.order):
+                self.turn = 0
+                self.round += 1
+            character = self.current
+            if character is not None and character.alive:
+                self._changed(TURN_FIELD)
+                return character
+        self._changed(TURN_FIELD)
+        return None
+
+    def status(self) -> str:
+        if self._status is None:
+            current = self.current
+            lines = [f"第 {self.round} 輪"] if self.order else []
+            for name in self.order:
+                character = self.characters[name]
+                marker = "▶ " if character is current else ""
+                lines.append(f"{marker}{character.name} 血量: {character.hp}/{character.max_hp}")
+            self._status = "".join(line + "\n" for line in lines)
+        return self._status
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "characters": [self.characters[name].to_dict() for name in self.order],
+            "turn": self.turn,
+            "round": self.round,
+            "version": self.version,
+        }
+
+    def take_changes(self) -> FieldChanges:
+        """取出上次之後變動過的欄位 (被移除的角色是 None) 並清空紀錄"""
+        changes: FieldChanges = {}
+        for field in self._dirty:
+            if field == ORDER_FIELD:
+                changes[field] = list(self.order)
+            elif field == TURN_FIELD:
+                changes[field] = {"turn": self.turn, "round": self.round}
+            else:
+                character = self.characters.get(field[len(CHARACTER_PREFIX):])
+                changes[field] = character.to_dict() if character is not None else None
+        self._dirty.clear()
+        return changes
+
+    def to_fields(self) -> FieldChanges:
+        """整場戰鬥的所有欄位 (不含版本號)"""
+        fields: FieldChanges = {ORDER_FIELD: list(self.order), TURN_FIELD: {"turn": self.turn, "round": self.round}}
+        for name, character in self.characters.items():
+            fields[CHARACTER_PREFIX + name] = character.to_dict()
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields: Dict[str, Any]) -> "Encounter":
+        encounter = cls()
+        for field, value in fields.items():
+            if field.startswith(CHARACTER_PREFIX):
+                character = Character.from_dict(value)
+                encounter.characters[character.name] = character
+        # 順序欄位與角色欄位對不上時 (例如手動修改過) 補上缺的角色並重排
+        order = [name for name in fields.get(ORDER_FIELD) or [] if name in encounter.characters]
+        if len(order) != len(encounter.characters):
+            order = encounter._sorted_order()
+        encounter.order = order
+        turn = fields.get(TURN_FIELD) or {}
+        encounter.turn = int(turn.get("turn", 0)) % len(order) if order else 0
+        encounter.round = int(turn.get("round", 1))
+        encounter.version = int(fields.get(VERSION_FIELD) or 0)
+        return encounter
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "Encounter":
+        encounter = cls()
+        if not data:
+            return encounter
+        # 舊格式直接存角色 list
+        items = data if isinstance(data, list) else data.get("characters") or []
+        for item in items:
+            character = Character.from_dict(item)
+            encounter.characters[character.name] = character
+        stored = list(encounter.characters)
+        # 匯入或手動修改過的資料不一定照先攻排，一律重排；輪到的角色照存檔時的順序找回來
+        encounter.order = encounter._sorted_order()
+        if isinstance(data, dict):
+            turn = int(data.get("turn", 0))
+            if stored:
+                encounter.turn = encounter.order.index(stored[turn % len(stored)])
+            encounter.round = int(data.get("round", 1))
+            encounter.version = int(data.get("version", 0))
+        return encounter
+
 
 class FightManager:
-    def __init__(self):
-        self.character_list : list[Character] = []
-        pass
-    
-    def damage(self, target: str, damage: int) -> Dict[str, str]:
-        for character in self.character_list:
-            if character.name == target:
-                character.hp -= damage
-                if character.hp <= 0:
-                    return {"status": "dead", "result": f"{target} 死亡"}
-                return {"status": "damage", "result": f"{target} 受到 {damage} 點傷害，剩餘血量 {character.hp}"}
-        return {"status": "not_found", "result": f"{target} 不存在"}
-    
-    def get_character_status(self) -> str:
-        status = ""
-        for character in self.character_list:
-            status += f"{character.name} 血量: {character.hp}/{character.max_hp}\n"
-        return status
-    
-        
-    
-fight_manager = FightManager()
+    """每個 session 一場 Encounter，物件常駐記憶體
+
+    store 可跨行程共用時，每場戰鬥在 store 裡是一組欄位 (見 VERSION_FIELD 等)。讀取只查版本號一欄，
+    版本和記憶體中的一樣就直接用快取；變更在 event loop 上套用到快取後，只寫回變動的欄位並遞增版本號，
+    版本號已被其他行程改過時重新載入再套用一次。store 的讀寫都在執行緒裡做，不卡 event loop。
+    同一個模型回應裡的多筆傷害用 apply_damage_batch 一次套用，只寫回一次。
+    """
+
+    def __init__(self, store: StateStore):
+        self._store = store
+        self._encounters: Dict[str, Encounter] = {}
+        # 同一行程內對同一場戰鬥的變更依序進行；[鎖, 使用中的數量]，用完就移除
+        self._locks: Dict[str, List[Any]] = {}
+
+    @staticmethod
+    def _key(scope: str) -> str:
+        return f"encounter:{scope}"
+
+    @contextlib.asynccontextmanager
+    async def _scope_lock(self, scope: str) -> AsyncIterator[None]:
+        entry = self._locks.get(scope)
+        if entry is None:
+            entry = self._locks[scope] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[scope]
+
+    async def encounter(self, scope: str = DEFAULT_SCOPE) -> Encounter:
+        cached = self._encounters.get(scope)
+        if self._store.shared:
+            version = int(await self._store.aget_field(self._key(scope), VERSION_FIELD) or 0)
+            if cached is None or version != cached.version:
+                fields = await self._store.aget_fields(self._key(scope))
+                cached = self._encounters[scope] = Encounter.from_fields(fields)
+        elif cached is None:
+            cached = self._encounters[scope] = Encounter()
+        return cached
+
+    async def _mutate(self, scope: str, action: Callable[[Encounter], Any]) -> Any:
+        if not self._store.shared:
+            encounter = await self.encounter(scope)
+            result = action(encounter)
+            encounter.take_changes()
+            # 單一行程時版本號只用來讓 checkpoint 判斷戰鬥是否有變動
+            encounter.version += 1
+            return result
+
+        async with self._scope_lock(scope):
+            while True:
+                encounter = await self.encounter(scope)
+                result = action(encounter)
+                changes = encounter.take_changes()
+                if not changes:
+                    return result
+                expected = encounter.version
+                changes[VERSION_FIELD] = expected + 1
+                if await self._store.aset_fields_if(self._key(scope), VERSION_FIELD, expected or None, changes):
+                    encounter.version = expected + 1
+                    return result
+                # 其他行程先寫入了：丟掉套用過的快取，重新載入後再套用一次
+                self._encounters.pop(scope, None)
+
+    async def get_characters(self, scope: str = DEFAULT_SCOPE) -> List[Character]:
+        encounter = await self.encounter(scope)
+        return [encounter.characters[name] for name in encounter.order]
+
+    async def add_character(self, name: str, hp: int, scope: str = DEFAULT_SCOPE, initiative: int = 0) -> None:
+        await self._mutate(scope, lambda encounter: encounter.add(name, hp, initiative))
+
+    async def remove_character(self, name: str, scope: str = DEFAULT_SCOPE) -> bool:
+        return await self._mutate(scope, lambda encounter: encounter.remove(name))
+
+    async def clear(self, scope: str = DEFAULT_SCOPE) -> None:
+        self._encounters.pop(scope, None)
+        await self._store.adelete(self._key(scope))
+
+    async def damage(self, target: str, damage: int, scope: str = DEFAULT_SCOPE) -> DamageResult:
+        return (await self.apply_damage_batch([(target, damage)], scope))[0]
+
+    async def apply_damage_batch(self, hits: Iterable[Tuple[str, int]], scope: str = DEFAULT_SCOPE) -> List[DamageResult]:
+        """依序套用多筆傷害，整批只寫回一次，且只寫被打到的角色"""
+        hits = list(hits)
+        return await self._mutate(scope, lambda encounter: [encounter.apply_damage(t, d) for t, d in hits])
+
+    async def next_turn(self, scope: str = DEFAULT_SCOPE) -> Optional[Character]:
+        return await self._mutate(scope, lambda encounter: encounter.next_turn())
+
+    async def get_character_status(self, scope: str = DEFAULT_SCOPE) -> str:
+        return (await self.encounter(scope)).status()
 
+    def loaded(self) -> Dict[str, Encounter]:
+        """這個行程記憶體中的戰鬥，不讀 store"""
+        return dict(self._encounters)
 
+    async def export(self, scope: str = DEFAULT_SCOPE) -> Optional[Dict[str, Any]]:
+        encounter = await self.encounter(scope)
+        return encounter.to_dict() if encounter.characters else None
 
+    async def restore(self, scope: str, data: Optional[Dict[str, Any]]) -> None:
+        """以快照取代整場戰鬥；data 為空時等同清除"""
+        if not data:
+            await self.clear(scope)
+            return
+        encounter = Encounter.from_dict(data)
+        if self._store.shared:
+            fields = encounter.to_fields()
+            async with self._scope_lock(scope):
+                while True:
+                    # 版本號接在現有的後面，其他行程才會重新載入
+                    current = await self._store.aget_field(self._key(scope), VERSION_FIELD)
+                    encounter.version = int(current or 0) + 1
+                    changes = dict(fields, **{VERSION_FIELD: encounter.version})
+                    if await self._store.aset_fields_if(self._key(scope), VERSION_FIELD, current, changes, replace=True):
+                        break
+        else:
+            encounter.version += 1
+        self._encounters[scope] = encounter
 
 
+fight_manager = FightManager(state_store)
@@ -1,55 +1,55 @@
-import random
 import json
-import os
-from pathlib import Path
-from request.google_chat import google_request
-from request.logger_setup import logger
+from game.dice import dice_engine
+from game.function_declarations import tools_declaration, TOOL_MODE_INSTRUCTION
+from game.prompt_registry import prompt_registry
+from request.config import get_function_calling_enabled
+from request.google_chat import google_request, google_request_stream
 from request.model import ChatRequest
+from request.rate_limiter import PRIORITY_INTERACTIVE
+from request.model_router import ROUTE_NARRATION
 
-#@lru_cache(maxsize=1)
-def read_system_prompt() -> str:
-    """Read system prompt text with robust path resolution and caching.
+async def read_system_prompt(session_id=None) -> str:
+    """Return the system prompt for a session from the in-memory prompt registry.
 
-    Resolution order:
-    1) Env var `SYSTEM_PROMPT_PATH` (absolute or relative to project root)
-    2) Default: `<project_root>/prompt/desription.txt`
+    Files are loaded once and reloaded in the background when their mtime
+    changes (see `game.prompt_registry`), so this never touches disk on the
+    request path after the first load. The session's prompt choice lives in
+    the state store.
     """
-    try:
-        project_root = Path(__file__).resolve().parent.parent
-        env_path = os.getenv("SYSTEM_PROMPT_PATH")
+    return await prompt_registry.get_for_session(session_id)
 
-        if env_path:
-            candidate_path = Path(env_path)
-            if not candidate_path.is_absolute():
-                candidate_path = project_root / candidate_path
-        else:
-            candidate_path = project_root / "prompt" / "description.txt"
+async def send_to_google_ai(message, session_id, tool_responses=None, priority=PRIORITY_INTERACTIVE, route=ROUTE_NARRATION, cache_command=None):
+    system_prompt = await read_system_prompt(session_id)
+    tools = None
+    if get_function_calling_enabled():
+        system_prompt += TOOL_MODE_INSTRUCTION
+        tools = tools_declaration
 
-        content = candidate_path.read_text(encoding="utf-8")
-        if not content.strip():
-            logger.warning("System prompt file is empty: %s", candidate_path)
-        else:
-            logger.info("Loaded system prompt from: %s", candidate_path)
-        return content
-    except FileNotFoundError:
-        logger.error("System prompt file not found. Set SYSTEM_PROMPT_PATH or ensure default exists at 'prompt/desription.txt'.")
-        return ""
-    except Exception as exc:
-        logger.exception("Failed to read system prompt: %s", exc)
-        return ""
-
-async def send_to_google_ai(message, session_id):
     req = ChatRequest(
         prompt=message,
         session_id=session_id,
-        system_prompt=read_system_prompt(),
-        #tools_declaration=tools_declaration
+        system_prompt=system_prompt,
+        tools_declaration=tools,
+        tool_responses=tool_responses,
+        priority=priority,
+        route=route,
+        cache_command=cache_command,
     )
     
     resp = await google_request(req)
     return resp
 
-def perform_d100_check(success_rate: int) -> str:
+async def send_to_google_ai_stream(message, session_id, cache_command=None):
+    req = ChatRequest(
+        prompt=message,
+        session_id=session_id,
+        system_prompt=await read_system_prompt(session_id),
+        cache_command=cache_command,
+    )
+    async for chunk in google_request_stream(req):
+        yield chunk
+
+def perform_d100_check(success_rate: int, session_id=None) -> str:
     """
     Performs a D100 check, including rules for critical success and failure.
 
@@ -59,25 +59,12 @@ def perform_d100_check(success_rate: int) -> str:
 
     Args:
         success_rate: The probability of success (1-100).
+        session_id: Rolls use this session's RNG and are written to its roll log.
 
     Returns:
-        A JSON string containing the roll result, check status, and the success rate used.
+        A string describing the roll result, check status, and the success rate used.
     """
     if not 1 <= success_rate <= 100:
         return "Success rate must be between 1 and 100."
 
-    roll_result = random.randint(1, 100)
-    status = ""
-
-    # Priority check for critical success and failure
-    if roll_result == 1:
-        status = f"🎲擲骰大成功, 成功率:{success_rate}"
-    elif roll_result == 100:
-        status = f"🎲擲骰大失敗, 成功率:{success_rate}"
-    # Standard check if not a critical roll
-    elif roll_result <= success_rate:
-        status = f"🎲擲骰成功, 成功率:{success_rate}"
-    else:
-        status = f"🎲擲骰失敗, 成功率:{success_rate}"
-    
-    return status
\ No newline at end of file
+    return dice_engine.d100_checks([success_rate], session_id)[0]
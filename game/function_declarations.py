@@ -52,7 +52,52 @@ tools_declaration = [
                     },
                     "required": ["success_rate"]
                 }
+            },
+            {
+                "name": "apply_damage",
+                "description": "對戰鬥中的角色造成傷害並回傳剩餘血量或死亡狀態。當角色在敘事中確實受到傷害時呼叫。",
+                "parameters": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "target": {
+                            "type": "STRING",
+                            "description": "受到傷害的角色名稱，需與戰鬥中的角色名稱完全一致。"
+                        },
+                        "damage": {
+                            "type": "NUMBER",
+                            "description": "造成的傷害值（正整數）。"
+                        }
+                    },
+                    "required": ["target", "damage"]
+                }
+            },
+            {
+                "name": "roll_dice",
+                "description": "依標準骰子表示法擲骰並回傳每個算式的點數與總和。一次可以擲多個算式，例如一群 NPC 的攻擊或傷害骰。支援 3d6+2、4d6kh3 (取最高 3 顆)、adv / dis (2d20 取高 / 取低)、6d10>=8 (骰池，回傳達標顆數)。",
+                "parameters": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "expressions": {
+                            "type": "ARRAY",
+                            "items": {"type": "STRING"},
+                            "description": "要擲的骰子算式列表，同一批一次擲完。"
+                        }
+                    },
+                    "required": ["expressions"]
+                }
             }
         ]
     }
-]
\ No newline at end of file
+]
+
+# 啟用原生 function calling 時附加在 system prompt 之後，取代 ☆DICE☆ 文字標記的規則
+TOOL_MODE_INSTRUCTION = textwrap.dedent("""
+
+    【工具呼叫模式】
+    本環境已提供 perform_d100_check、apply_damage 與 roll_dice 工具，以下規則優先於前文的標記格式：
+    - 需要 D100 檢定時，直接呼叫 perform_d100_check(success_rate)，不要輸出「☆DICE:{success_rate}☆」。
+    - 角色受到傷害時，呼叫 apply_damage(target, damage)，不要輸出「☆Damage:{...}☆」。
+    - 需要其他骰子 (傷害骰、一群 NPC 的擲骰) 時，把所有算式放進同一次 roll_dice(expressions) 呼叫。
+    - 同一回合需要多個檢定或傷害時，可以在同一次回應中一併呼叫。
+    - 收到工具結果後再敘述後果。
+""")
\ No newline at end of file
@@ -1,49 +1,274 @@
-from game.func_tool import perform_d100_check, send_to_google_ai
+from game.func_tool import send_to_google_ai, send_to_google_ai_stream
+from game.dice import DiceError, dice_engine, parse as parse_dice
+from request.rate_limiter import PRIORITY_FOLLOW_UP
+from request.model_router import ROUTE_FOLLOW_UP
 import re
 import asyncio
-from typing import Dict, Set
+import time
+from typing import Dict, List, Optional, Tuple
 
 from game.fight_manager import fight_manager
+from game.outbox import outbox
+from game.session_manager import session_manager
+from game.stream_message import StreamingMessage
+from game.tool_registry import tool_registry
+from request.logger_setup import logger
+from request.memory import conversation_store
+from request.metrics import metrics, turn_trace
+from request.resilience import CircuitOpenError, DeadlineExceeded, deadline_scope
+from request.config import (
+    get_streaming_enabled,
+    get_stream_edit_interval,
+    get_session_queue_max,
+    get_session_queue_put_timeout,
+    get_session_worker_idle_seconds,
+    get_session_coalesce_enabled,
+    get_function_calling_enabled,
+    get_max_tool_rounds,
+    get_turn_deadline_seconds,
+    get_dice_prefetch_enabled,
+)
+
+
+# 玩家訊息經由 $R 進來；RESPONSE_CACHE_COMMANDS 含 R 時重複的提問直接回覆快取
+CACHE_COMMAND = "R"
+
+
+class CommandScanner:
+    """在串流文字中逐段偵測完整的 ☆FUNC:{args}☆ 指令
+
+    _pos 之前的文字都已處理過，每段只從 _pos 往後找，總成本與串流長度成正比。
+    """
+
+    def __init__(self, pattern: re.Pattern, prefix: re.Pattern):
+        self._pattern = pattern
+        # 尚未閉合但仍可能成為指令的開頭
+        self._prefix = prefix
+        self._buffer = ""
+        self._pos = 0
+        self._visible: List[str] = []
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+    def feed(self, chunk: str) -> List[Dict[str, str]]:
+        self._buffer += chunk
+        results = []
+        while True:
+            start = self._buffer.find("☆", self._pos)
+            if start < 0:
+                self._visible.append(self._buffer[self._pos:])
+                self._pos = len(self._buffer)
+                break
+            self._visible.append(self._buffer[self._pos:start])
+            self._pos = start
+            m = self._pattern.match(self._buffer, start)
+            if m:
+                results.append({"func": m.group(1), "args": m.group(2).strip()})
+                self._pos = m.end()
+            elif self._prefix.fullmatch(self._buffer, start):
+                # 等下一段文字再判斷
+                break
+            else:
+                # 不可能成為指令的 ☆ 照原文顯示
+                self._visible.append("☆")
+                self._pos = start + 1
+        return results
+
+    def visible_text(self) -> str:
+        # 已完成的指令移除，尚未閉合的 ☆... 先不顯示
+        if len(self._visible) > 1:
+            self._visible = ["".join(self._visible)]
+        return self._visible[0] if self._visible else ""
+
+class DiceRoll:
+    """一批 DICE 的擲骰結果；follow_up 是已經送出的結果敘述請求 (預取)"""
+
+    __slots__ = ("message", "errors", "follow_up")
+
+    def __init__(self, message: Optional[str], errors: List[str]) -> None:
+        self.message = message
+        self.errors = errors
+        self.follow_up: Optional[asyncio.Task] = None
+
 
 class GameCore:
     def __init__(self):
-        self._processing_sessions: Set[str] = set()
-        self._processing_lock = asyncio.Lock()
+        # 每個 session 一條 FIFO 佇列與一個 worker，彼此獨立，不需要全域鎖
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
     
     # 預編譯的指令樣式正則，避免每次呼叫重編譯
     COMMAND_PATTERN = re.compile(r"☆([A-Za-z_][A-Za-z0-9_]*)\:\{([^}]*)\}☆")
+    COMMAND_PREFIX_PATTERN = re.compile(r"☆(?:[A-Za-z_][A-Za-z0-9_]*(?::(?:\{[^}]*\}?)?)?)?")
         
     def enter_message(self, user_id, message):
-        print(f"user_id: {user_id}, message: {message}")
+        logger.info("user_id: %s, message: %s", user_id, message)
         
-    async def send_message(self, ctx, message, session_id = "fixed_003"):
-        # 如果同一個 session 正在處理，忽略新訊息
-        registered = await self._try_register_session(session_id)
-        if not registered:
-            print(f"session_id: {session_id} 正在處理中")
+    async def send_message(self, ctx, message, session_id: Optional[str] = None):
+        # 沒指定時由 guild/頻道 (或頻道綁定的戰役) 決定 session，不同桌各自一條佇列並行處理
+        if session_id is None:
+            session_id = await session_manager.session_id_for(ctx)
+        session_manager.touch(session_id, ctx)
+
+        # 排入該 session 的佇列，由專屬 worker 依序處理
+        queue = self._queues.get(session_id)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=get_session_queue_max())
+            self._queues[session_id] = queue
+            self._workers[session_id] = asyncio.create_task(self._session_worker(session_id, queue))
+
+        item = (ctx, message, time.perf_counter())
+        busy = not queue.empty()
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # 佇列已滿：在限定時間內等待空位，仍然滿就拒收
+            try:
+                await asyncio.wait_for(queue.put(item), timeout=get_session_queue_put_timeout())
+            except asyncio.TimeoutError:
+                logger.warning("session_id: %s 佇列已滿", session_id)
+                try:
+                    await ctx.message.add_reaction("🥹")
+                    await ctx.message.add_reaction("🕑")
+                except Exception:
+                    pass
+                return
+            busy = True
+
+        if busy:
             try:
-                await ctx.message.add_reaction("🥹")
                 await ctx.message.add_reaction("🕑")
             except Exception:
                 pass
-            return
+
+    async def _session_worker(self, session_id: str, queue: asyncio.Queue):
+        idle_timeout = get_session_worker_idle_seconds()
+        while True:
+            try:
+                ctx, message, enqueued_at = await asyncio.wait_for(queue.get(), timeout=idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    # 閒置太久就收掉 worker，下次有訊息再建立
+                    if self._queues.get(session_id) is queue:
+                        del self._queues[session_id]
+                        self._workers.pop(session_id, None)
+                    return
+                continue
+
+            messages = [message]
+            if get_session_coalesce_enabled():
+                # 把排隊中的多則玩家訊息合併成一次模型回合
+                while not queue.empty():
+                    ctx, queued_message, _ = queue.get_nowait()
+                    messages.append(queued_message)
+
+            # 時間預算從最早那則訊息進入佇列開始算，一路傳到 HTTP 呼叫
+            deadline = get_turn_deadline_seconds()
+            deadline_at = enqueued_at + deadline if deadline > 0 else None
+            with turn_trace(session_id), deadline_scope(at=deadline_at):
+                metrics.observe("stage_seconds", time.perf_counter() - enqueued_at, stage="queue_wait")
+                metrics.inc("coalesced_messages", len(messages) - 1)
+                try:
+                    await self._process_turn(ctx, "\n".join(messages), session_id)
+                except Exception as e:
+                    logger.exception("session worker 發生錯誤: %s", e)
+
+    async def _process_turn(self, ctx, message, session_id):
         try:
-            resp = await send_to_google_ai(message, session_id)
+            if get_function_calling_enabled():
+                await self._send_message_with_tools(ctx, message, session_id)
+                return
+
+            if get_streaming_enabled():
+                await self._send_message_streaming(ctx, message, session_id)
+                return
+
+            resp = await send_to_google_ai(message, session_id, cache_command=CACHE_COMMAND)
             text = resp.get("text") or ""
             
             command_results = self.parse_command_results(text)
             text = self.remove_command_text(text)
-            await ctx.send(f"{text}" or "ai say nothing")
+            # 模型回合已寫入歷史，先擲骰並送出結果敘述的請求，再公布這段敘述
+            roll = self._start_dice(command_results, session_id)
+            await outbox.send(ctx, f"{text}" or "ai say nothing")
 
             if command_results:
-                for cmd in command_results:
-                    await game_core.process_command(ctx, cmd["func"], cmd["args"])
+                await self.process_commands(ctx, command_results, session_id, roll)
+        except DeadlineExceeded:
+            logger.warning("session_id: %s 回合逾時", session_id)
+            await outbox.send(ctx, "模型回應逾時，請稍後再試一次")
+        except CircuitOpenError as e:
+            logger.warning("session_id: %s 斷路器開啟: %s", session_id, e)
+            await outbox.send(ctx, f"模型服務暫時不穩定，請約 {max(1, int(e.retry_in))} 秒後再試")
         except Exception as e:
-            print(f"send_message 發生錯誤: {e}")
-            await ctx.send(f"發生錯誤: {e}")
-        finally:
-            await self._unregister_session(session_id)
+            logger.exception("send_message 發生錯誤: %s", e)
+            await outbox.send(ctx, f"發生錯誤: {e}")
         
+    @staticmethod
+    def _round_limit_results(calls: List[Dict]) -> List[Dict]:
+        return [{"name": c["name"], "response": {"error": "tool round limit reached"}} for c in calls]
+
+    async def _send_message_with_tools(self, ctx, message, session_id):
+        # 原生 function calling：同一回應的所有呼叫並行執行，結果一次送回模型
+        resp = await send_to_google_ai(message, session_id, cache_command=CACHE_COMMAND)
+        max_rounds = get_max_tool_rounds()
+        rounds = 0
+        while resp.get("function_calls"):
+            calls = resp["function_calls"]
+            text = self.remove_command_text(resp.get("text") or "").strip()
+            if text:
+                await outbox.send(ctx, text)
+            if rounds > max_rounds:
+                # 回報上限後模型仍要求呼叫：直接補上錯誤回應讓歷史保持成對，不再送回模型
+                conversation_store.add_tool_responses(session_id, self._round_limit_results(calls))
+                if not text:
+                    await outbox.send(ctx, "ai say nothing")
+                return
+            if rounds < max_rounds:
+                results = await tool_registry.execute_all(ctx, calls, session_id)
+            else:
+                # 超過輪數上限仍要回覆每個呼叫，讓歷史保持成對
+                results = self._round_limit_results(calls)
+            rounds += 1
+            resp = await send_to_google_ai("", session_id, tool_responses=results)
+
+        text = resp.get("text") or ""
+        # 模型仍輸出文字標記時照舊處理
+        command_results = self.parse_command_results(text)
+        text = self.remove_command_text(text)
+        await outbox.send(ctx, f"{text}" or "ai say nothing")
+        await self.process_commands(ctx, command_results, session_id)
+
+    async def _send_message_streaming(self, ctx, message, session_id):
+        output = StreamingMessage(ctx, edit_interval=get_stream_edit_interval())
+        scanner = CommandScanner(self.COMMAND_PATTERN, self.COMMAND_PREFIX_PATTERN)
+        rolled: List[str] = []
+
+        async for chunk in send_to_google_ai_stream(message, session_id, cache_command=CACHE_COMMAND):
+            for cmd in scanner.feed(chunk):
+                if cmd["func"] == "DICE":
+                    # 指令一完整就擲骰公布；結果敘述的請求要等本回合寫入歷史後再送
+                    roll = self._roll_dice([cmd["args"]], session_id)
+                    await self._announce_dice(ctx, roll)
+                    if roll.message:
+                        rolled.append(roll.message)
+                else:
+                    await self.process_command(ctx, cmd["func"], cmd["args"], session_id)
+            await output.update(scanner.visible_text())
+
+        # 串流結束時回合已寫入歷史，結果敘述的請求與最後一次 edit 並行
+        roll = self._prefetch_follow_up(DiceRoll("\n".join(rolled), []), session_id) if rolled else None
+        text = self.remove_command_text(scanner.text)
+        if text.strip():
+            await output.finish(text)
+        elif not output.started:
+            await outbox.send(ctx, "ai say nothing")
+
+        if roll is not None:
+            await self._dice_follow_up(ctx, roll, session_id)
+
     def parse_command_result(self, text: str) -> Dict[str, str]:
         m = self.COMMAND_PATTERN.search(text)
         if m:
@@ -65,62 +290,134 @@ class GameCore:
     def remove_command_text(self, text: str) -> str:
         return self.COMMAND_PATTERN.sub("", text)
     
-    async def process_command(self, ctx, func, args):
-        print(f"func: {func}, args: {args}")
+    async def process_commands(self, ctx, commands: List[Dict[str, str]], session_id: str, roll: Optional[DiceRoll] = None):
+        # 同一回應裡的所有 Damage 與 DICE 各自一次批次處理，其餘指令依序執行；DICE 最先擲，結果最後公布
+        if roll is None:
+            roll = self._start_dice(commands, session_id)
+        damage_args = [cmd["args"] for cmd in commands if cmd["func"] == "Damage"]
+        if damage_args:
+            await self.damage_batch(ctx, damage_args, session_id)
+        for cmd in commands:
+            if cmd["func"] not in ("Damage", "DICE"):
+                await self.process_command(ctx, cmd["func"], cmd["args"], session_id)
+        if roll is not None:
+            await self._finish_dice(ctx, roll, session_id)
+
+    async def process_command(self, ctx, func, args, session_id: str):
+        logger.info("func: %s, args: %s", func, args)
         
         if func == "DICE":
-            await self.dice(ctx, args)
+            await self.dice(ctx, args, session_id)
         elif func == "Damage":
-            await self.damage(ctx, args)
+            await self.damage(ctx, args, session_id)
         else:
-            await ctx.send(f"發現擲骰指令，但未使用DICE")
+            await outbox.send(ctx, f"發現擲骰指令，但未使用DICE")
     
-    async def dice(self, ctx, args: str):
-        try:
-            rate = int(args)
-        except Exception:
-            print(f"DICE 指令錯誤, {args}")
-            await ctx.send(f"DICE 指令錯誤, {args}")
-            return
-        if not 1 <= rate <= 100:
-            print(f"DICE 參數需要1到100, {args}")
-            await ctx.send(f"DICE 參數需要1到100, {args}")
-            return
-        
-        dice_message = perform_d100_check(rate)
-        print(f"D100檢定結果: {dice_message}")
-        
-        await ctx.send(dice_message)
-            
-        resp = await send_to_google_ai(dice_message, "fixed_003")
-        
-        print(f"模型回傳: {resp}")
+    async def dice(self, ctx, args: str, session_id: str):
+        await self.dice_batch(ctx, [args], session_id)
+
+    async def dice_batch(self, ctx, args_list: List[str], session_id: str):
+        # 整組檢定一次擲完、一則訊息公布，再用一次模型請求敘述所有結果
+        await self._finish_dice(ctx, self._start_roll(args_list, session_id), session_id)
+
+    def _start_dice(self, commands: List[Dict[str, str]], session_id: str) -> Optional[DiceRoll]:
+        dice_args = [cmd["args"] for cmd in commands if cmd["func"] == "DICE"]
+        return self._start_roll(dice_args, session_id) if dice_args else None
+
+    def _start_roll(self, args_list: List[str], session_id: str) -> DiceRoll:
+        return self._prefetch_follow_up(self._roll_dice(args_list, session_id), session_id)
+
+    def _prefetch_follow_up(self, roll: DiceRoll, session_id: str) -> DiceRoll:
+        """開啟 DICE_PREFETCH 時馬上送出結果敘述的請求，不等公布訊息"""
+        if roll.message and get_dice_prefetch_enabled():
+            roll.follow_up = asyncio.create_task(self._request_follow_up(roll.message, session_id))
+            # 回合中途出錯沒有等到結果時，不要留下未取用的例外
+            roll.follow_up.add_done_callback(lambda task: task.cancelled() or task.exception())
+            metrics.inc("dice_prefetch")
+        return roll
+
+    async def _announce_dice(self, ctx, roll: DiceRoll):
+        for error in roll.errors:
+            await outbox.send(ctx, error)
+        if roll.message:
+            await outbox.send(ctx, roll.message)
+
+    async def _finish_dice(self, ctx, roll: DiceRoll, session_id: str):
+        await self._announce_dice(ctx, roll)
+        if roll.message:
+            await self._dice_follow_up(ctx, roll, session_id)
+
+    def _roll_dice(self, args_list: List[str], session_id: str) -> DiceRoll:
+        # 每個 DICE 參數可以是成功率 (D100 檢定)、骰子表示法 (3d6+2)，或以逗號分隔的多個
+        items = [part.strip() for args in args_list for part in args.split(",") if part.strip()]
+        rates: List[int] = []
+        notations: List[str] = []
+        order: List[Tuple[str, int]] = []
+        errors: List[str] = []
+        for item in items:
+            if item.isdigit():
+                rate = int(item)
+                if not 1 <= rate <= 100:
+                    errors.append(f"DICE 參數需要1到100, {item}")
+                    continue
+                order.append(("d100", len(rates)))
+                rates.append(rate)
+            else:
+                try:
+                    parse_dice(item)
+                except DiceError as e:
+                    errors.append(f"DICE 指令錯誤, {e}")
+                    continue
+                order.append(("roll", len(notations)))
+                notations.append(item)
+
+        for error in errors:
+            logger.warning(error)
+        if not order:
+            return DiceRoll(None, errors)
+
+        checks = dice_engine.d100_checks(rates, session_id) if rates else []
+        rolls = dice_engine.roll_many(notations, session_id) if notations else []
+        dice_message = "\n".join(checks[i] if kind == "d100" else rolls[i].describe() for kind, i in order)
+        logger.info("擲骰結果: %s", dice_message)
+        return DiceRoll(dice_message, errors)
+
+    async def _request_follow_up(self, dice_message: str, session_id: str):
+        return await send_to_google_ai(dice_message, session_id, priority=PRIORITY_FOLLOW_UP, route=ROUTE_FOLLOW_UP)
+
+    async def _dice_follow_up(self, ctx, roll: DiceRoll, session_id: str):
+        if roll.follow_up is not None:
+            resp = await roll.follow_up
+        else:
+            resp = await self._request_follow_up(roll.message, session_id)
+
+        logger.debug("模型回傳", extra={"payload": resp})
         
         text = resp.get("text") or ""
-        await ctx.send(f"{text}" or "ai say nothing")
-            
-    async def damage(self, ctx, args: str):
-        target, damage = args.split(",")
-        result = fight_manager.damage(target, int(damage))
-        
-        if result["status"] == "dead":
-            print(result["result"])
-            await ctx.send(result["result"])
-            #給模型結束請求做收尾
-        elif result["status"] == "damage":
-            print(result["result"])
-        else:
-            print(f"發現傷害指令，但Damage指令錯誤, {result['result']}")
+        await outbox.send(ctx, f"{text}" or "ai say nothing")
             
-    async def _try_register_session(self, session_id: str) -> bool:
-        async with self._processing_lock:
-            if session_id in self._processing_sessions:
-                return False
-            self._processing_sessions.add(session_id)
-            return True
-
-    async def _unregister_session(self, session_id: str) -> None:
-        async with self._processing_lock:
-            self._processing_sessions.discard(session_id)
+    async def damage(self, ctx, args: str, session_id: str):
+        await self.damage_batch(ctx, [args], session_id)
+
+    async def damage_batch(self, ctx, args_list: List[str], session_id: str):
+        hits = []
+        for args in args_list:
+            try:
+                target, damage = args.split(",")
+                hits.append((target.strip(), int(damage)))
+            except ValueError:
+                logger.warning("發現傷害指令，但Damage指令錯誤, %s", args)
+        if not hits:
+            return
+
+        for result in await fight_manager.apply_damage_batch(hits, scope=session_id):
+            if result["status"] == "dead":
+                logger.info(result["result"])
+                await outbox.send(ctx, result["result"])
+                #給模型結束請求做收尾
+            elif result["status"] == "damage":
+                logger.info(result["result"])
+            else:
+                logger.warning("發現傷害指令，但Damage指令錯誤, %s", result["result"])
             
 game_core = GameCore()
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""送往 Discord 的訊息管線
+
+長文依段落、換行、句尾的順序切成不超過 2000 字的訊息；同一頻道排隊中的小訊息合併成一則；
+每個頻道一個背景 worker 依頻道與全域的速率額度送出，呼叫端只排入佇列，不用等送出完成就能接著發下一次模型請求。
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+from request.config import (
+    get_outbox_enabled,
+    get_outbox_linger_seconds,
+    get_outbox_channel_limit,
+    get_outbox_global_per_second,
+)
+from request.logger_setup import logger
+from request.metrics import metrics
+
+DISCORD_MESSAGE_LIMIT = 2000
+MERGE_SEPARATOR = "\n\n"
+# 記錄的頻道數超過這個值時清掉閒置的頻道
+MAX_IDLE_CHANNELS = 1024
+_FENCE = "```"
+# 依序嘗試的切點；切點太靠前 (不到一半) 時改用下一種，避免切出很短的訊息
+_BREAKS = ("\n\n", "\n", "。", "！", "？", ". ", "! ", "? ", "，", ", ", " ")
+
+
+def _find_cut(window: str) -> int:
+    for sep in _BREAKS:
+        index = window.rfind(sep)
+        if index >= len(window) // 2:
+            return index + len(sep)
+    return len(window)
+
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> List[str]:
+    """切成不超過 limit 字的多則訊息；切在程式碼區塊中間時兩邊各補上 ``` 維持格式"""
+    chunks: List[str] = []
+    rest = text
+    # 預留補上 ``` 的空間
+    reserve = len(_FENCE) + 1
+    while len(rest) > limit:
+        cut = _find_cut(rest[:limit - reserve])
+        chunk, rest = rest[:cut].rstrip(), rest[cut:].lstrip("\n")
+        if chunk.count(_FENCE) % 2:
+            chunk += "\n" + _FENCE
+            rest = _FENCE + "\n" + rest
+        if chunk.strip():
+            chunks.append(chunk)
+    if rest.strip():
+        chunks.append(rest)
+    return chunks
+
+
+def coalesce(texts: Iterable[str], limit: int = DISCORD_MESSAGE_LIMIT) -> List[str]:
+    """連續的小訊息以空行接成一則，不超過 limit；本身超長的先切開"""
+    merged: List[str] = []
+    for text in texts:
+        for piece in split_message(text, limit):
+            if merged and len(merged[-1]) + len(MERGE_SEPARATOR) + len(piece) <= limit:
+                merged[-1] += MERGE_SEPARATOR + piece
+            else:
+                merged.append(piece)
+    return merged
+
+
+class _Window:
+    """滑動視窗計數：window 秒內最多 capacity 次"""
+
+    __slots__ = ("capacity", "window", "sent")
+
+    def __init__(self, capacity: int, window: float) -> None:
+        self.capacity = capacity
+        self.window = window
+        self.sent: Deque[float] = deque()
+
+    def delay(self, now: float) -> float:
+        while self.sent and now - self.sent[0] >= self.window:
+            self.sent.popleft()
+        if len(self.sent) < self.capacity:
+            return 0.0
+        return self.sent[0] + self.window - now
+
+    def record(self, now: float) -> None:
+        self.sent.append(now)
+
+
+class _Item:
+    __slots__ = ("ctx", "text", "future")
+
+    def __init__(self, ctx, text: str, future: Optional[asyncio.Future]) -> None:
+        self.ctx = ctx
+        self.text = text
+        self.future = future
+
+
+class _Channel:
+    __slots__ = ("items", "window", "worker", "idle")
+
+    def __init__(self, window: _Window) -> None:
+        self.items: List[_Item] = []
+        self.window = window
+        self.worker: Optional[asyncio.Task] = None
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+
+def _channel_key(ctx) -> Any:
+    channel = getattr(ctx, "channel", None)
+    return getattr(channel, "id", None) or id(ctx)
+
+
+class Outbox:
+    def __init__(self, enabled: bool, linger: float, channel_messages: int, channel_window: float, global_per_second: int) -> None:
+        self._enabled = enabled
+        self._linger = linger
+        self._channel_messages = channel_messages
+        self._channel_window = channel_window
+        self._global = _Window(global_per_second, 1.0)
+        self._channels: Dict[Any, _Channel] = {}
+
+    async def send(self, ctx, text: str, wait: bool = False):
+        """排入頻道的佇列；wait=True 時等到送出並回傳訊息物件 (之後要 edit 的訊息用)，這種訊息不和別的合併
+
+        wait=False 時立刻返回，送出失敗只記 log。
+        """
+        if not text or not text.strip():
+            return None
+        if not self._enabled:
+            message = None
+            for chunk in split_message(text):
+                with metrics.stage("discord_send"):
+                    message = await ctx.send(chunk)
+            return message
+
+        key = _channel_key(ctx)
+        channel = self._channels.get(key)
+        if channel is None:
+            if len(self._channels) >= MAX_IDLE_CHANNELS:
+                self._prune(time.monotonic())
+            channel = self._channels[key] = _Channel(_Window(self._channel_messages, self._channel_window))
+        future = asyncio.get_running_loop().create_future() if wait else None
+        channel.items.append(_Item(ctx, text, future))
+        channel.idle.clear()
+        if channel.worker is None:
+            # worker 不繼承呼叫端的 contextvars，否則 discord_send 會一直記在第一個回合的 trace 上
+            channel.worker = contextvars.Context().run(asyncio.create_task, self._run(key, channel))
+        if future is not None:
+            return await future
+        return None
+
+    def _prune(self, now: float) -> None:
+        # 頻道的速率視窗要在 worker 閒置後繼續保留，只清掉視窗已經過期的閒置頻道
+        for key, channel in list(self._channels.items()):
+            channel.window.delay(now)
+            if channel.worker is None and not channel.window.sent:
+                del self._channels[key]
+
+    async def drain(self, ctx=None) -> None:
+        """等到指定頻道 (或所有頻道) 的訊息都送出"""
+        channels = [self._channels.get(_channel_key(ctx))] if ctx is not None else list(self._channels.values())
+        for channel in channels:
+            if channel is not None:
+                await channel.idle.wait()
+
+    async def _run(self, key: Any, channel: _Channel) -> None:
+        try:
+            while channel.items:
+                if self._linger:
+                    await asyncio.sleep(self._linger)
+                batch, channel.items = channel.items, []
+                await self._deliver(key, channel, batch)
+        finally:
+            channel.worker = None
+            channel.idle.set()
+
+    async def _deliver(self, key: Any, channel: _Channel, batch: List[_Item]) -> None:
+        merged: List[_Item] = []
+        for item in batch:
+            if item.future is None:
+                merged.append(item)
+                continue
+            # 要回傳訊息物件的項目單獨送出，先把前面累積的送掉以維持順序
+            await self._send_merged(key, channel, merged)
+            merged = []
+            try:
+                message = None
+                for chunk in split_message(item.text):
+                    message = await self._send(channel, item.ctx, chunk)
+                item.future.set_result(message)
+            except Exception as exc:
+                item.future.set_exception(exc)
+        await self._send_merged(key, channel, merged)
+
+    async def _send_merged(self, key: Any, channel: _Channel, items: List[_Item]) -> None:
+        if not items:
+            return
+        chunks = coalesce(item.text for item in items)
+        if len(chunks) < len(items):
+            metrics.inc("discord_coalesced", len(items) - len(chunks))
+        for chunk in chunks:
+            try:
+                await self._send(channel, items[0].ctx, chunk)
+            except Exception as exc:
+                metrics.inc("discord_send_errors")
+                logger.warning("Discord send to channel %s failed: %s", key, exc)
+
+    async def _send(self, channel: _Channel, ctx, text: str):
+        while True:
+            now = time.monotonic()
+            delay = max(channel.window.delay(now), self._global.delay(now))
+            if delay <= 0:
+                break
+            # 等待額度的期間新進的訊息會在下一批合併
+            metrics.inc("discord_throttled")
+            await asyncio.sleep(delay)
+        channel.window.record(now)
+        self._global.record(now)
+        with metrics.stage("discord_send"):
+            return await ctx.send(text)
+
+    async def close(self) -> None:
+        """送完所有排隊中的訊息"""
+        await self.drain()
+
+
+outbox = Outbox(
+    get_outbox_enabled(),
+    get_outbox_linger_seconds(),
+    *get_outbox_channel_limit(),
+    get_outbox_global_per_second(),
+)
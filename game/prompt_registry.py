@@ -0,0 +1,177 @@
+import asyncio
+import os
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from threading import RLock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from request.config import get_prompt_reload_interval
+from request.logger_setup import logger
+from request.state_store import StateStore, state_store
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_PROMPT_NAME = "default"
+_PROMPT_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+@dataclass
+class _PromptEntry:
+    path: Path
+    mtime: Optional[float]
+    content: str
+
+
+def _resolve_path(name: str) -> Path:
+    """default 依序取 `SYSTEM_PROMPT_PATH` 或 `prompt/description.txt`，其餘名稱對應 `prompt/<name>.txt`"""
+    if name == DEFAULT_PROMPT_NAME:
+        env_path = os.getenv("SYSTEM_PROMPT_PATH")
+        if env_path:
+            candidate_path = Path(env_path)
+            if not candidate_path.is_absolute():
+                candidate_path = PROJECT_ROOT / candidate_path
+            return candidate_path
+        return PROJECT_ROOT / "prompt" / "description.txt"
+    return PROJECT_ROOT / "prompt" / f"{name}.txt"
+
+
+def _load(path: Path) -> _PromptEntry:
+    try:
+        mtime = path.stat().st_mtime
+        content = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        logger.error("System prompt file not found: %s", path)
+        return _PromptEntry(path=path, mtime=None, content="")
+    except Exception as exc:
+        logger.exception("Failed to read system prompt %s: %s", path, exc)
+        return _PromptEntry(path=path, mtime=None, content="")
+
+    if not content.strip():
+        logger.warning("System prompt file is empty: %s", path)
+    else:
+        logger.info("Loaded system prompt from: %s", path)
+    return _PromptEntry(path=path, mtime=mtime, content=content)
+
+
+# (session_id, prompt 名稱)
+ChangeHandler = Callable[[str, str], None]
+
+
+class PromptRegistry:
+    """具名 system prompt 的記憶體快取；背景依 mtime 重新載入，請求路徑上不碰磁碟
+
+    每個 session 選用的 prompt 名稱存在 StateStore，跟頻道綁定一樣多行程共用；
+    共用 store 時讀過的名稱快取 PROMPT_RELOAD_INTERVAL_SECONDS，其他行程的變更與改檔一樣最多延遲這麼久生效。
+    """
+
+    def __init__(self, store: StateStore) -> None:
+        self._store = store
+        self._entries: Dict[str, _PromptEntry] = {}
+        # session -> (prompt 名稱, 讀取時間)
+        self._session_prompts: Dict[str, Tuple[str, float]] = {}
+        self._lock = RLock()
+        self._watcher: Optional[asyncio.Task] = None
+        self._change_handler: Optional[ChangeHandler] = None
+
+    def set_change_handler(self, handler: Optional[ChangeHandler]) -> None:
+        self._change_handler = handler
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"session_prompt:{session_id}"
+
+    def get(self, name: str = DEFAULT_PROMPT_NAME) -> str:
+        entry = self._entries.get(name)
+        if entry is None:
+            # 只有第一次用到尚未預載的 prompt 才會讀檔
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is None:
+                    entry = _load(_resolve_path(name))
+                    self._entries[name] = entry
+        return entry.content
+
+    async def get_for_session(self, session_id: Optional[str]) -> str:
+        name = await self.session_prompt_name(session_id) if session_id else DEFAULT_PROMPT_NAME
+        return self.get(name)
+
+    async def assign(self, session_id: str, name: str) -> bool:
+        """指定某個 session (頻道/戰役) 使用的 prompt，名稱不合法或檔案不存在時回傳 False"""
+        if name == DEFAULT_PROMPT_NAME:
+            await self._store.adelete(self._key(session_id))
+        else:
+            # 名稱直接對應到 prompt/<name>.txt，不接受路徑字元
+            if not _PROMPT_NAME.match(name) or not _resolve_path(name).is_file() or not self.get(name):
+                return False
+            await self._store.aset(self._key(session_id), name)
+        self._cache(session_id, name)
+        if self._change_handler is not None:
+            self._change_handler(session_id, name)
+        return True
+
+    def available(self) -> List[str]:
+        return sorted(path.stem for path in (PROJECT_ROOT / "prompt").glob("*.txt") if _PROMPT_NAME.match(path.stem))
+
+    async def session_prompt_name(self, session_id: str) -> str:
+        if not self._store.shared:
+            # 純記憶體 store 本身就是 dict，不另外快取
+            return self._store.get(self._key(session_id)) or DEFAULT_PROMPT_NAME
+        cached = self._session_prompts.get(session_id)
+        if cached is not None and time.monotonic() - cached[1] < get_prompt_reload_interval():
+            return cached[0]
+        name = await self._store.aget(self._key(session_id)) or DEFAULT_PROMPT_NAME
+        self._cache(session_id, name)
+        return name
+
+    def _cache(self, session_id: str, name: str) -> None:
+        if self._store.shared and get_prompt_reload_interval() > 0:
+            self._session_prompts[session_id] = (name, time.monotonic())
+
+    def _prune_sessions(self) -> None:
+        cutoff = time.monotonic() - get_prompt_reload_interval()
+        for session_id in [sid for sid, (_, read_at) in self._session_prompts.items() if read_at < cutoff]:
+            del self._session_prompts[session_id]
+
+    def reload_changed(self) -> None:
+        with self._lock:
+            items = list(self._entries.items())
+        for name, entry in items:
+            path = _resolve_path(name)
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if path != entry.path or mtime != entry.mtime:
+                new_entry = _load(path)
+                with self._lock:
+                    self._entries[name] = new_entry
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self.get, DEFAULT_PROMPT_NAME)
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self) -> None:
+        interval = get_prompt_reload_interval()
+        if interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            self._prune_sessions()
+            try:
+                await asyncio.to_thread(self.reload_changed)
+            except Exception as exc:
+                logger.warning("Prompt reload failed: %s", exc)
+
+    async def close(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+
+
+prompt_registry = PromptRegistry(state_store)
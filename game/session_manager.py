@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import time
+from typing import Dict, List, Optional
+
+from request.config import get_campaign_idle_seconds
+from request.state_store import StateStore, state_store
+
+# 沒有 guild 的私訊頻道用這個代替 guild id
+DM_SCOPE = "dm"
+# 多久掃一次閒置的戰役
+SWEEP_INTERVAL_SECONDS = 60.0
+
+
+class Campaign:
+    """一個進行中的戰役 (一張桌)：對應一個 session id，同一時間只有一個 worker 處理它的回合"""
+
+    __slots__ = ("session_id", "guild_id", "channel_id", "created_at", "last_active", "messages")
+
+    def __init__(self, session_id: str, guild_id: Optional[int], channel_id: Optional[int]) -> None:
+        self.session_id = session_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.created_at = time.monotonic()
+        self.last_active = self.created_at
+        self.messages = 0
+
+
+class SessionManager:
+    """由 guild/頻道 (或頻道綁定的戰役 id) 決定 session，並索引、淘汰閒置的戰役
+
+    頻道綁定存在 StateStore，多行程共用同一個 store 時每個行程看到的綁定一致；
+    讀過的綁定快取在記憶體，store 的讀寫都走 async 版本，不卡 event loop。
+    """
+
+    def __init__(self, store: StateStore) -> None:
+        self._store = store
+        self._campaigns: Dict[str, Campaign] = {}
+        # 頻道 -> 綁定的戰役 id (None 代表沒綁定，用頻道本身當 session)
+        self._bindings: Dict[str, Optional[str]] = {}
+        self._last_sweep = time.monotonic()
+
+    @staticmethod
+    def channel_key(ctx) -> str:
+        guild = getattr(ctx, "guild", None)
+        channel = getattr(ctx, "channel", None)
+        guild_part = str(guild.id) if guild is not None else DM_SCOPE
+        channel_part = str(channel.id) if channel is not None else str(ctx.author.id)
+        return f"{guild_part}:{channel_part}"
+
+    async def _binding(self, channel_key: str) -> Optional[str]:
+        if channel_key not in self._bindings:
+            self._bindings[channel_key] = await self._store.aget(f"campaign_binding:{channel_key}")
+        return self._bindings[channel_key]
+
+    @staticmethod
+    def _session_id(channel_key: str, campaign_id: Optional[str]) -> str:
+        if campaign_id:
+            return f"campaign:{campaign_id}"
+        return f"channel:{channel_key}"
+
+    async def session_id_for(self, ctx) -> str:
+        """這則訊息所屬的 session；頻道綁定戰役時多個頻道可以共用同一個 session"""
+        channel_key = self.channel_key(ctx)
+        return self._session_id(channel_key, await self._binding(channel_key))
+
+    async def bind(self, ctx, campaign_id: str) -> str:
+        """把 ctx 所在頻道綁到指定戰役，回傳新的 session id"""
+        channel_key = self.channel_key(ctx)
+        await self._store.aset(f"campaign_binding:{channel_key}", campaign_id)
+        self._bindings[channel_key] = campaign_id
+        return self._session_id(channel_key, campaign_id)
+
+    async def unbind(self, ctx) -> str:
+        channel_key = self.channel_key(ctx)
+        await self._store.adelete(f"campaign_binding:{channel_key}")
+        self._bindings[channel_key] = None
+        return self._session_id(channel_key, None)
+
+    def touch(self, session_id: str, ctx=None) -> Campaign:
+        """記錄戰役有新的活動，不存在時建立並加入索引"""
+        campaign = self._campaigns.get(session_id)
+        if campaign is None:
+            guild = getattr(ctx, "guild", None)
+            channel = getattr(ctx, "channel", None)
+            campaign = Campaign(
+                session_id,
+                guild.id if guild is not None else None,
+                channel.id if channel is not None else None,
+            )
+            self._campaigns[session_id] = campaign
+        campaign.last_active = time.monotonic()
+        campaign.messages += 1
+        self._maybe_sweep(campaign.last_active)
+        return campaign
+
+    def get(self, session_id: str) -> Optional[Campaign]:
+        return self._campaigns.get(session_id)
+
+    def active(self) -> List[Campaign]:
+        return sorted(self._campaigns.values(), key=lambda c: c.last_active, reverse=True)
+
+    def _maybe_sweep(self, now: float) -> None:
+        if now - self._last_sweep >= SWEEP_INTERVAL_SECONDS:
+            self._last_sweep = now
+            self.evict_idle(now)
+
+    def evict_idle(self, now: Optional[float] = None) -> List[str]:
+        """移除閒置超過 CAMPAIGN_IDLE_SECONDS 的戰役索引，回傳被移除的 session id"""
+        now = time.monotonic() if now is None else now
+        idle = get_campaign_idle_seconds()
+        evicted = [sid for sid, c in self._campaigns.items() if now - c.last_active > idle]
+        for session_id in evicted:
+            del self._campaigns[session_id]
+        if evicted:
+            # 綁定快取也一併清掉，下次需要時再從 store 讀
+            self._bindings.clear()
+        return evicted
+
+
+session_manager = SessionManager(state_store)
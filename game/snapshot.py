@@ -0,0 +1,484 @@
+"""戰役快照：把一個 session 的回合、摘要與戰鬥狀態存成 gzip 壓縮的 JSON Lines
+
+每行一筆紀錄:
+    {"type": "header", "format": "trpg-snapshot", "version": 1, "session": ..., "kind": "full" | "delta", "created": ...}
+    {"type": "turn", "turn": {...}}
+    {"type": "summary", "text": ...}
+    {"type": "fight", "data": {...} | null}
+    {"type": "prompt", "name": ...}
+
+每一段以 header 開頭、各自是一個 gzip member，所以增量可以直接接在檔尾；讀取時依序套用，
+後面的摘要、戰鬥狀態與 prompt 覆蓋前面的。匯出與匯入都逐行處理，不需要把整份歷史載入記憶體；
+store 與戰鬥狀態只在 event loop 上讀寫，壓縮、解壓與檔案 I/O 才丟到執行緒。
+"""
+from __future__ import annotations
+
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from game.fight_manager import fight_manager
+from game.prompt_registry import DEFAULT_PROMPT_NAME, prompt_registry
+from request.config import (
+    get_checkpoint_dir,
+    get_checkpoint_interval,
+    get_checkpoint_compact_segments,
+    get_checkpoint_restore,
+)
+from request.logger_setup import logger
+from request.memory import conversation_store
+from request.metrics import metrics
+
+FORMAT = "trpg-snapshot"
+VERSION = 1
+KIND_FULL = "full"
+KIND_DELTA = "delta"
+# 匯入時每累積這麼多回合寫進 store 一次
+RESTORE_BATCH = 256
+
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class SnapshotError(ValueError):
+    """不是快照檔、內容損毀或版本不支援"""
+
+
+@dataclass
+class SnapshotInfo:
+    session_id: str
+    turns: int = 0
+    summary: bool = False
+    fight: bool = False
+    prompt: str = DEFAULT_PROMPT_NAME
+    segments: int = 0
+
+
+def snapshot_filename(session_id: str) -> str:
+    # session id 含有 ':' '|' 等字元，換掉後再加上雜湊避免不同 session 撞名
+    digest = hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:8]
+    return f"{_SAFE_NAME.sub('_', session_id)[:80]}-{digest}.snap.gz"
+
+
+def _header(session_id: str, kind: str) -> Dict[str, Any]:
+    return {
+        "type": "header",
+        "format": FORMAT,
+        "version": VERSION,
+        "session": session_id,
+        "kind": kind,
+        "created": round(time.time(), 3),
+    }
+
+
+def write_records(fileobj: IO[bytes], records: Iterable[Dict[str, Any]]) -> int:
+    """寫成一個 gzip member；fileobj 以追加模式開啟時就是在檔尾接上一段"""
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=6) as gz:
+        for record in records:
+            gz.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+            count += 1
+    return count
+
+
+def iter_records(fileobj: IO[bytes]) -> Iterator[Dict[str, Any]]:
+    """逐筆讀出所有段的紀錄；最後一段寫到一半 (例如當機) 時保留前面完整的部分"""
+    first = True
+    try:
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as gz:
+            for raw in gz:
+                if not raw.strip():
+                    continue
+                try:
+                    record = json.loads(raw)
+                except ValueError as exc:
+                    raise SnapshotError(f"快照內容損毀: {exc}") from exc
+                if record.get("type") == "header":
+                    if record.get("format") != FORMAT:
+                        raise SnapshotError("不是戰役快照檔")
+                    if int(record.get("version") or 0) > VERSION:
+                        raise SnapshotError(f"不支援的快照版本: {record.get('version')}")
+                elif first:
+                    raise SnapshotError("快照缺少 header")
+                first = False
+                yield record
+    except EOFError:
+        if first:
+            raise SnapshotError("快照檔是空的或不完整")
+        logger.warning("Snapshot ends with a truncated segment, ignoring the rest")
+    except OSError as exc:
+        raise SnapshotError(f"快照檔無法讀取: {exc}") from exc
+
+
+def session_records(
+    session_id: str,
+    turns: Iterable[Dict[str, Any]],
+    summary: str,
+    fight: Optional[Dict[str, Any]],
+    prompt: str = DEFAULT_PROMPT_NAME,
+) -> Iterator[Dict[str, Any]]:
+    yield _header(session_id, KIND_FULL)
+    for turn in turns:
+        yield {"type": "turn", "turn": turn}
+    if summary:
+        yield {"type": "summary", "text": summary}
+    if fight is not None:
+        yield {"type": "fight", "data": fight}
+    if prompt != DEFAULT_PROMPT_NAME:
+        yield {"type": "prompt", "name": prompt}
+
+
+async def _capture(session_id: str) -> Tuple[Iterator[Dict[str, Any]], str, Optional[Dict[str, Any]], str]:
+    """在 event loop 上取出 session 的狀態；回合由 backend 逐頁讀出，要在執行緒裡消費"""
+    await conversation_store.preload(session_id)
+    fight = await fight_manager.export(session_id)
+    prompt = await prompt_registry.session_prompt_name(session_id)
+    return (
+        conversation_store.export_turns(session_id),
+        conversation_store.get_summary(session_id),
+        fight,
+        prompt,
+    )
+
+
+async def export_session(session_id: str, fileobj: IO[bytes]) -> int:
+    """把 session 寫成一份完整快照，回傳紀錄筆數；壓縮與寫檔在執行緒裡做"""
+    records = session_records(session_id, *await _capture(session_id))
+    return await asyncio.to_thread(write_records, fileobj, records)
+
+
+def _read_batch(records: Iterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return list(itertools.islice(records, RESTORE_BATCH))
+
+
+async def import_session(fileobj: IO[bytes], session_id: Optional[str] = None, checkpoint: bool = True) -> SnapshotInfo:
+    """逐段套用快照，取代 session 原有的歷史、摘要、戰鬥狀態與 prompt
+
+    解壓與解析在執行緒裡每次讀一批，狀態的更新都在 event loop 上。
+    session_id 有指定時匯入到該 session (例如把戰役搬到另一個頻道)，否則使用快照裡的 session。
+    """
+    info: Optional[SnapshotInfo] = None
+    batch: List[Dict[str, Any]] = []
+    summary: Optional[str] = None
+    fight: Optional[Dict[str, Any]] = None
+    prompt = DEFAULT_PROMPT_NAME
+    records = iter_records(fileobj)
+    while True:
+        chunk = await asyncio.to_thread(_read_batch, records)
+        if not chunk:
+            break
+        for record in chunk:
+            kind = record.get("type")
+            if kind == "header":
+                if info is None:
+                    info = SnapshotInfo(session_id or record.get("session") or "")
+                    if not info.session_id:
+                        raise SnapshotError("快照沒有 session id")
+                info.segments += 1
+                if info.segments == 1 or record.get("kind") == KIND_FULL:
+                    # 完整快照從頭開始
+                    batch.clear()
+                    info.turns = conversation_store.restore(info.session_id, (), replace=True)
+                    summary = None
+                    fight = None
+                    prompt = DEFAULT_PROMPT_NAME
+            elif kind == "turn":
+                batch.append(record["turn"])
+            elif kind == "summary":
+                summary = record.get("text") or ""
+            elif kind == "fight":
+                fight = record.get("data")
+            elif kind == "prompt":
+                prompt = record.get("name") or DEFAULT_PROMPT_NAME
+        if batch:
+            info.turns += conversation_store.restore(info.session_id, batch)
+            batch = []
+
+    if info is None:
+        raise SnapshotError("快照檔是空的")
+    if summary:
+        conversation_store.set_summary(info.session_id, summary)
+    await fight_manager.restore(info.session_id, fight)
+    if not await prompt_registry.assign(info.session_id, prompt):
+        # 這邊沒有快照用的 prompt 檔時改用預設
+        logger.warning("Snapshot prompt %s not found, using default for %s", prompt, info.session_id)
+        await prompt_registry.assign(info.session_id, DEFAULT_PROMPT_NAME)
+        prompt = DEFAULT_PROMPT_NAME
+    info.summary = bool(summary)
+    info.fight = bool(fight)
+    info.prompt = prompt
+    if checkpoint and checkpointer.enabled:
+        await checkpointer.rewrite(info.session_id)
+    return info
+
+
+class _Pending:
+    __slots__ = ("turns", "summary", "prompt", "reset")
+
+    def __init__(self) -> None:
+        self.turns: List[Dict[str, Any]] = []
+        self.summary: Optional[str] = None
+        self.prompt: Optional[str] = None
+        self.reset = False
+
+
+class Checkpointer:
+    """定期把有變動的 session 以增量寫進各自的 checkpoint 檔
+
+    ConversationStore 每次寫入、PromptRegistry 每次換 prompt 都通知這裡，只記下新的回合、摘要與 prompt；每隔 CHECKPOINT_INTERVAL_SECONDS
+    把累積的變動接在檔尾成為新的一段，不重寫整份。段數超過 CHECKPOINT_COMPACT_SEGMENTS 時合併成一份完整快照。
+    """
+
+    def __init__(self, directory: str, interval: float, compact_segments: int) -> None:
+        self._dir = Path(directory)
+        self._interval = interval
+        self._compact_segments = compact_segments
+        self._lock = threading.Lock()
+        # 同一個檔只會有一個執行緒在寫
+        self._io_lock = threading.Lock()
+        self._pending: Dict[str, _Pending] = {}
+        self._segments: Dict[str, int] = {}
+        self._fight_versions: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._interval > 0
+
+    def path_for(self, session_id: str) -> Path:
+        return self._dir / snapshot_filename(session_id)
+
+    def on_change(self, session_id: str, kind: str, payload: Any) -> None:
+        # 由 ConversationStore 與 PromptRegistry 同步呼叫，只記錄不寫檔
+        with self._lock:
+            pending = self._pending.get(session_id)
+            if pending is None:
+                pending = self._pending[session_id] = _Pending()
+            if kind == "turn":
+                pending.turns.append(payload.to_dict())
+            elif kind == "summary":
+                pending.summary = payload
+            elif kind == "prompt":
+                pending.prompt = payload
+            elif kind == "clear":
+                pending.turns.clear()
+                pending.summary = None
+                pending.reset = True
+
+    def _on_prompt(self, session_id: str, name: str) -> None:
+        self.on_change(session_id, "prompt", name)
+
+    def _collect(self) -> Tuple[Dict[str, _Pending], Dict[str, Optional[Dict[str, Any]]]]:
+        """在 event loop 上取走累積的變動，戰鬥狀態只帶版本號有變的"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        fights: Dict[str, Optional[Dict[str, Any]]] = {}
+        loaded = fight_manager.loaded()
+        for scope, encounter in loaded.items():
+            if self._fight_versions.get(scope) != encounter.version:
+                self._fight_versions[scope] = encounter.version
+                fights[scope] = encounter.to_dict() if encounter.characters else None
+        for scope in [scope for scope in self._fight_versions if scope not in loaded]:
+            del self._fight_versions[scope]
+            fights[scope] = None
+        return pending, fights
+
+    def _requeue(self, session_id: str, change: _Pending) -> None:
+        # 寫入失敗的變動放回去，接在之後的變動前面
+        with self._lock:
+            newer = self._pending.get(session_id)
+            if newer is not None:
+                if newer.reset:
+                    return
+                change.turns.extend(newer.turns)
+                if newer.summary is not None:
+                    change.summary = newer.summary
+                if newer.prompt is not None:
+                    change.prompt = newer.prompt
+            self._pending[session_id] = change
+
+    def _write(self, pending: Dict[str, _Pending], fights: Dict[str, Optional[Dict[str, Any]]]) -> Tuple[int, List[str]]:
+        """在執行緒裡寫檔，只碰檔案與 _io_lock 保護的段數；回傳 (寫入的段數, 寫入失敗的 session)"""
+        self._dir.mkdir(parents=True, exist_ok=True)
+        written = 0
+        failed: List[str] = []
+        for session_id in set(pending) | set(fights):
+            change = pending.get(session_id) or _Pending()
+            records: List[Dict[str, Any]] = [{"type": "turn", "turn": turn} for turn in change.turns]
+            if change.summary is not None:
+                records.append({"type": "summary", "text": change.summary})
+            if session_id in fights:
+                records.append({"type": "fight", "data": fights[session_id]})
+            if change.prompt is not None:
+                records.append({"type": "prompt", "name": change.prompt})
+            if not records and not change.reset:
+                continue
+            try:
+                self._append(session_id, records, change.reset)
+                written += 1
+            except Exception as exc:
+                logger.warning("Checkpoint for %s failed: %s", session_id, exc)
+                self._requeue(session_id, change)
+                failed.append(session_id)
+        return written, failed
+
+    def _append(self, session_id: str, records: List[Dict[str, Any]], reset: bool) -> None:
+        path = self.path_for(session_id)
+        with self._io_lock:
+            fresh = reset or not path.exists()
+            segments = 0 if fresh else self._segments.get(session_id)
+            if segments is None:
+                segments = self._count_segments(path)
+            with path.open("wb" if fresh else "ab") as f:
+                write_records(f, [_header(session_id, KIND_FULL if fresh else KIND_DELTA), *records])
+            segments += 1
+            if segments > self._compact_segments:
+                self._compact(session_id, path)
+                segments = 1
+            self._segments[session_id] = segments
+
+    @staticmethod
+    def _count_segments(path: Path) -> int:
+        with path.open("rb") as f:
+            return sum(1 for record in iter_records(f) if record.get("type") == "header")
+
+    @staticmethod
+    def _compact(session_id: str, path: Path) -> None:
+        """把完整快照加上所有增量合併成一段，邊讀邊寫"""
+        latest: Dict[str, Dict[str, Any]] = {}
+
+        def merged() -> Iterator[Dict[str, Any]]:
+            yield _header(session_id, KIND_FULL)
+            with path.open("rb") as f:
+                for record in iter_records(f):
+                    kind = record.get("type")
+                    if kind == "turn":
+                        yield record
+                    elif kind in ("summary", "fight", "prompt"):
+                        latest[kind] = record
+            yield from latest.values()
+
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("wb") as f:
+            write_records(f, merged())
+        os.replace(tmp, path)
+
+    async def rewrite(self, session_id: str) -> None:
+        """以 store 目前的內容重寫整份 checkpoint (匯入之後使用)"""
+        with self._lock:
+            self._pending.pop(session_id, None)
+        records = session_records(session_id, *await _capture(session_id))
+        encounter = fight_manager.loaded().get(session_id)
+        await asyncio.to_thread(self._replace, session_id, records)
+        if encounter is not None:
+            self._fight_versions[session_id] = encounter.version
+
+    def _replace(self, session_id: str, records: Iterator[Dict[str, Any]]) -> None:
+        path = self.path_for(session_id)
+        tmp = path.with_name(path.name + ".tmp")
+        with self._io_lock:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            with tmp.open("wb") as f:
+                write_records(f, records)
+            os.replace(tmp, path)
+            self._segments[session_id] = 1
+
+    @staticmethod
+    def _checkpoint_files(directory: Path) -> List[Tuple[Path, Optional[str]]]:
+        # 只讀每個檔的 header 取得 session id
+        found: List[Tuple[Path, Optional[str]]] = []
+        if not directory.exists():
+            return found
+        for path in sorted(directory.glob("*.snap.gz")):
+            try:
+                with path.open("rb") as f:
+                    records = iter_records(f)
+                    header = next(records, None)
+                    records.close()
+            except SnapshotError as exc:
+                logger.warning("Skipping checkpoint %s: %s", path.name, exc)
+                continue
+            found.append((path, (header or {}).get("session")))
+        return found
+
+    async def restore_all(self) -> int:
+        """還原 store 裡還沒有的 session (例如純記憶體模式重啟後)，回傳還原的數量"""
+        restored = 0
+        for path, session_id in await asyncio.to_thread(self._checkpoint_files, self._dir):
+            if not session_id:
+                continue
+            # store 已經有歷史 (持久化 backend) 時以 store 為準
+            await conversation_store.preload(session_id)
+            if conversation_store.get_recent(session_id, 1):
+                continue
+            try:
+                with path.open("rb") as f:
+                    info = await import_session(f, checkpoint=False)
+            except SnapshotError as exc:
+                logger.warning("Skipping checkpoint %s: %s", path.name, exc)
+                continue
+            with self._io_lock:
+                self._segments[session_id] = info.segments
+            encounter = fight_manager.loaded().get(session_id)
+            if encounter is not None:
+                self._fight_versions[session_id] = encounter.version
+            restored += 1
+        return restored
+
+    async def checkpoint(self) -> int:
+        pending, fights = self._collect()
+        if not pending and not fights:
+            return 0
+        with metrics.timer("checkpoint_seconds"):
+            written, failed = await asyncio.to_thread(self._write, pending, fights)
+        # 寫入失敗的戰鬥狀態下次整份重送
+        for session_id in failed:
+            self._fight_versions.pop(session_id, None)
+        metrics.inc("checkpoint_segments", written)
+        return written
+
+    async def start(self) -> None:
+        if not self.enabled:
+            return
+        if get_checkpoint_restore():
+            restored = await self.restore_all()
+            if restored:
+                logger.info("Restored %s sessions from checkpoints in %s", restored, self._dir)
+        # 還原完才開始記錄變動，避免還原的內容又被寫一次
+        conversation_store.set_change_handler(self.on_change)
+        prompt_registry.set_change_handler(self._on_prompt)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.checkpoint()
+            except Exception as exc:
+                logger.warning("Checkpoint failed: %s", exc)
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # 關閉前把最後一批變動寫完
+        await self.checkpoint()
+        conversation_store.set_change_handler(None)
+        prompt_registry.set_change_handler(None)
+
+
+checkpointer = Checkpointer(get_checkpoint_dir(), get_checkpoint_interval(), get_checkpoint_compact_segments())
@@ -0,0 +1,47 @@
+import time
+from typing import List
+
+from game.outbox import DISCORD_MESSAGE_LIMIT, outbox, split_message
+from request.metrics import metrics
+
+
+class StreamingMessage:
+    """把串流中的模型文字寫進 Discord 訊息，以固定間隔批次 edit 避免撞到速率限制"""
+
+    def __init__(self, ctx, edit_interval: float = 1.2, limit: int = DISCORD_MESSAGE_LIMIT):
+        self.ctx = ctx
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self._messages: List = []
+        self._rendered: List[str] = []
+        self._last_edit = 0.0
+
+    async def update(self, text: str) -> None:
+        now = time.monotonic()
+        if self._messages and now - self._last_edit < self.edit_interval:
+            return
+        await self._render(text)
+
+    async def finish(self, text: str) -> None:
+        await self._render(text)
+
+    async def _render(self, text: str) -> None:
+        if not text:
+            return
+        pages = split_message(text, self.limit)
+        for index, page in enumerate(pages):
+            if index < len(self._messages):
+                if self._rendered[index] != page:
+                    with metrics.stage("discord_edit"):
+                        await self._messages[index].edit(content=page)
+                    self._rendered[index] = page
+            else:
+                # 經由 outbox 送出，與同頻道排隊中的訊息維持順序並共用速率額度
+                message = await outbox.send(self.ctx, page, wait=True)
+                self._messages.append(message)
+                self._rendered.append(page)
+        self._last_edit = time.monotonic()
+
+    @property
+    def started(self) -> bool:
+        return bool(self._messages)
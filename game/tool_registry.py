@@ -0,0 +1,79 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+
+from game.fight_manager import fight_manager
+from game.dice import DiceError, dice_engine
+from game.func_tool import perform_d100_check
+from game.outbox import outbox
+from request.logger_setup import logger
+
+# handler(ctx, args, session_id)
+ToolHandler = Callable[[Any, Dict[str, Any], str], Awaitable[Dict[str, Any]]]
+
+
+class ToolRegistry:
+    """模型 functionCall 名稱對應到實際執行的 handler"""
+
+    def __init__(self) -> None:
+        self._handlers: Dict[str, ToolHandler] = {}
+
+    def register(self, name: str, handler: ToolHandler) -> None:
+        self._handlers[name] = handler
+
+    def tool(self, name: str):
+        def decorator(handler: ToolHandler) -> ToolHandler:
+            self.register(name, handler)
+            return handler
+        return decorator
+
+    async def execute(self, ctx, call: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+        name = call.get("name")
+        args = call.get("args") or {}
+        handler = self._handlers.get(name)
+        if handler is None:
+            return {"name": name, "response": {"error": f"unknown function '{name}'"}}
+        try:
+            response = await handler(ctx, args, session_id)
+        except Exception as exc:
+            logger.warning("Tool %s failed: %s", name, exc)
+            response = {"error": str(exc)}
+        return {"name": name, "response": response}
+
+    async def execute_all(self, ctx, calls: List[Dict[str, Any]], session_id: str) -> List[Dict[str, Any]]:
+        # 同一次回應裡的多個呼叫並行執行，結果依原順序回傳
+        return list(await asyncio.gather(*(self.execute(ctx, call, session_id) for call in calls)))
+
+
+tool_registry = ToolRegistry()
+
+
+@tool_registry.tool("perform_d100_check")
+async def _perform_d100_check(ctx, args: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+    success_rate = int(args.get("success_rate", 0))
+    if not 1 <= success_rate <= 100:
+        return {"error": "success_rate must be between 1 and 100"}
+    dice_message = perform_d100_check(success_rate, session_id)
+    logger.info("D100檢定結果: %s", dice_message)
+    await outbox.send(ctx, dice_message)
+    return {"result": dice_message}
+
+
+@tool_registry.tool("apply_damage")
+async def _apply_damage(ctx, args: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+    result = await fight_manager.damage(str(args.get("target", "")), int(args.get("damage", 0)), scope=session_id)
+    if result["status"] == "dead":
+        await outbox.send(ctx, result["result"])
+    return result
+
+
+@tool_registry.tool("roll_dice")
+async def _roll_dice(ctx, args: Dict[str, Any], session_id: str) -> Dict[str, Any]:
+    expressions = [str(e) for e in args.get("expressions") or []]
+    if not expressions:
+        return {"error": "expressions must not be empty"}
+    try:
+        results = dice_engine.roll_many(expressions, session_id)
+    except DiceError as exc:
+        return {"error": str(exc)}
+    await outbox.send(ctx, "\n".join(r.describe() for r in results))
+    return {"results": [{"expression": r.expression, "rolls": list(r.kept), "total": r.total} for r in results]}
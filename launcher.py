@@ -0,0 +1,105 @@
+"""多行程分片啟動器：把 shard 平均分給 SHARD_PROCESSES 個 bot.py 行程
+
+每個子行程是一個只負責部分 shard 的 AutoShardedBot；Discord 依 guild id 把 guild 固定
+分配到 shard，所以同一個 guild 的訊息永遠由同一個行程處理。對話與戰鬥狀態放在共用
+的 SQLite (或 Redis 相容) store，行程重啟或 shard 重新分配後接手的行程可以直接讀到。
+
+用法: SHARD_PROCESSES=4 python launcher.py
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from request.config import get_shard_count, get_shard_processes, get_metrics_port
+from request.logger_setup import logger
+
+DISCORD_GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+# 子行程異常結束後多久重啟
+RESTART_DELAY_SECONDS = 5.0
+
+
+def recommended_shard_count(token: str) -> int:
+    r = httpx.get(DISCORD_GATEWAY_BOT_URL, headers={"Authorization": f"Bot {token}"}, timeout=10)
+    r.raise_for_status()
+    return int(r.json().get("shards") or 1)
+
+
+def split_shards(shard_count: int, processes: int) -> List[List[int]]:
+    # shard i 交給第 i % processes 個行程，讓各行程負責的 guild 數量接近
+    groups = [list(range(i, shard_count, processes)) for i in range(processes)]
+    return [g for g in groups if g]
+
+
+def child_env(index: int, shard_count: int, shard_ids: List[int]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env["SHARD_COUNT"] = str(shard_count)
+    env["SHARD_IDS"] = ",".join(map(str, shard_ids))
+    # 狀態要能跨行程共用：沒指定時改用共用的 SQLite
+    if env.get("CONVERSATION_BACKEND", "memory").strip().lower() == "memory":
+        env["CONVERSATION_BACKEND"] = "sqlite"
+    if env.get("STATE_BACKEND", "memory").strip().lower() == "memory":
+        env["STATE_BACKEND"] = "sqlite"
+    env.setdefault("CONVERSATION_SHARED", "1")
+    # 每個行程的 metrics 各用一個 port
+    if get_metrics_port():
+        env["METRICS_PORT"] = str(get_metrics_port() + index)
+    return env
+
+
+def main() -> int:
+    processes = get_shard_processes()
+    shard_count = get_shard_count()
+    if not shard_count:
+        shard_count = max(processes, recommended_shard_count(os.environ["DISCORD_TOKEN"]))
+    groups = split_shards(shard_count, processes)
+    logger.info("launcher: %s shards across %s processes: %s", shard_count, len(groups), groups)
+
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    children: Dict[int, subprocess.Popen] = {}
+    stopping = False
+
+    def spawn(index: int) -> None:
+        children[index] = subprocess.Popen(
+            [sys.executable, bot_path],
+            env=child_env(index, shard_count, groups[index]),
+        )
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for child in children.values():
+            if child.poll() is None:
+                child.send_signal(signal.SIGINT)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(len(groups)):
+        spawn(index)
+
+    while children:
+        time.sleep(1.0)
+        for index, child in list(children.items()):
+            code = child.poll()
+            if code is None:
+                continue
+            if stopping:
+                del children[index]
+                continue
+            logger.warning("launcher: process %s (shards %s) exited with %s, restarting", index, groups[index], code)
+            time.sleep(RESTART_DELAY_SECONDS)
+            spawn(index)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
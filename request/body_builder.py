@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson 是選用相依
+    orjson = None
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+dumps: Callable[[Any], bytes] = orjson.dumps if orjson is not None else _stdlib_dumps
+
+# 以物件 id 快取不會變動的模組層級常數 (tools 宣告、safetySettings)，同時保留參照避免 id 被重用
+_static_cache: Dict[int, Tuple[Any, bytes]] = {}
+
+
+def encode_static(obj: Any) -> bytes:
+    """編碼模組層級的常數物件並快取；呼叫端不可就地修改傳入的物件"""
+    cached = _static_cache.get(id(obj))
+    if cached is not None and cached[0] is obj:
+        return cached[1]
+    encoded = dumps(obj)
+    _static_cache[id(obj)] = (obj, encoded)
+    return encoded
+
+
+@lru_cache(maxsize=32)
+def encode_system_instruction(text: str) -> bytes:
+    return dumps({"parts": [{"text": text}]})
+
+
+class PreparedBody:
+    """generateContent 請求內容，各區段保留已編碼的 bytes，送出時直接串接不重新序列化"""
+
+    __slots__ = ("contents", "generation_config", "safety_settings", "system_prompt", "tools", "cached_content")
+
+    def __init__(
+        self,
+        contents: List[bytes],
+        generation_config: Dict[str, Any],
+        safety_settings: Any,
+        system_prompt: Optional[str] = None,
+        tools: Any = None,
+        cached_content: Optional[str] = None,
+    ) -> None:
+        self.contents = contents
+        self.generation_config = generation_config
+        self.safety_settings = safety_settings
+        self.system_prompt = system_prompt
+        self.tools = tools
+        self.cached_content = cached_content
+
+    def copy(self) -> "PreparedBody":
+        return PreparedBody(
+            self.contents,
+            self.generation_config,
+            self.safety_settings,
+            self.system_prompt,
+            self.tools,
+            self.cached_content,
+        )
+
+    @property
+    def system_instruction(self) -> Optional[Dict[str, Any]]:
+        return {"parts": [{"text": self.system_prompt}]} if self.system_prompt else None
+
+    def static_fingerprint(self, model: str) -> str:
+        """model + systemInstruction + tools 的雜湊，直接對已編碼的 bytes 計算"""
+        digest = hashlib.sha256(model.encode("utf-8"))
+        if self.system_prompt:
+            digest.update(encode_system_instruction(self.system_prompt))
+        digest.update(b"\x00")
+        if self.tools:
+            digest.update(encode_static(self.tools))
+        return digest.hexdigest()
+
+    def use_cached_content(self, name: str) -> None:
+        self.cached_content = name
+        self.system_prompt = None
+        self.tools = None
+
+    def encode(self) -> bytes:
+        pieces = [b'{"contents":[', b",".join(self.contents), b'],"generationConfig":', dumps(self.generation_config)]
+        pieces += [b',"safetySettings":', encode_static(self.safety_settings)]
+        if self.cached_content:
+            pieces += [b',"cachedContent":', dumps(self.cached_content)]
+        if self.system_prompt:
+            pieces += [b',"systemInstruction":', encode_system_instruction(self.system_prompt)]
+        if self.tools:
+            pieces += [b',"tools":', encode_static(self.tools)]
+        pieces.append(b"}")
+        return b"".join(pieces)
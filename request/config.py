@@ -1,10 +1,16 @@
 import os
+from typing import Dict, List, Optional, Tuple
 
 
 def get_default_model() -> str:
     return os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
 
 
+def get_gemini_base_url() -> str:
+    # 可指向本機 stub server 做測試
+    return os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+
+
 def get_timeout_seconds() -> float:
     raw = os.getenv("HTTP_TIMEOUT_SECONDS", "60")
     try:
@@ -29,4 +35,492 @@ def get_retry_backoff_base() -> float:
         return 0.8
 
 
+def get_http2_enabled() -> bool:
+    return os.getenv("HTTP2_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_http_max_connections() -> int:
+    raw = os.getenv("HTTP_MAX_CONNECTIONS", "20")
+    try:
+        return int(raw)
+    except Exception:
+        return 20
+
+
+def get_http_max_keepalive_connections() -> int:
+    raw = os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")
+    try:
+        return int(raw)
+    except Exception:
+        return 10
+
+
+def get_http_keepalive_expiry() -> float:
+    raw = os.getenv("HTTP_KEEPALIVE_EXPIRY", "120")
+    try:
+        return float(raw)
+    except Exception:
+        return 120.0
+
+
+def get_streaming_enabled() -> bool:
+    return os.getenv("GEMINI_STREAMING", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_stream_edit_interval() -> float:
+    raw = os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "1.2")
+    try:
+        return float(raw)
+    except Exception:
+        return 1.2
+
+
+def get_session_queue_max() -> int:
+    raw = os.getenv("SESSION_QUEUE_MAX", "8")
+    try:
+        return int(raw)
+    except Exception:
+        return 8
+
+
+def get_session_queue_put_timeout() -> float:
+    raw = os.getenv("SESSION_QUEUE_PUT_TIMEOUT_SECONDS", "5")
+    try:
+        return float(raw)
+    except Exception:
+        return 5.0
+
+
+def get_session_worker_idle_seconds() -> float:
+    raw = os.getenv("SESSION_WORKER_IDLE_SECONDS", "300")
+    try:
+        return float(raw)
+    except Exception:
+        return 300.0
+
+
+def get_session_coalesce_enabled() -> bool:
+    return os.getenv("SESSION_COALESCE", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_campaign_idle_seconds() -> float:
+    # 戰役閒置多久後從 session 索引移除 (歷史仍保留在對話 store)
+    raw = os.getenv("CAMPAIGN_IDLE_SECONDS", "3600")
+    try:
+        return float(raw)
+    except Exception:
+        return 3600.0
+
+
+def get_conversation_backend() -> str:
+    return os.getenv("CONVERSATION_BACKEND", "memory").strip().lower()
+
+
+def get_conversation_db_path() -> str:
+    return os.getenv("CONVERSATION_DB_PATH", "data/conversations.sqlite3")
+
+
+def get_conversation_log_dir() -> str:
+    return os.getenv("CONVERSATION_LOG_DIR", "data/conversations")
+
+
+def get_conversation_hot_sessions() -> int:
+    raw = os.getenv("CONVERSATION_HOT_SESSIONS", "256")
+    try:
+        return int(raw)
+    except Exception:
+        return 256
+
+
+def get_conversation_flush_interval() -> float:
+    raw = os.getenv("CONVERSATION_FLUSH_INTERVAL_SECONDS", "0.5")
+    try:
+        return float(raw)
+    except Exception:
+        return 0.5
+
+
+def get_conversation_flush_batch() -> int:
+    raw = os.getenv("CONVERSATION_FLUSH_BATCH", "64")
+    try:
+        return int(raw)
+    except Exception:
+        return 64
+
+
+def get_conversation_shared() -> bool:
+    # 多個行程共用同一個 SQLite 對話庫時開啟；每回合開始前 (最多每 CONVERSATION_SYNC_TTL_SECONDS 一次) 確認其他行程有沒有寫入
+    return os.getenv("CONVERSATION_SHARED", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_conversation_sync_ttl() -> float:
+    # 共用模式下同一個 session 至少隔這麼久才重新確認其他行程的寫入
+    raw = os.getenv("CONVERSATION_SYNC_TTL_SECONDS", "1.0")
+    try:
+        return float(raw)
+    except Exception:
+        return 1.0
+
+
+def get_state_backend() -> str:
+    return os.getenv("STATE_BACKEND", "memory").strip().lower()
+
+
+def get_state_db_path() -> str:
+    return os.getenv("STATE_DB_PATH", "data/state.sqlite3")
+
+
+def get_state_redis_url() -> str:
+    return os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+
+
+def get_shard_count() -> int:
+    # 0 代表不分片；launcher 會依 Discord 建議值自動設定
+    raw = os.getenv("SHARD_COUNT", "0")
+    try:
+        return max(0, int(raw))
+    except Exception:
+        return 0
+
+
+def get_shard_ids() -> Optional[List[int]]:
+    """這個行程負責的 shard，例如 "0,2"；未設定時由 AutoShardedBot 全部接手"""
+    raw = os.getenv("SHARD_IDS", "")
+    try:
+        ids = [int(part) for part in raw.split(",") if part.strip()]
+    except Exception:
+        return None
+    return ids or None
+
+
+def get_shard_processes() -> int:
+    raw = os.getenv("SHARD_PROCESSES", "1")
+    try:
+        return max(1, int(raw))
+    except Exception:
+        return 1
+
+
+def get_history_token_budget() -> int:
+    raw = os.getenv("HISTORY_TOKEN_BUDGET", "6000")
+    try:
+        return int(raw)
+    except Exception:
+        return 6000
+
+
+def get_summary_enabled() -> bool:
+    return os.getenv("SUMMARY_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_summary_model() -> str:
+    return os.getenv("SUMMARY_MODEL") or get_fast_model()
+
+
+def get_summary_max_tokens() -> int:
+    raw = os.getenv("SUMMARY_MAX_TOKENS", "1024")
+    try:
+        return int(raw)
+    except Exception:
+        return 1024
+
+
+def get_context_cache_enabled() -> bool:
+    return os.getenv("CONTEXT_CACHE_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_context_cache_ttl_seconds() -> float:
+    raw = os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600")
+    try:
+        return float(raw)
+    except Exception:
+        return 3600.0
+
+
+def get_context_cache_refresh_margin() -> float:
+    raw = os.getenv("CONTEXT_CACHE_REFRESH_MARGIN_SECONDS", "300")
+    try:
+        return float(raw)
+    except Exception:
+        return 300.0
+
+
+def get_response_cache_enabled() -> bool:
+    return os.getenv("RESPONSE_CACHE_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_response_cache_commands() -> List[str]:
+    # 預設只快取 $chat 的規則/設定問答；劇情指令 (R) 需要自行加入
+    return _parse_model_list(os.getenv("RESPONSE_CACHE_COMMANDS", "chat"))
+
+
+def get_response_cache_ttl_seconds() -> float:
+    raw = os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")
+    try:
+        return float(raw)
+    except Exception:
+        return 3600.0
 
+
+def get_response_cache_max_entries() -> int:
+    raw = os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024")
+    try:
+        return max(1, int(raw))
+    except Exception:
+        return 1024
+
+
+def get_response_cache_similarity() -> float:
+    """字面相似度門檻 (0~1)；設成 1 只用完全相同的比對"""
+    raw = os.getenv("RESPONSE_CACHE_SIMILARITY", "0.7")
+    try:
+        return float(raw)
+    except Exception:
+        return 0.7
+
+
+def get_response_cache_history_turns() -> int:
+    # 快取 key 納入最近幾個回合；0 代表問題與對話進度無關
+    raw = os.getenv("RESPONSE_CACHE_HISTORY_TURNS", "0")
+    try:
+        return max(0, int(raw))
+    except Exception:
+        return 0
+
+
+def get_prompt_reload_interval() -> float:
+    raw = os.getenv("PROMPT_RELOAD_INTERVAL_SECONDS", "5")
+    try:
+        return float(raw)
+    except Exception:
+        return 5.0
+
+
+def get_function_calling_enabled() -> bool:
+    return os.getenv("GEMINI_FUNCTION_CALLING", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_max_tool_rounds() -> int:
+    raw = os.getenv("MAX_TOOL_ROUNDS", "3")
+    try:
+        return int(raw)
+    except Exception:
+        return 3
+
+
+def get_dice_seed() -> Optional[int]:
+    """設定後每個 session 的擲骰序列由這個種子與 session id 決定，可重現"""
+    raw = os.getenv("DICE_SEED", "").strip()
+    try:
+        return int(raw) if raw else None
+    except Exception:
+        return None
+
+
+def get_dice_prefetch_enabled() -> bool:
+    # 擲完骰就先送出結果敘述的請求，與公布訊息、傷害處理並行
+    return os.getenv("DICE_PREFETCH", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_dice_log_size() -> int:
+    raw = os.getenv("DICE_LOG_SIZE", "200")
+    try:
+        return max(1, int(raw))
+    except Exception:
+        return 200
+
+
+def get_metrics_window() -> int:
+    raw = os.getenv("METRICS_WINDOW", "1024")
+    try:
+        return int(raw)
+    except Exception:
+        return 1024
+
+
+def get_metrics_port() -> int:
+    # 0 表示不開 Prometheus exporter
+    raw = os.getenv("METRICS_PORT", "0")
+    try:
+        return int(raw)
+    except Exception:
+        return 0
+
+
+def _parse_model_limits(raw: str) -> Dict[str, int]:
+    # "15" 套用到所有模型；"gemini-1.5-flash=15,gemini-1.5-pro=2,*=10" 可分別設定
+    limits: Dict[str, int] = {}
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model, sep, value = item.rpartition("=")
+        try:
+            limits[model.strip() if sep else "*"] = int(value)
+        except ValueError:
+            continue
+    return limits
+
+
+def get_rate_limit_enabled() -> bool:
+    return os.getenv("RATE_LIMIT_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_rate_limit_rpm() -> Dict[str, int]:
+    # 每分鐘請求數上限，0 或未設定表示由 429 回應自動推估
+    return _parse_model_limits(os.getenv("GEMINI_RPM", "0"))
+
+
+def get_rate_limit_tpm() -> Dict[str, int]:
+    return _parse_model_limits(os.getenv("GEMINI_TPM", "0"))
+
+
+def get_turn_deadline_seconds() -> float:
+    # 從玩家送出指令開始算，整個回合 (含排隊、重試、擲骰後續) 的時間預算；0 表示不限
+    raw = os.getenv("TURN_DEADLINE_SECONDS", "120")
+    try:
+        return float(raw)
+    except Exception:
+        return 120.0
+
+
+def get_circuit_error_ratio() -> float:
+    raw = os.getenv("CIRCUIT_ERROR_RATIO", "0.5")
+    try:
+        return float(raw)
+    except Exception:
+        return 0.5
+
+
+def get_circuit_min_requests() -> int:
+    raw = os.getenv("CIRCUIT_MIN_REQUESTS", "10")
+    try:
+        return int(raw)
+    except Exception:
+        return 10
+
+
+def get_circuit_window_seconds() -> float:
+    raw = os.getenv("CIRCUIT_WINDOW_SECONDS", "60")
+    try:
+        return float(raw)
+    except Exception:
+        return 60.0
+
+
+def get_circuit_open_seconds() -> float:
+    raw = os.getenv("CIRCUIT_OPEN_SECONDS", "30")
+    try:
+        return float(raw)
+    except Exception:
+        return 30.0
+
+
+def get_hedge_enabled() -> bool:
+    return os.getenv("HEDGE_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_hedge_min_delay() -> float:
+    raw = os.getenv("HEDGE_MIN_DELAY_SECONDS", "1.0")
+    try:
+        return float(raw)
+    except Exception:
+        return 1.0
+
+
+def get_hedge_min_samples() -> int:
+    raw = os.getenv("HEDGE_MIN_SAMPLES", "20")
+    try:
+        return int(raw)
+    except Exception:
+        return 20
+
+
+def _parse_model_list(raw: str) -> List[str]:
+    return [m.strip() for m in raw.split(",") if m.strip()]
+
+
+def get_fast_model() -> str:
+    # 擲骰後續、摘要這類短回應用的便宜快速模型
+    return os.getenv("GEMINI_FAST_MODEL") or get_default_model()
+
+
+def get_route_models(route: str) -> List[str]:
+    """某種請求依序可用的模型，可用 GEMINI_MODELS_<ROUTE>=a,b 覆寫"""
+    configured = _parse_model_list(os.getenv(f"GEMINI_MODELS_{route.upper()}", ""))
+    if configured:
+        return configured
+    if route == "summary":
+        return [get_summary_model()]
+    if route == "follow_up":
+        return [get_fast_model()]
+    return [get_default_model()]
+
+
+def get_fallback_models() -> List[str]:
+    # 上面的模型都被限流或斷路時才改用
+    return _parse_model_list(os.getenv("GEMINI_FALLBACK_MODELS", ""))
+
+
+def get_router_prefer_fastest() -> bool:
+    return os.getenv("ROUTER_PREFER_FASTEST", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_checkpoint_dir() -> str:
+    return os.getenv("CHECKPOINT_DIR", "data/checkpoints")
+
+
+def get_checkpoint_interval() -> float:
+    # 背景 checkpoint 的間隔秒數，0 表示不啟用
+    raw = os.getenv("CHECKPOINT_INTERVAL_SECONDS", "0")
+    try:
+        return max(0.0, float(raw))
+    except Exception:
+        return 0.0
+
+
+def get_checkpoint_compact_segments() -> int:
+    # 一個 checkpoint 檔累積多少段增量後合併成一份完整快照
+    raw = os.getenv("CHECKPOINT_COMPACT_SEGMENTS", "50")
+    try:
+        return max(1, int(raw))
+    except Exception:
+        return 50
+
+
+def get_checkpoint_restore() -> bool:
+    # 啟動時從 checkpoint 還原 store 裡沒有的 session
+    return os.getenv("CHECKPOINT_RESTORE", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_outbox_enabled() -> bool:
+    # 關閉時每則訊息直接送出 (仍會依 2000 字切開)
+    return os.getenv("OUTBOX_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+def get_outbox_linger_seconds() -> float:
+    # 頻道開始送出前等待的時間，讓同一回合接著產生的訊息合併成一則
+    raw = os.getenv("OUTBOX_LINGER_SECONDS", "0.05")
+    try:
+        return max(0.0, float(raw))
+    except Exception:
+        return 0.05
+
+
+def get_outbox_channel_limit() -> Tuple[int, float]:
+    # 每個頻道 OUTBOX_CHANNEL_MESSAGES 則 / OUTBOX_CHANNEL_WINDOW_SECONDS 秒 (Discord 頻道訊息 bucket 約 5 則 / 5 秒)
+    try:
+        messages = max(1, int(os.getenv("OUTBOX_CHANNEL_MESSAGES", "5")))
+        window = max(0.0, float(os.getenv("OUTBOX_CHANNEL_WINDOW_SECONDS", "5")))
+        return messages, window
+    except Exception:
+        return 5, 5.0
+
+
+def get_outbox_global_per_second() -> int:
+    # Discord 全域上限為每秒 50 個請求，預設留一點空間給 edit 與 reaction
+    raw = os.getenv("OUTBOX_GLOBAL_PER_SECOND", "45")
+    try:
+        return max(1, int(raw))
+    except Exception:
+        return 45
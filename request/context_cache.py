@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from request.config import (
+    get_gemini_base_url,
+    get_context_cache_enabled,
+    get_context_cache_ttl_seconds,
+    get_context_cache_refresh_margin,
+)
+from request.body_builder import PreparedBody
+from request.http_client import http_client_manager
+from request.logger_setup import logger
+
+# 建立失敗 (例如內容低於模型的最小快取 token 數) 後多久內不再嘗試
+FAILURE_COOLDOWN_SECONDS = 600.0
+
+
+@dataclass
+class _CacheEntry:
+    name: Optional[str]
+    expires_at: float
+
+
+class ContextCacheManager:
+    """把固定的 systemInstruction + tools 放進 Gemini cachedContents，每回合只送 cache 名稱"""
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, _CacheEntry] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def apply(self, body: PreparedBody, model: str, api_key: str) -> Optional[str]:
+        """可用時把 body 的靜態區段換成 cachedContent，回傳使用的 cache key；否則原樣不動"""
+        if not get_context_cache_enabled():
+            return None
+        if not body.system_prompt and not body.tools:
+            return None
+
+        # 直接對已編碼的靜態區段計算雜湊，不必每回合重新 json.dumps 整份 prompt
+        key = body.static_fingerprint(model)
+        name = await self._resolve(key, model, api_key, body.system_instruction, body.tools)
+        if not name:
+            return None
+
+        body.use_cached_content(name)
+        return key
+
+    def invalidate(self, key: str) -> None:
+        self._entries.pop(key, None)
+        self._drop_lock(key)
+
+    def _drop_lock(self, key: str) -> None:
+        # 正在使用中的鎖留著，等下次淘汰再清
+        lock = self._locks.get(key)
+        if lock is not None and not lock.locked():
+            del self._locks[key]
+
+    def _evict_expired(self, now: float) -> None:
+        """清掉已過期的 cache 與對應的鎖，不同 prompt/模型組合的 key 不會一直累積"""
+        for key, entry in list(self._entries.items()):
+            if entry.expires_at <= now:
+                del self._entries[key]
+                self._drop_lock(key)
+
+    async def _resolve(self, key: str, model: str, api_key: str, system_instruction: Any, tools: Any) -> Optional[str]:
+        entry = self._entries.get(key)
+        margin = get_context_cache_refresh_margin()
+        now = time.monotonic()
+        if entry is not None and entry.expires_at - now > margin:
+            return entry.name
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and entry.expires_at - now > margin:
+                return entry.name
+            if entry is not None and entry.name and entry.expires_at > now:
+                # 快到期：延長 TTL，失敗再重新建立
+                if await self._refresh(entry, api_key):
+                    return entry.name
+            self._evict_expired(now)
+            entry = await self._create(model, api_key, system_instruction, tools)
+            self._entries[key] = entry
+            return entry.name
+
+    async def _create(self, model: str, api_key: str, system_instruction: Any, tools: Any) -> _CacheEntry:
+        ttl = get_context_cache_ttl_seconds()
+        payload: Dict[str, Any] = {"model": f"models/{model}", "ttl": f"{int(ttl)}s"}
+        if system_instruction:
+            payload["systemInstruction"] = system_instruction
+        if tools:
+            payload["tools"] = tools
+
+        url = f"{get_gemini_base_url()}/cachedContents?key={api_key}"
+        try:
+            client = await http_client_manager.get_client()
+            r = await client.post(url, json=payload, headers={"content-type": "application/json"})
+        except Exception as exc:
+            logger.warning("Context cache create failed: %s", exc)
+            return _CacheEntry(name=None, expires_at=time.monotonic() + FAILURE_COOLDOWN_SECONDS)
+
+        if r.status_code != 200:
+            logger.warning("Context cache create non-200 status=%s body=%s", r.status_code, r.text[:500])
+            return _CacheEntry(name=None, expires_at=time.monotonic() + FAILURE_COOLDOWN_SECONDS)
+
+        name = r.json().get("name")
+        logger.info("Created context cache %s for model %s", name, model)
+        return _CacheEntry(name=name, expires_at=time.monotonic() + ttl)
+
+    async def _refresh(self, entry: _CacheEntry, api_key: str) -> bool:
+        ttl = get_context_cache_ttl_seconds()
+        url = f"{get_gemini_base_url()}/{entry.name}?updateMask=ttl&key={api_key}"
+        try:
+            client = await http_client_manager.get_client()
+            r = await client.patch(url, json={"ttl": f"{int(ttl)}s"}, headers={"content-type": "application/json"})
+        except Exception as exc:
+            logger.warning("Context cache refresh failed: %s", exc)
+            return False
+        if r.status_code != 200:
+            logger.warning("Context cache refresh non-200 status=%s body=%s", r.status_code, r.text[:500])
+            return False
+        entry.expires_at = time.monotonic() + ttl
+        return True
+
+
+context_cache_manager = ContextCacheManager()
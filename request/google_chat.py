@@ -1,22 +1,23 @@
 import os
 import httpx
-import json
-from typing import Optional, Any, Dict, List, Literal
+import time
+from functools import lru_cache
+from typing import Optional, Any, AsyncIterator, Dict, List, Literal, Tuple
 
 # Local modules
 from request.memory import conversation_store, ConversationTurn
-from request.config import get_default_model, get_timeout_seconds, get_max_retries, get_retry_backoff_base
-from request.logger_setup import logger
-from request.utils_http import post_json_with_retries
+from request.config import get_max_retries, get_retry_backoff_base, get_history_token_budget, get_gemini_base_url
+from request.logger_setup import LazyBytes, logger
+from request.utils_http import post_json_with_retries, stream_sse_json
+from request.http_client import http_client_manager
+from request.context_cache import context_cache_manager
+from request.metrics import metrics, record_usage
+from request.body_builder import PreparedBody, dumps
+from request.model_router import model_router
+from request.response_cache import CacheLookup, context_key, response_cache
+from request.resilience import CircuitOpenError, ModelUnavailableError
 from request.model import ChatRequest # 確保你的 ChatRequest 模型能接受額外欄位
-
-# REVISED: 在 ChatRequest 中增加 function_name 欄位
-# 你需要在你的 model.py 中修改 ChatRequest
-# from pydantic import BaseModel
-# class ChatRequest(BaseModel):
-#     ...
-#     toolReturn: Optional[bool] = False
-#     function_name: Optional[str] = None # <-- 新增此行
+from request.turns import ROLE_USER, ROLE_MODEL, ROLE_TOOL
 
 # 安全設定保持不變
 UNCENSORED_CATEGORIES = [
@@ -27,34 +28,21 @@ UNCENSORED_CATEGORIES = [
     {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_NONE"},
 ]
 
-def detect_tools_declaration(data: Dict[str, Any]):
+def _extract_function_calls(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """取出回應中所有 functionCall part (一次回應可能有多個)"""
     try:
-        candidates = data.get('candidates') or []
+        candidates = data.get("candidates") or []
         if not candidates or not isinstance(candidates[0], dict):
-            return None
-
-        content = candidates[0].get('content') or {}
-        if not isinstance(content, dict):
-            return None
-
-        parts = content.get('parts') or []
-        if not parts or not isinstance(parts[0], dict):
-            return None
-
-        function_call = parts[0].get('functionCall')
-        if not isinstance(function_call, dict):
-            return None
-
-        function_name = function_call.get('name')
-        function_args = function_call.get('args', {})
-        if not function_name:
-            return None
-
-        print(f"🤖 AI 回應: 偵測到需要呼叫函式 '{function_name}'")
-        print(f"   - 函式參數: {function_args}")
-        return {"function_name": function_name, "function_args": function_args}
+            return []
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        calls: List[Dict[str, Any]] = []
+        for p in parts:
+            function_call = p.get("functionCall") if isinstance(p, dict) else None
+            if isinstance(function_call, dict) and function_call.get("name"):
+                calls.append({"name": function_call["name"], "args": function_call.get("args") or {}})
+        return calls
     except Exception:
-        return None
+        return []
 
 def _extract_text_from_gl_response(data: Dict[str, Any]) -> str:
     try:
@@ -73,136 +61,230 @@ def _extract_text_from_gl_response(data: Dict[str, Any]) -> str:
 
 
 # REVISED: 大幅修改此函式以正確處理儲存的新結構
-def _build_history_contents(history: List[ConversationTurn]) -> List[Dict[str, Any]]:
-    contents: List[Dict[str, Any]] = []
-    for turn in history:
-        role = turn.get("role")
-        part = {} # 初始化一個空的 Part 物件
-
-        if role == "user":
-            part = {"text": turn.get("text", "")}
-            contents.append({"role": "user", "parts": [part]})
-
-        elif role == "model":
-            if "text" in turn:
-                part = {"text": turn.get("text", "")}
-            elif "function_call" in turn:
-                # 正確的邏輯：只提取 function_call 物件，而不是整個 turn
-                part = {"function_call": turn.get("function_call")}
-            else:
-                continue # 如果是空的 model turn，跳過
-
-            contents.append({"role": "model", "parts": [part]})
-
-        elif role == "tool":
-            if "function_response" in turn:
-                # 正確的邏輯：只提取 function_response 物件，而不是整個 turn
-                part = {"function_response": turn.get("function_response")}
-            else:
-                continue # 如果是空的 tool turn，跳過
-            
-            contents.append({"role": "tool", "parts": [part]})
-
-    return contents
+def _turn_content(turn: ConversationTurn) -> Optional[Dict[str, Any]]:
+    role = turn.role
 
-# REVISED: 重構核心請求和儲存邏輯
-async def google_request(req: ChatRequest):
+    if role == ROLE_USER:
+        return {"role": "user", "parts": [{"text": turn.text}]}
+
+    if role == ROLE_MODEL:
+        # 一次回應可能同時有文字與多個 function call，放在同一個 content 的 parts 裡
+        parts: List[Dict[str, Any]] = []
+        if turn.text:
+            parts.append({"text": turn.text})
+        for call in turn.function_calls or ():
+            parts.append({"function_call": call})
+        return {"role": "model", "parts": parts} if parts else None
+
+    if role == ROLE_TOOL:
+        parts = [{"function_response": response} for response in turn.function_responses or ()]
+        # API 只接受 user/model 角色，工具結果以 user 角色回傳
+        return {"role": "user", "parts": parts} if parts else None
+
+    return None
+
+
+def _encode_turn(turn: ConversationTurn) -> bytes:
+    # 回合寫入後內容不再改變，編碼結果快取在回合上；空回合編成 b"" 代表略過
+    if turn.encoded is None:
+        content = _turn_content(turn)
+        turn.encoded = dumps(content) if content is not None else b""
+    return turn.encoded
+
+
+def _build_summary_contents(summary: str) -> List[Dict[str, Any]]:
+    # 早期劇情的滾動摘要放在歷史最前面，並補一個 model 回合維持 user/model 交替
+    if not summary:
+        return []
+    return [
+        {"role": "user", "parts": [{"text": f"【先前劇情摘要】\n{summary}"}]},
+        {"role": "model", "parts": [{"text": "了解，我會依照先前劇情摘要繼續主持。"}]},
+    ]
+
+
+@lru_cache(maxsize=256)
+def _encode_summary_contents(summary: str) -> Tuple[bytes, ...]:
+    # 摘要只在背景重寫時才變，同一份摘要的編碼結果重用
+    return tuple(dumps(content) for content in _build_summary_contents(summary))
+
+
+def _get_api_key() -> str:
     api_key = os.getenv("GOOGLE_API_KEY")
     if not api_key:
         raise Exception("GOOGLE_API_KEY is not set")
+    return api_key
 
-    model = req.model or get_default_model()
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
 
+def _build_request_body(req: ChatRequest) -> PreparedBody:
     # 清除 session (如果需要)
     if req.clear_session and req.session_id:
         conversation_store.clear_session(req.session_id)
 
-    # 1. 準備歷史對話
-    contents: List[Dict[str, Any]] = []
-    if req.use_history and req.session_id:
-        history = conversation_store.get_recent(req.session_id, max_turns=int(req.history_turns or 8))
-        # 注意：這裡的建構函式是舊的，我們將在下面處理完整的 contents
-        # contents.extend(_build_history_contents(history)) # 我們將把所有 turn 放在一起處理
+    # 1. 準備歷史對話 (每個 content 已編碼成 bytes)
+    contents: List[bytes] = []
 
     # 2. 處理並儲存當前回合 (可能是 user 或 tool)
     if req.session_id:
-        if req.toolReturn:
-            # 這是工具的回應
-            if not req.function_name:
-                raise ValueError("toolReturn is True, but function_name is not provided.")
-            
-            try:
-                # req.prompt 應該是 JSON 字串，我們需要解析它
-                response_data = json.loads(req.prompt)
-            except json.JSONDecodeError:
-                raise ValueError("toolReturn is True, but the prompt is not a valid JSON string.")
-
-            # 存入歷史
-            conversation_store.add_tool_response(req.session_id, req.function_name, response_data)
+        if req.tool_responses:
+            # 一次把多個工具結果存成同一個回合
+            conversation_store.add_tool_responses(req.session_id, req.tool_responses)
 
         else:
             # 這是一個普通的使用者訊息
             conversation_store.add_turn(req.session_id, role="user", text=req.prompt)
 
-    # 3. 重新從 store 獲取完整的、包含當前回合的歷史，並建構 contents
+    # 3. 從 store 獲取完整的、包含當前回合的歷史，並建構 contents
     if req.use_history and req.session_id:
          # 獲取包含剛剛新增回合的最新歷史
-        final_history = conversation_store.get_recent(req.session_id, max_turns=int(req.history_turns or 8) + 1)
-        contents = _build_history_contents(final_history)
+        final_history = conversation_store.get_window(
+            req.session_id,
+            max_turns=int(req.history_turns or 8) + 1,
+            max_tokens=int(req.history_token_budget or get_history_token_budget()),
+        )
+        contents = list(_encode_summary_contents(conversation_store.get_summary(req.session_id)))
+        # 沒變動的回合直接用快取的 bytes，成本與歷史長度無關
+        contents.extend(encoded for encoded in map(_encode_turn, final_history) if encoded)
     else:
         # 如果不使用歷史，只處理當前回合
-        if req.toolReturn:
-            # 邏輯上 toolReturn 不應該在沒有歷史的情況下發生，但為了完整性做處理
-            response_data = json.loads(req.prompt)
-            contents.append({"role": "tool", "parts": [{"function_response": {"name": req.function_name, "response": response_data}}]})
+        if req.tool_responses:
+            contents.append(dumps({"role": "user", "parts": [{"function_response": r} for r in req.tool_responses]}))
         else:
-            contents.append({"role": "user", "parts": [{"text": req.prompt}]})
+            contents.append(dumps({"role": "user", "parts": [{"text": req.prompt}]}))
 
-    body: Dict[str, Any] = {
-        "contents": contents,
-        "generationConfig": {
+    return PreparedBody(
+        contents=contents,
+        generation_config={
             "maxOutputTokens": int(req.max_output_tokens),
             "temperature": float(req.temperature or 0.7),
         },
-        "safetySettings": UNCENSORED_CATEGORIES
-    }
+        safety_settings=UNCENSORED_CATEGORIES,
+        system_prompt=req.system_prompt or None,
+        tools=req.tools_declaration or None,
+    )
+
+
+def _log_request_body(label: str, content: bytes) -> None:
+    # 完整 body 很大，只在 DEBUG 時輸出，解碼與截斷延到 log 執行緒
+    logger.debug("%s: %s", label, LazyBytes(content))
 
-    if req.system_prompt:
-        body["systemInstruction"] = {"parts": [{"text": req.system_prompt}]}
-        
-    if req.tools_declaration:
-        body["tools"] = req.tools_declaration
 
-    timeout_seconds = get_timeout_seconds()
+def _store_model_response(req: ChatRequest, text: str, func_calls: List[Dict[str, Any]]) -> None:
+    # 4. 儲存模型的回應 (可能是文字或 function call)
+    if req.session_id:
+        if func_calls:
+            conversation_store.add_func_calls(req.session_id, func_calls, text=text)
+        elif text:
+            conversation_store.add_turn(req.session_id, role="model", text=text)
+
+
+def _cache_lookup(req: ChatRequest) -> Optional[CacheLookup]:
+    # 只有一般的玩家提問能用快取；工具結果回合一定要送給模型
+    if req.tool_responses or not response_cache.enabled_for(req.cache_command):
+        return None
+    history: List[str] = []
+    turns = response_cache.history_turns()
+    if turns and req.use_history and req.session_id and not req.clear_session:
+        history = [f"{turn.role}:{turn.text}" for turn in conversation_store.get_recent(req.session_id, turns)]
+    return response_cache.lookup(req.prompt, context_key(req.system_prompt, history, req.route))
+
+
+def _cached_response(req: ChatRequest, lookup: CacheLookup) -> Dict[str, Any]:
+    # 命中時不呼叫 API，但這一問一答照樣寫進歷史，對話保持連貫
+    if req.session_id:
+        if req.clear_session:
+            conversation_store.clear_session(req.session_id)
+        conversation_store.add_turn(req.session_id, role="user", text=req.prompt)
+        conversation_store.add_turn(req.session_id, role="model", text=lookup.text)
+    resp: Dict[str, Any] = {"text": lookup.text, "model": "cache", "cached": lookup.tier}
+    if req.session_id:
+        resp["session_id"] = req.session_id
+    return resp
+
+
+# 這些錯誤代表「這個模型現在不行」，可以改送下一個候選模型
+FALLBACK_ERRORS = (ModelUnavailableError, CircuitOpenError)
+
+
+def _log_fallback(model: str, next_model: str, exc: Exception) -> None:
+    logger.warning("Model %s unavailable (%s), falling back to %s", model, exc, next_model)
+    metrics.inc("model_fallbacks", model=model, to=next_model)
+
+
+async def _generate(req: ChatRequest, model: str, body: PreparedBody, api_key: str) -> Dict[str, Any]:
+    url = f"{get_gemini_base_url()}/models/{model}:generateContent?key={api_key}"
+    request_body = body.copy()
+    cache_key = await context_cache_manager.apply(request_body, model, api_key)
+
     max_retries = get_max_retries()
     backoff_base = get_retry_backoff_base()
 
-    # 為了 debug，打印出最終發送的 body
-    logger.info("Sending request body to Gemini: %s", json.dumps(body, indent=2, ensure_ascii=False))
+    with metrics.stage("serialize"):
+        content = request_body.encode()
+    _log_request_body("Sending request body to Gemini", content)
 
-    async with httpx.AsyncClient(timeout=timeout_seconds) as client:
-        r = await post_json_with_retries(client, url, json=body, headers={"content-type": "application/json"}, max_retries=max_retries, backoff_base=backoff_base)
+    client = await http_client_manager.get_client()
+    r = await post_json_with_retries(client, url, content=content, headers={"content-type": "application/json"}, max_retries=max_retries, backoff_base=backoff_base, model=model, priority=int(req.priority or 0))
+
+    if cache_key and 400 <= r.status_code < 500 and r.status_code != 429:
+        # cachedContent 可能已過期或被刪除，改送完整內容重試一次
+        logger.warning("Request with cachedContent failed status=%s, retrying without cache", r.status_code)
+        context_cache_manager.invalidate(cache_key)
+        with metrics.stage("serialize"):
+            content = body.encode()
+        r = await post_json_with_retries(client, url, content=content, headers={"content-type": "application/json"}, max_retries=max_retries, backoff_base=backoff_base, model=model, priority=int(req.priority or 0))
 
     if r.status_code != 200:
         logger.warning("google_chat non-200 status=%s body=%s", r.status_code, r.text)
+        if r.status_code == 429 or r.status_code >= 500:
+            raise ModelUnavailableError(model, r.status_code, r.text)
         raise Exception(r.text)
+    return r.json()
+
 
-    data = r.json()
-    print(f"google_chat 回傳: {data}")
+async def _preload_history(req: ChatRequest) -> None:
+    # 冷 session 的磁碟讀取在執行緒裡完成，組 body 時只讀記憶體
+    if req.session_id and not req.clear_session:
+        await conversation_store.preload(req.session_id)
+
+
+# REVISED: 重構核心請求和儲存邏輯
+async def google_request(req: ChatRequest):
+    await _preload_history(req)
+    lookup = _cache_lookup(req)
+    if lookup is not None and lookup.hit:
+        return _cached_response(req, lookup)
+
+    api_key = _get_api_key()
+
+    with metrics.stage("history_build"):
+        body = _build_request_body(req)
+
+    # 歷史只寫入一次；換模型時重送同一份 body
+    candidates = model_router.candidates(req)
+    for index, model in enumerate(candidates):
+        started = time.perf_counter()
+        try:
+            data = await _generate(req, model, body, api_key)
+        except FALLBACK_ERRORS as exc:
+            if index + 1 >= len(candidates):
+                raise
+            _log_fallback(model, candidates[index + 1], exc)
+            continue
+        metrics.observe("model_seconds", time.perf_counter() - started, model=model)
+        break
+
+    logger.debug("google_chat 回傳", extra={"payload": data})
+    record_usage(model, req.session_id, data)
     
-    func_call = detect_tools_declaration(data)
+    func_calls = _extract_function_calls(data)
     text = _extract_text_from_gl_response(data)
     
-    if text == "":
+    if text == "" and not func_calls:
         raise Exception("語言模型 回傳空字串")
 
-    # 4. 儲存模型的回應 (可能是文字或 function call)
-    if req.session_id:
-        if text:
-            conversation_store.add_turn(req.session_id, role="model", text=text)
-        if func_call:
-            conversation_store.add_func_call(req.session_id, func_call["function_name"], func_call["function_args"])
+    _store_model_response(req, text, func_calls)
+    if lookup is not None and not func_calls:
+        response_cache.store(lookup, text)
 
     # 準備最終的回應
     resp: Dict[str, Any] = {"text": text, "model": model}
@@ -210,6 +292,84 @@ async def google_request(req: ChatRequest):
         resp["session_id"] = req.session_id
     if req.return_raw:
         resp["raw"] = data
-    if func_call:
-        resp["function_call"] = func_call
-    return resp
\ No newline at end of file
+    if func_calls:
+        resp["function_calls"] = func_calls
+    return resp
+
+
+async def google_request_stream(req: ChatRequest) -> AsyncIterator[str]:
+    """以 streamGenerateContent (SSE) 逐段產出模型文字，串流結束後才寫入歷史"""
+    await _preload_history(req)
+    lookup = _cache_lookup(req)
+    if lookup is not None and lookup.hit:
+        yield _cached_response(req, lookup)["text"]
+        return
+
+    api_key = _get_api_key()
+
+    with metrics.stage("history_build"):
+        body = _build_request_body(req)
+
+    client = await http_client_manager.get_client()
+    texts: List[str] = []
+    func_calls: List[Dict[str, Any]] = []
+    last_usage: Dict[str, Any] = {}
+    candidates = model_router.candidates(req)
+    for model_index, model in enumerate(candidates):
+        url = f"{get_gemini_base_url()}/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
+        request_body = body.copy()
+        cache_key = await context_cache_manager.apply(request_body, model, api_key)
+        attempts = [request_body, body] if cache_key else [body]
+
+        started = time.perf_counter()
+        try:
+            for index, payload in enumerate(attempts):
+                with metrics.stage("serialize"):
+                    content = payload.encode()
+                _log_request_body("Sending streaming request body to Gemini", content)
+                try:
+                    async for data in stream_sse_json(
+                        client,
+                        url,
+                        content=content,
+                        headers={"content-type": "application/json"},
+                        max_retries=get_max_retries(),
+                        backoff_base=get_retry_backoff_base(),
+                        model=model,
+                        priority=int(req.priority or 0),
+                    ):
+                        func_calls.extend(_extract_function_calls(data))
+                        if data.get("usageMetadata"):
+                            # 每個片段的 usageMetadata 是累計值，只記最後一份
+                            last_usage = data
+                        chunk = _extract_text_from_gl_response(data)
+                        if chunk:
+                            texts.append(chunk)
+                            yield chunk
+                    break
+                except FALLBACK_ERRORS:
+                    raise
+                except Exception as exc:
+                    # 已經輸出過片段就不能重來；否則改送完整內容重試
+                    if texts or index + 1 >= len(attempts):
+                        raise
+                    logger.warning("Streaming with cachedContent failed (%s), retrying without cache", exc)
+                    context_cache_manager.invalidate(cache_key)
+        except FALLBACK_ERRORS as exc:
+            # 換模型同樣只能在還沒輸出任何片段前
+            if texts or func_calls or model_index + 1 >= len(candidates):
+                raise
+            _log_fallback(model, candidates[model_index + 1], exc)
+            continue
+        metrics.observe("model_seconds", time.perf_counter() - started, model=model)
+        break
+
+    record_usage(model, req.session_id, last_usage)
+
+    text = "".join(texts)
+    if text == "" and not func_calls:
+        raise Exception("語言模型 回傳空字串")
+
+    _store_model_response(req, text, func_calls)
+    if lookup is not None and not func_calls:
+        response_cache.store(lookup, text)
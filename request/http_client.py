@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Optional
+
+import httpx
+
+from request.config import (
+    get_timeout_seconds,
+    get_http2_enabled,
+    get_http_max_connections,
+    get_http_max_keepalive_connections,
+    get_http_keepalive_expiry,
+)
+from request.logger_setup import logger
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class HttpClientManager:
+    """持有整個 bot 生命週期共用的 httpx.AsyncClient，讓每次模型呼叫重用連線池"""
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+        self._lock = asyncio.Lock()
+
+    def _build_client(self) -> httpx.AsyncClient:
+        http2 = get_http2_enabled()
+        if http2 and not _http2_available():
+            logger.warning("HTTP/2 requested but 'h2' is not installed, falling back to HTTP/1.1")
+            http2 = False
+
+        limits = httpx.Limits(
+            max_connections=get_http_max_connections(),
+            max_keepalive_connections=get_http_max_keepalive_connections(),
+            keepalive_expiry=get_http_keepalive_expiry(),
+        )
+        logger.info(
+            "Opening shared HTTP client (http2=%s, max_connections=%s, keepalive=%s)",
+            http2,
+            limits.max_connections,
+            limits.max_keepalive_connections,
+        )
+        return httpx.AsyncClient(timeout=get_timeout_seconds(), limits=limits, http2=http2)
+
+    async def start(self) -> httpx.AsyncClient:
+        async with self._lock:
+            if self._client is None or self._client.is_closed:
+                self._client = self._build_client()
+            return self._client
+
+    async def get_client(self) -> httpx.AsyncClient:
+        # 未經 setup_hook 啟動時(例如單獨呼叫 google_request)也能懶載入
+        client = self._client
+        if client is not None and not client.is_closed:
+            return client
+        return await self.start()
+
+    async def close(self) -> None:
+        async with self._lock:
+            client, self._client = self._client, None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+            logger.info("Shared HTTP client closed")
+
+
+http_client_manager = HttpClientManager()
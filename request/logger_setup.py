@@ -1,6 +1,13 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import sys
+from typing import Any, Optional
 
 
 def _level_from_env() -> int:
@@ -8,18 +15,198 @@ def _level_from_env() -> int:
     return getattr(logging, level_name, logging.INFO)
 
 
+def _int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+def _float_env(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except Exception:
+        return default
+
+
+# 單筆訊息與附帶 payload 的長度上限，超過就截斷 (完整 request body 這類大物件不會整份寫出)
+MAX_MESSAGE_CHARS = _int_env("LOG_MAX_MESSAGE_CHARS", 4000)
+
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def truncate(text: str, limit: int = MAX_MESSAGE_CHARS) -> str:
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(truncated {len(text) - limit} chars)"
+
+
+class LazyJson:
+    """紀錄沒有被等級過濾掉時才 json.dumps"""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any) -> None:
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj, ensure_ascii=False, default=str)
+
+
+class LazyBytes:
+    """已編碼的 request body 之類的大段 bytes，紀錄沒被過濾掉時才解碼，而且只解碼會被保留的前段"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def __str__(self) -> str:
+        if MAX_MESSAGE_CHARS <= 0:
+            return self.data.decode("utf-8", "replace")
+        # UTF-8 一個字最多 4 bytes
+        limit = MAX_MESSAGE_CHARS * 4
+        text = self.data[:limit].decode("utf-8", "ignore")
+        if len(self.data) <= limit and len(text) <= MAX_MESSAGE_CHARS:
+            return text
+        return f"{text[:MAX_MESSAGE_CHARS]}...({len(self.data)} bytes)"
+
+
+class EncodedPayload(str):
+    """已經序列化 (必要時截斷) 的 payload JSON"""
+
+
+def encode_payload(payload: Any) -> EncodedPayload:
+    if isinstance(payload, EncodedPayload):
+        return payload
+    encoded = str(LazyJson(payload))
+    if MAX_MESSAGE_CHARS > 0 and len(encoded) > MAX_MESSAGE_CHARS:
+        # 太長時改成截斷後的字串，仍然是合法的 JSON
+        encoded = json.dumps(truncate(encoded), ensure_ascii=False)
+    return EncodedPayload(encoded)
+
+
+def _payload(record: logging.LogRecord) -> Optional[EncodedPayload]:
+    # 用 extra={"payload": ...} 附帶的結構化資料
+    payload = getattr(record, "payload", None)
+    return None if payload is None else encode_payload(payload)
+
+
+class JsonFormatter(logging.Formatter):
+    """每筆紀錄一行 JSON (JSON Lines)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": truncate(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and key != "payload":
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        line = json.dumps(data, ensure_ascii=False, default=str)
+        payload = _payload(record)
+        if payload is None:
+            return line
+        # payload 只序列化一次直接接在後面
+        return f'{line[:-1]}, "payload": {payload}}}'
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__(fmt="%(asctime)s %(levelname)s %(name)s - %(message)s", datefmt="%H:%M:%S")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = truncate(super().format(record))
+        payload = _payload(record)
+        if payload is not None:
+            text += " " + payload
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """DEBUG 紀錄只保留一部分 (LOG_DEBUG_SAMPLE_RATE)，在呼叫端就丟掉，不進佇列"""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+_EXC_FORMATTER = logging.Formatter()
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """只把 record 放進佇列；套用版面與 I/O 都在 QueueListener 的執行緒做，佇列滿了就丟棄並計數"""
+
+    def __init__(self, log_queue: "queue.Queue") -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 與 QueueHandler 相同，在呼叫端先把訊息、payload 與 traceback 固定成字串，
+        # 之後呼叫端再修改 args 或 payload 指向的物件也不影響輸出；加上時間、JSON 等版面仍在 listener 執行緒做
+        record = copy.copy(record)
+        record.msg = truncate(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            record.payload = encode_payload(payload)
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _build_handlers() -> list:
+    handlers = []
+    stream = logging.StreamHandler(stream=sys.stdout)
+    stream.setFormatter(JsonFormatter() if os.getenv("LOG_FORMAT", "text").lower() == "json" else TextFormatter())
+    handlers.append(stream)
+
+    log_file = os.getenv("LOG_FILE")
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        rotating = logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=_int_env("LOG_FILE_MAX_BYTES", 10 * 1024 * 1024),
+            backupCount=_int_env("LOG_FILE_BACKUPS", 5),
+            encoding="utf-8",
+        )
+        # 檔案一律寫 JSON Lines 方便之後分析
+        rotating.setFormatter(JsonFormatter())
+        handlers.append(rotating)
+    return handlers
+
+
 logger = logging.getLogger("aichat")
+listener: Optional[logging.handlers.QueueListener] = None
 if not logger.handlers:
-    handler = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(
-        fmt="%(asctime)s %(levelname)s %(name)s - %(message)s",
-        datefmt="%H:%M:%S",
-    )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    _queue: "queue.Queue" = queue.Queue(maxsize=_int_env("LOG_QUEUE_SIZE", 10000))
+    queue_handler = NonBlockingQueueHandler(_queue)
+    queue_handler.addFilter(SamplingFilter(_float_env("LOG_DEBUG_SAMPLE_RATE", 1.0)))
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(_queue, *_build_handlers(), respect_handler_level=True)
+    listener.start()
+    # 結束時把佇列裡剩下的紀錄寫完
+    atexit.register(listener.stop)
 
 logger.setLevel(_level_from_env())
 logger.propagate = False
-
-
-
@@ -1,78 +1,364 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List, Literal
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Literal, Optional, Sequence, Tuple
 from threading import RLock
 
-# ConversationTurn 現在是一個更通用的字典，因為每個角色的結構都不同
-ConversationTurn = Dict[str, Any]
+from request.config import get_conversation_hot_sessions, get_conversation_shared, get_conversation_sync_ttl
+from request.storage import BatchingWriter, ConversationBackend, create_backend_from_env, create_writer
+from request.tokens import estimate_turn_tokens
+from request.turns import Turn, TurnRing, ROLE_USER, ROLE_MODEL, ROLE_TOOL
+
+# 記憶體中的回合一律是 slots 物件；只有寫進 backend 時才轉成 dict
+ConversationTurn = Turn
+
+# 移出送給模型的歷史窗口 (或被擠出保留上限) 的回合會交給這個 handler (例如背景摘要)
+EvictionHandler = Callable[[str, List[ConversationTurn]], None]
+# 每次寫入後以 (session_id, "turn" | "summary" | "clear", 內容) 通知 (例如背景 checkpoint)
+ChangeHandler = Callable[[str, str, Any], None]
 
 
 class ConversationStore:
-    def __init__(self, max_history_per_session: int = 40) -> None:
-        self._store: Dict[str, List[ConversationTurn]] = {}
+    def __init__(
+        self,
+        max_history_per_session: int = 40,
+        backend: Optional[ConversationBackend] = None,
+        max_hot_sessions: Optional[int] = None,
+        shared: bool = False,
+        sync_ttl: float = 1.0,
+    ) -> None:
+        # 記憶體中只保留最近使用的 session (LRU)，其餘在需要時從 backend 載入尾端
+        self._store: "OrderedDict[str, TurnRing]" = OrderedDict()
         self._lock = RLock()
         self._max = max_history_per_session
+        self._backend = backend or ConversationBackend()
+        self._writer = create_writer(self._backend)
+        self._max_hot = max_hot_sessions
+        self._summaries: Dict[str, str] = {}
+        self._eviction_handler: Optional[EvictionHandler] = None
+        self._change_handler: Optional[ChangeHandler] = None
+        # 多行程共用 backend 時，記錄每個 session 預期的寫入序號；與 backend 不同代表別的行程寫過
+        self._shared = shared and self._backend.shared and self._writer is not None
+        self._heads: Dict[str, int] = {}
+        # 每個 session 上次確認序號的時間；TTL 內不再查 backend
+        self._sync_ttl = sync_ttl
+        self._checked: Dict[str, float] = {}
+        # 每個 session 的 ring 中前幾個回合已經交給 eviction handler；沒有紀錄代表剛從 backend 載入
+        self._folded: Dict[str, int] = {}
+
+    def set_eviction_handler(self, handler: Optional[EvictionHandler]) -> None:
+        self._eviction_handler = handler
+
+    def set_change_handler(self, handler: Optional[ChangeHandler]) -> None:
+        self._change_handler = handler
+
+    def _notify(self, session_id: str, kind: str, payload: Any) -> None:
+        if self._change_handler is not None:
+            self._change_handler(session_id, kind, payload)
+
+    def _turns(self, session_id: str) -> TurnRing:
+        turns = self._store.get(session_id)
+        if turns is not None:
+            self._store.move_to_end(session_id)
+            return turns
+        if self._writer is None:
+            return self._install(session_id, (), 0)
+        # 沒有先 preload 的冷 session 只能在這裡同步載入 (例如在執行緒裡匯入/還原)
+        return self._install(session_id, *self._read_tail(session_id))
+
+    def _read_tail(self, session_id: str) -> Tuple[List[Dict[str, Any]], int]:
+        """確保尚未寫出的回合已落盤，再讀出尾端與寫入序號；會等待寫入執行緒，不要在 event loop 上呼叫"""
+        self._writer.flush()
+        # 先讀序號：讀取期間別的行程寫入時，序號對不上會在下次使用時重新載入
+        head = self._backend.head(session_id) if self._shared else 0
+        return self._backend.load_tail(session_id, self._max), head
+
+    def _install(self, session_id: str, tail: Iterable[Dict[str, Any]], head: int) -> TurnRing:
+        turns = TurnRing(self._max)
+        for data in tail:
+            turn = Turn.from_dict(data)
+            if not turn.tokens:
+                turn.tokens = estimate_turn_tokens(turn)
+            turns.append(turn)
+        if self._shared:
+            self._heads[session_id] = head
+            self._checked[session_id] = time.monotonic()
+        if len(turns):
+            # 載入的回合在變冷前已經處理過窗口外的部分，等第一次取窗口時再定位
+            self._folded.pop(session_id, None)
+        else:
+            self._folded[session_id] = 0
+        self._store[session_id] = turns
+        self._evict()
+        return turns
+
+    async def preload(self, session_id: str) -> None:
+        """把冷 session 的尾端與摘要在執行緒裡載入記憶體，之後同一回合的讀寫都不碰磁碟
+
+        共用模式下熱 session 超過 sync TTL 時也在執行緒裡確認序號，別的行程寫過就重新載入。
+        """
+        if not session_id or self._writer is None:
+            return
+        with self._lock:
+            hot = session_id in self._store and session_id in self._summaries
+            expected = self._heads.get(session_id)
+            if hot and (not self._shared or time.monotonic() - self._checked.get(session_id, 0.0) < self._sync_ttl):
+                return
+        if hot:
+            stale = await asyncio.to_thread(self._is_stale, session_id, expected)
+            with self._lock:
+                if not stale:
+                    self._checked[session_id] = time.monotonic()
+                    return
+                # 其他行程寫過這個 session，丟掉本地快取重新載入；等待期間自己又寫入過就留到下次確認
+                if self._heads.get(session_id) != expected:
+                    return
+                self._forget(session_id)
+        tail, head, summary = await asyncio.to_thread(self._read_cold, session_id)
+        with self._lock:
+            # 等待期間已經有別的呼叫載入或寫入過時以記憶體為準
+            if session_id not in self._store:
+                self._install(session_id, tail, head)
+            self._summaries.setdefault(session_id, summary)
+
+    def _is_stale(self, session_id: str, expected: Optional[int]) -> bool:
+        self._writer.flush()
+        return self._backend.head(session_id) != expected
+
+    def _read_cold(self, session_id: str) -> Tuple[List[Dict[str, Any]], int, str]:
+        tail, head = self._read_tail(session_id)
+        return tail, head, self._backend.load_summary(session_id)
+
+    def _forget(self, session_id: str) -> None:
+        self._store.pop(session_id, None)
+        self._summaries.pop(session_id, None)
+        self._heads.pop(session_id, None)
+        self._checked.pop(session_id, None)
+        self._folded.pop(session_id, None)
+
+    def _advance(self, session_id: str) -> None:
+        if not self._shared:
+            return
+        # 自己的寫入也會推進 backend 的序號，本地跟著加一；寫入照常批次送出，不在這裡等待
+        if session_id in self._heads:
+            self._heads[session_id] += 1
+
+    def _evict(self) -> None:
+        # 純記憶體模式沒有地方可以放，不做淘汰
+        if self._writer is None or not self._max_hot:
+            return
+        while len(self._store) > self._max_hot:
+            session_id, _ = self._store.popitem(last=False)
+            self._summaries.pop(session_id, None)
+            self._heads.pop(session_id, None)
+            self._checked.pop(session_id, None)
+            self._folded.pop(session_id, None)
+
+    def _append(self, session_id: str, turn: Turn) -> None:
+        # token 數只在寫入時估算一次並快取在回合上
+        turn.tokens = estimate_turn_tokens(turn)
+        evicted = self._turns(session_id).append(turn)
+        if evicted is not None and not self._shift_folded(session_id) and self._eviction_handler is not None:
+            self._eviction_handler(session_id, [evicted])
+        if self._writer is not None:
+            self._writer.append(session_id, turn.to_dict())
+            self._advance(session_id)
+        self._notify(session_id, "turn", turn)
+
+    def _shift_folded(self, session_id: str) -> bool:
+        """ring 擠掉最舊的回合後調整紀錄；回傳該回合是否已經交給過 handler"""
+        folded = self._folded.get(session_id)
+        if folded is None:
+            return True
+        if folded > 0:
+            self._folded[session_id] = folded - 1
+            return True
+        return False
 
     def add_turn(self, session_id: str, role: Literal["user", "model"], text: str) -> None:
         """儲存使用者輸入或模型的文字回應"""
         if not session_id:
             return
         with self._lock:
-            turns = self._store.setdefault(session_id, [])
-            # 儲存的結構直接對應 API 的 parts 結構
-            turns.append({
-                "role": role,
-                "text": text
-            })
-            if len(turns) > self._max:
-                self._store[session_id] = turns[-self._max:]
-
-    def add_func_call(self, session_id: str, func_name: str, func_args: Dict[str, Any]) -> None:
-        """儲存模型發出的函式呼叫請求"""
+            self._append(session_id, Turn(role=ROLE_USER if role == "user" else ROLE_MODEL, text=text))
+
+    def add_func_calls(self, session_id: str, calls: List[Dict[str, Any]], text: str = "") -> None:
+        """儲存模型一次回應中的多個函式呼叫 (可附帶文字)"""
         if not session_id:
             return
         with self._lock:
-            turns = self._store.setdefault(session_id, [])
-            # 儲存完整的 function_call 物件，角色是 model
-            turns.append({
-                "role": "model",
-                "function_call": {
-                    "name": func_name,
-                    "args": func_args
-                }
-            })
-            if len(turns) > self._max:
-                self._store[session_id] = turns[-self._max:]
-
-    def add_tool_response(self, session_id: str, func_name: str, response_data: Any) -> None:
-        """儲存工具執行後的回應"""
+            self._append(session_id, Turn(
+                role=ROLE_MODEL,
+                text=text or "",
+                function_calls=tuple({"name": c["name"], "args": c.get("args") or {}} for c in calls),
+            ))
+
+    def add_tool_responses(self, session_id: str, responses: List[Dict[str, Any]]) -> None:
+        """儲存同一批工具呼叫的所有回應，對應前一個 model 回合的 function_calls"""
         if not session_id:
             return
         with self._lock:
-            turns = self._store.setdefault(session_id, [])
-            # 儲存完整的 function_response 物件，角色是 tool
-            turns.append({
-                "role": "tool",
-                "function_response": {
-                    "name": func_name,
-                    "response": response_data
-                }
-            })
-            if len(turns) > self._max:
-                self._store[session_id] = turns[-self._max:]
-
-    def get_recent(self, session_id: str, max_turns: int) -> List[ConversationTurn]:
+            self._append(session_id, Turn(
+                role=ROLE_TOOL,
+                function_responses=tuple({"name": r["name"], "response": r["response"]} for r in responses),
+            ))
+
+    def get_recent(self, session_id: str, max_turns: int, max_tokens: Optional[int] = None) -> Sequence[Turn]:
+        """取得最近的回合；有 max_tokens 時回傳不超過預算的最長尾段(至少包含最後一回合)，切點不會落在 function_call 與結果之間
+
+        回傳的是不複製的視圖，只在下一次寫入該 session 前有效，請立即使用。
+        """
+        if not session_id or max_turns <= 0:
+            return ()
+        with self._lock:
+            turns = self._turns(session_id)
+            return turns.view(self._window_start(turns, max_turns, max_tokens))
+
+    def get_window(self, session_id: str, max_turns: int, max_tokens: Optional[int] = None) -> Sequence[Turn]:
+        """同 get_recent，用於實際送給模型的歷史；窗口之前還沒交出去的回合交給 eviction handler 摘要"""
         if not session_id or max_turns <= 0:
-            return []
+            return ()
+        with self._lock:
+            turns = self._turns(session_id)
+            start = self._window_start(turns, max_turns, max_tokens)
+            folded = self._folded.get(session_id)
+            if folded is None:
+                self._folded[session_id] = start
+            elif start > folded:
+                self._folded[session_id] = start
+                if self._eviction_handler is not None:
+                    self._eviction_handler(session_id, list(turns.view(folded, start)))
+            return turns.view(start)
+
+    @staticmethod
+    def _window_start(turns: TurnRing, max_turns: int, max_tokens: Optional[int]) -> int:
+        size = len(turns)
+        lower = max(0, size - max_turns)
+        start = lower
+        if max_tokens and max_tokens > 0:
+            start = size
+            used = 0
+            while start > lower:
+                cost = turns.at(start - 1).tokens
+                if used + cost > max_tokens and start < size:
+                    break
+                used += cost
+                start -= 1
+        return ConversationStore._pair_boundary(turns, start)
+
+    @staticmethod
+    def _pair_boundary(turns: TurnRing, start: int) -> int:
+        """窗口不能從工具結果開始 (對應的 function_call 會被切掉)；往後略過，整段都是工具結果時往前帶上呼叫"""
+        size = len(turns)
+        if start >= size or turns.at(start).role != ROLE_TOOL:
+            return start
+        forward = start
+        while forward < size and turns.at(forward).role == ROLE_TOOL:
+            forward += 1
+        if forward < size:
+            return forward
+        while start > 0 and turns.at(start).role == ROLE_TOOL:
+            start -= 1
+        return start
+
+    def get_summary(self, session_id: str) -> str:
+        if not session_id:
+            return ""
+        with self._lock:
+            summary = self._summaries.get(session_id)
+            if summary is None:
+                summary = ""
+                if self._writer is not None:
+                    self._writer.flush()
+                    summary = self._backend.load_summary(session_id)
+                self._summaries[session_id] = summary
+            return summary
+
+    def set_summary(self, session_id: str, summary: str) -> None:
+        """更新該 session 移出歷史窗口的回合摘要"""
+        if not session_id:
+            return
         with self._lock:
-            turns = self._store.get(session_id, [])
-            return turns[-max_turns:]
+            self._summaries[session_id] = summary
+            if self._writer is not None:
+                self._writer.save_summary(session_id, summary)
+                self._advance(session_id)
+            self._notify(session_id, "summary", summary)
 
     def clear_session(self, session_id: str) -> None:
         if not session_id:
             return
         with self._lock:
-            self._store.pop(session_id, None)
+            self._clear(session_id)
+            self._notify(session_id, "clear", None)
+
+    def _clear(self, session_id: str) -> None:
+        self._forget(session_id)
+        if self._writer is not None:
+            self._writer.clear(session_id)
+
+    def export_turns(self, session_id: str) -> Iterator[Dict[str, Any]]:
+        """session 的完整歷史 (dict 格式)；有 backend 時從 backend 逐頁讀出，純記憶體模式只有保留中的回合
+
+        backend 模式在開始迭代時才等待寫入執行緒並讀檔，請在執行緒裡消費。
+        """
+        if not session_id:
+            return iter(())
+        with self._lock:
+            if self._writer is None:
+                turns = self._store.get(session_id)
+                return iter([turn.to_dict() for turn in turns] if turns is not None else [])
+            writer = self._writer
+        return self._iter_backend(writer, session_id)
+
+    def _iter_backend(self, writer: BatchingWriter, session_id: str) -> Iterator[Dict[str, Any]]:
+        writer.flush()
+        yield from self._backend.iter_turns(session_id)
+
+    def restore(self, session_id: str, turns: Iterable[Dict[str, Any]], replace: bool = False) -> int:
+        """批次寫入匯入/還原的回合；不觸發摘要與變更通知，回傳寫入的回合數"""
+        if not session_id:
+            return 0
+        count = 0
+        with self._lock:
+            if replace:
+                # 清空後不必再讀 backend，直接從空的 ring 開始
+                self._clear(session_id)
+                ring = self._install(session_id, (), 0)
+            else:
+                ring = self._turns(session_id)
+            for data in turns:
+                turn = Turn.from_dict(data)
+                if not turn.tokens:
+                    turn.tokens = estimate_turn_tokens(turn)
+                ring.append(turn)
+                if self._writer is not None:
+                    self._writer.append(session_id, turn.to_dict())
+                count += 1
+            if count:
+                # 匯入的摘要已涵蓋來源窗口之前的回合，等第一次取窗口時再定位
+                self._folded.pop(session_id, None)
+            if self._shared:
+                # 不在這裡等寫入；下次 preload 時確認序號並從 backend 重新載入
+                self._heads.pop(session_id, None)
+                self._checked.pop(session_id, None)
+        return count
+
+    def close(self) -> None:
+        """送出尚未寫入的回合並關閉 backend"""
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            else:
+                self._backend.close()
 
 
-conversation_store = ConversationStore()
\ No newline at end of file
+conversation_store = ConversationStore(
+    backend=create_backend_from_env(),
+    max_hot_sessions=get_conversation_hot_sessions(),
+    shared=get_conversation_shared(),
+    sync_ttl=get_conversation_sync_ttl(),
+)
\ No newline at end of file
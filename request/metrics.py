@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from request.config import get_metrics_window
+from request.logger_setup import logger
+
+LabelKey = Tuple[Tuple[str, str], ...]
+QUANTILES = (0.5, 0.95, 0.99)
+# 各 session 的累計只保留最近活動的這麼多個
+MAX_SESSION_TOTALS = 1024
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Optional[Dict[str, str]] = None) -> str:
+    items = list(key) + sorted((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _quantile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class _Timing:
+    __slots__ = ("count", "total", "window")
+
+    def __init__(self, window: int) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.window: Deque[float] = deque(maxlen=window)
+
+
+class TurnTrace:
+    """單一回合各階段耗時，回合結束時輸出一行結構化紀錄"""
+
+    def __init__(self, session_id: str) -> None:
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "spans_ms": {k: round(v * 1000, 1) for k, v in self.spans.items()},
+        }
+
+
+_current_turn: contextvars.ContextVar[Optional[TurnTrace]] = contextvars.ContextVar("current_turn", default=None)
+
+
+class MetricsRegistry:
+    """行程內的計數器與耗時統計 (滑動視窗分位數)，可輸出 Prometheus 文字格式
+
+    session id 不當成 label (數量沒有上限)；各 session 的累計另外存在 LRU，只給 $stats 查，不輸出給 Prometheus。
+    """
+
+    def __init__(self, window: int = 1024, max_sessions: int = MAX_SESSION_TOTALS) -> None:
+        self._window = window
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._timings: Dict[str, Dict[LabelKey, _Timing]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, float]] = {}
+        self._sessions: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        self._max_sessions = max_sessions
+        self._lock = Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def inc_session(self, session_id: str, name: str, value: float = 1) -> None:
+        with self._lock:
+            totals = self._sessions.get(session_id)
+            if totals is None:
+                totals = self._sessions[session_id] = {}
+                if len(self._sessions) > self._max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            totals[name] = totals.get(name, 0) + value
+
+    def session_totals(self, session_id: str) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._sessions.get(session_id, {}))
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._timings.setdefault(name, {})
+            timing = series.get(key)
+            if timing is None:
+                timing = series[key] = _Timing(self._window)
+            timing.count += 1
+            timing.total += seconds
+            timing.window.append(seconds)
+        trace = _current_turn.get()
+        if trace is not None:
+            trace.add(labels.get("stage", name), seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def stage(self, stage: str, **labels: Any):
+        return self.timer("stage_seconds", stage=stage, **labels)
+
+    def counter_value(self, name: str, **labels: Any) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0)
+
+    def counters(self, name: str) -> Dict[LabelKey, float]:
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def gauges(self, name: str) -> Dict[LabelKey, float]:
+        with self._lock:
+            return dict(self._gauges.get(name, {}))
+
+    def percentiles(self, name: str) -> Dict[LabelKey, Dict[str, float]]:
+        with self._lock:
+            snapshot = {k: (t.count, t.total, sorted(t.window)) for k, t in self._timings.get(name, {}).items()}
+        result: Dict[LabelKey, Dict[str, float]] = {}
+        for key, (count, total, values) in snapshot.items():
+            stats = {"count": count, "sum": total}
+            for q in QUANTILES:
+                stats[f"p{int(q * 100)}"] = _quantile(values, q)
+            result[key] = stats
+        return result
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            gauges = {n: dict(s) for n, s in self._gauges.items()}
+            timings = {n: {k: (t.count, t.total, sorted(t.window)) for k, t in s.items()} for n, s in self._timings.items()}
+        for name, series in sorted(counters.items()):
+            metric = f"aichat_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in series.items():
+                lines.append(f"{metric}{_format_labels(key)} {value}")
+        for name, series in sorted(gauges.items()):
+            metric = f"aichat_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            for key, value in series.items():
+                lines.append(f"{metric}{_format_labels(key)} {value}")
+        for name, series in sorted(timings.items()):
+            metric = f"aichat_{name}"
+            lines.append(f"# TYPE {metric} summary")
+            for key, (count, total, values) in series.items():
+                for q in QUANTILES:
+                    lines.append(f"{metric}{_format_labels(key, {'quantile': str(q)})} {_quantile(values, q):.6f}")
+                lines.append(f"{metric}_sum{_format_labels(key)} {total:.6f}")
+                lines.append(f"{metric}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(window=get_metrics_window())
+
+
+@contextmanager
+def turn_trace(session_id: str) -> Iterator[TurnTrace]:
+    trace = TurnTrace(session_id)
+    token = _current_turn.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_turn.reset(token)
+        metrics.inc("turns")
+        metrics.inc_session(session_id, "turns")
+        metrics.observe("turn_seconds", time.perf_counter() - trace.started)
+        logger.info("turn_timing", extra={"payload": trace.as_dict()})
+
+
+def record_usage(model: str, session_id: Optional[str], data: Dict[str, Any]) -> None:
+    """記錄回應中 usageMetadata 的 token 用量"""
+    usage = data.get("usageMetadata") or {}
+    fields = {
+        "prompt": usage.get("promptTokenCount"),
+        "output": usage.get("candidatesTokenCount"),
+        "cached": usage.get("cachedContentTokenCount"),
+        "total": usage.get("totalTokenCount"),
+    }
+    for kind, value in fields.items():
+        if value:
+            metrics.inc("tokens", value, model=model, kind=kind)
+            if session_id:
+                metrics.inc_session(session_id, f"{kind}_tokens", value)
+
+
+class HttpTrace:
+    """httpx/httpcore 的 trace extension，量測連線建立與 TTFB"""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self._phase_started: Optional[float] = None
+
+    async def __call__(self, event_name: str, info: Dict[str, Any]) -> None:
+        # 只有新建連線時才會出現 connect/TLS 事件；重用連線池時只會有 TTFB
+        now = time.perf_counter()
+        if event_name.endswith("connect_tcp.started") or event_name.endswith("start_tls.started"):
+            self._phase_started = now
+        elif event_name.endswith("connect_tcp.complete") and self._phase_started is not None:
+            metrics.observe("stage_seconds", now - self._phase_started, stage="http_connect")
+        elif event_name.endswith("start_tls.complete") and self._phase_started is not None:
+            metrics.observe("stage_seconds", now - self._phase_started, stage="http_tls")
+        elif event_name.endswith("receive_response_headers.complete"):
+            metrics.observe("stage_seconds", now - self.started, stage="http_ttfb")
+
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.render_prometheus().encode("utf-8")
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode("ascii")
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1") -> asyncio.AbstractServer:
+    server = await asyncio.start_server(_serve_metrics, host, port)
+    logger.info("Prometheus metrics exporter listening on %s:%s", host, port)
+    return server
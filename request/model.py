@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 class ChatRequest(BaseModel):
     prompt: str
@@ -7,14 +7,20 @@ class ChatRequest(BaseModel):
     max_output_tokens: Optional[int] = 12800
     temperature: Optional[float] = 0.7
 
-    toolReturn: Optional[bool] = False
-
     # New optional fields
     session_id: Optional[str] = None
     use_history: Optional[bool] = True
     history_turns: Optional[int] = 10
+    history_token_budget: Optional[int] = None
     system_prompt: Optional[str] = None
     return_raw: Optional[bool] = False
     clear_session: Optional[bool] = False
     tools_declaration: Optional[object] = None
-    function_name: Optional[str] = None
\ No newline at end of file
+    # 多個工具結果: [{"name": ..., "response": {...}}]，一次送回模型
+    tool_responses: Optional[List[Dict[str, Any]]] = None
+    # 限流排隊時的優先序，見 request.rate_limiter 的 PRIORITY_*
+    priority: Optional[int] = 0
+    # 請求種類 (narration / follow_up / summary)，決定用哪一組模型；有指定 model 時不路由
+    route: Optional[str] = None
+    # 發出請求的指令名稱；該指令有啟用 response cache 時，重複的問題直接回覆快取
+    cache_command: Optional[str] = None
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from typing import List
+
+from request.config import get_route_models, get_fallback_models, get_router_prefer_fastest
+from request.model import ChatRequest
+from request.rate_limiter import rate_limiter
+from request.resilience import circuit_breakers
+
+ROUTE_NARRATION = "narration"
+ROUTE_FOLLOW_UP = "follow_up"
+ROUTE_SUMMARY = "summary"
+
+# 少於這麼多成功樣本時不拿延遲來排序
+MIN_LATENCY_SAMPLES = 5
+
+
+class ModelRouter:
+    """依請求種類挑模型：健康的優先，同一層裡偏好近期最快的，最後才用備援模型"""
+
+    def _healthy(self, model: str) -> bool:
+        return circuit_breakers.get(model).available and not rate_limiter.is_throttled(model)
+
+    def _latency(self, model: str) -> float:
+        breaker = circuit_breakers.get(model)
+        if breaker.sample_count < MIN_LATENCY_SAMPLES:
+            # 樣本不足的模型排在前面，讓它累積延遲資料
+            return 0.0
+        return breaker.latency_quantile(0.5) or 0.0
+
+    def _order(self, models: List[str]) -> List[str]:
+        if get_router_prefer_fastest():
+            # sorted 是穩定排序，延遲相同時維持設定順序
+            return sorted(models, key=lambda m: (not self._healthy(m), self._latency(m)))
+        return sorted(models, key=lambda m: not self._healthy(m))
+
+    def candidates(self, req: ChatRequest) -> List[str]:
+        """依嘗試順序回傳這個請求可用的模型"""
+        fallbacks = get_fallback_models()
+        if req.model:
+            primary = [req.model]
+        else:
+            primary = self._order(get_route_models(req.route or ROUTE_NARRATION))
+        ordered = primary + [m for m in self._order(fallbacks) if m not in primary]
+        # 斷路或被限流中的模型挪到最後，只在其他模型也失敗時才試
+        return sorted(ordered, key=lambda m: not self._healthy(m))
+
+
+model_router = ModelRouter()
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import re
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from request.config import get_rate_limit_enabled, get_rate_limit_rpm, get_rate_limit_tpm
+from request.logger_setup import logger
+from request.metrics import metrics
+
+# 數字越小越先送出
+PRIORITY_INTERACTIVE = 0
+PRIORITY_FOLLOW_UP = 1
+PRIORITY_BACKGROUND = 2
+
+# 被 429 時速率乘上的比例，以及每次成功回應加回的比例 (AIMD)
+DECREASE_FACTOR = 0.7
+INCREASE_FRACTION = 0.02
+MIN_RPM = 1.0
+# token bucket 最多累積幾秒的額度
+BURST_SECONDS = 10.0
+DEFAULT_THROTTLE_SECONDS = 2.0
+
+_RETRY_DELAY = re.compile(r"^\s*([0-9.]+)s\s*$")
+
+
+def _limit_for(limits: Dict[str, int], model: str) -> float:
+    return float(limits.get(model, limits.get("*", 0)))
+
+
+def parse_retry_after(headers: Any, body: Any = None) -> Optional[float]:
+    """從 Retry-After header 或 Google 錯誤內容的 RetryInfo.retryDelay 取出建議等待秒數"""
+    raw = headers.get("retry-after") if headers is not None else None
+    if raw:
+        try:
+            return max(0.0, float(raw))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(raw).timestamp() - time.time())
+            except Exception:
+                pass
+    try:
+        details = (body or {}).get("error", {}).get("details") or []
+    except AttributeError:
+        return None
+    for detail in details:
+        if isinstance(detail, dict) and detail.get("retryDelay"):
+            m = _RETRY_DELAY.match(str(detail["retryDelay"]))
+            if m:
+                return float(m.group(1))
+    return None
+
+
+class _ModelBucket:
+    def __init__(self, model: str, rpm: float, tpm: float) -> None:
+        self.model = model
+        self.configured_rpm = rpm
+        # 0 表示未設定上限，直到第一次被 429 才從實際流量推估
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_allowance = self._request_capacity()
+        self.token_allowance = self._token_capacity()
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters: List[Tuple[int, int, asyncio.Future, int]] = []
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.sent: Deque[Tuple[float, int]] = deque()
+
+    def _request_capacity(self) -> float:
+        return max(1.0, self.rpm / 60.0 * BURST_SECONDS) if self.rpm else float("inf")
+
+    def _token_capacity(self) -> float:
+        return self.tpm / 60.0 * BURST_SECONDS if self.tpm else float("inf")
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.request_allowance = min(self._request_capacity(), self.request_allowance + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self.token_allowance = min(self._token_capacity(), self.token_allowance + elapsed * self.tpm / 60.0)
+
+    def delay_for(self, tokens: int, now: float) -> float:
+        delay = max(0.0, self.blocked_until - now)
+        if self.rpm and self.request_allowance < 1:
+            delay = max(delay, (1 - self.request_allowance) * 60.0 / self.rpm)
+        if self.tpm:
+            # 單一請求超過整個 bucket 時只等到 bucket 滿，避免永遠等不到
+            need = min(tokens, self._token_capacity())
+            if self.token_allowance < need:
+                delay = max(delay, (need - self.token_allowance) * 60.0 / self.tpm)
+        return delay
+
+    def consume(self, tokens: int, now: float) -> None:
+        if self.rpm:
+            self.request_allowance -= 1
+        if self.tpm:
+            self.token_allowance -= tokens
+        self.sent.append((now, tokens))
+        self.trim(now)
+
+    def trim(self, now: float) -> None:
+        while self.sent and now - self.sent[0][0] > 60.0:
+            self.sent.popleft()
+
+    def per_minute(self, now: float) -> Tuple[int, int]:
+        self.trim(now)
+        return len(self.sent), sum(tokens for _, tokens in self.sent)
+
+    def observed_rpm(self, now: float) -> float:
+        # 剛啟動時視窗不到一分鐘，依實際經過時間換算成每分鐘速率
+        self.trim(now)
+        if not self.sent:
+            return MIN_RPM
+        window = max(1.0, now - self.sent[0][0])
+        return len(self.sent) * 60.0 / window
+
+
+class RateLimiter:
+    """依模型共用的 token bucket 排程器
+
+    所有呼叫者共享同一份額度與 429 退避狀態；等待中的請求依優先序放行，
+    互動回合先於擲骰後續與背景摘要。速率以 AIMD 自動貼近實際配額。
+    """
+
+    def __init__(self) -> None:
+        self._buckets: Dict[str, _ModelBucket] = {}
+        self._seq = itertools.count()
+
+    def _bucket(self, model: str) -> _ModelBucket:
+        bucket = self._buckets.get(model)
+        if bucket is None:
+            bucket = _ModelBucket(model, _limit_for(get_rate_limit_rpm(), model), _limit_for(get_rate_limit_tpm(), model))
+            self._buckets[model] = bucket
+        return bucket
+
+    async def acquire(self, model: str, tokens: int = 0, priority: int = PRIORITY_INTERACTIVE) -> None:
+        if not get_rate_limit_enabled():
+            return
+        bucket = self._bucket(model)
+        now = time.monotonic()
+        bucket.refill(now)
+        if not bucket.waiters and bucket.delay_for(tokens, now) <= 0:
+            bucket.consume(tokens, now)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(bucket.waiters, (priority, next(self._seq), future, tokens))
+        self._update_depth(bucket)
+        if bucket.dispatcher is None or bucket.dispatcher.done():
+            bucket.dispatcher = asyncio.create_task(self._dispatch(bucket))
+        with metrics.stage("rate_limit_wait"):
+            try:
+                await future
+            finally:
+                if not future.done():
+                    # 呼叫端被取消：留在 heap 裡的 future 由 dispatcher 丟掉
+                    future.cancel()
+
+    async def _dispatch(self, bucket: _ModelBucket) -> None:
+        try:
+            while bucket.waiters:
+                priority, _, future, tokens = bucket.waiters[0]
+                if future.done():
+                    heapq.heappop(bucket.waiters)
+                    continue
+                now = time.monotonic()
+                bucket.refill(now)
+                delay = bucket.delay_for(tokens, now)
+                if delay > 0:
+                    # 醒來後重新看 heap 頂端，期間插隊的高優先請求會先放行
+                    await asyncio.sleep(min(delay, 1.0))
+                    continue
+                heapq.heappop(bucket.waiters)
+                bucket.consume(tokens, now)
+                future.set_result(None)
+                self._update_depth(bucket)
+        finally:
+            self._update_depth(bucket)
+
+    def _update_depth(self, bucket: _ModelBucket) -> None:
+        depth = sum(1 for _, _, future, _ in bucket.waiters if not future.done())
+        metrics.set_gauge("scheduler_queue_depth", depth, model=bucket.model)
+
+    def on_response(self, model: str, status_code: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """回報請求結果；429 時回傳所有呼叫者共用的等待秒數"""
+        if not get_rate_limit_enabled():
+            return None
+        bucket = self._bucket(model)
+        now = time.monotonic()
+        if status_code == 429:
+            # 同一波併發請求一起收到 429 時只降速一次
+            if now >= bucket.blocked_until:
+                if not bucket.rpm:
+                    bucket.rpm = max(MIN_RPM, bucket.observed_rpm(now))
+                bucket.rpm = max(MIN_RPM, bucket.rpm * DECREASE_FACTOR)
+            bucket.request_allowance = min(bucket.request_allowance, 0.0)
+            wait = retry_after if retry_after is not None else DEFAULT_THROTTLE_SECONDS
+            bucket.blocked_until = max(bucket.blocked_until, now + wait)
+            metrics.inc("rate_limited", model=model)
+            metrics.set_gauge("scheduler_rpm", bucket.rpm, model=model)
+            logger.info("Rate limited on %s, lowering to %.1f rpm and pausing %.2fs", model, bucket.rpm, wait)
+            return max(0.0, bucket.blocked_until - now)
+        if 200 <= status_code < 300 and bucket.rpm:
+            step = (bucket.configured_rpm or bucket.rpm) * INCREASE_FRACTION
+            ceiling = bucket.configured_rpm or float("inf")
+            bucket.rpm = min(ceiling, bucket.rpm + step)
+            metrics.set_gauge("scheduler_rpm", bucket.rpm, model=model)
+        return None
+
+    def is_throttled(self, model: str) -> bool:
+        """該模型目前是否因 429 暫停送出"""
+        bucket = self._buckets.get(model)
+        return bucket is not None and bucket.blocked_until > time.monotonic()
+
+    def queue_depth(self, model: Optional[str] = None) -> int:
+        buckets = [self._buckets[model]] if model in self._buckets else ([] if model else list(self._buckets.values()))
+        return sum(1 for b in buckets for _, _, future, _ in b.waiters if not future.done())
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        result: Dict[str, Dict[str, float]] = {}
+        for model, bucket in self._buckets.items():
+            requests, tokens = bucket.per_minute(now)
+            result[model] = {
+                "rpm_limit": bucket.rpm,
+                "requests_last_minute": requests,
+                "tokens_last_minute": tokens,
+                "queue_depth": self.queue_depth(model),
+                "blocked_seconds": max(0.0, bucket.blocked_until - now),
+            }
+        return result
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import contextvars
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Optional, Tuple
+
+from request.config import (
+    get_circuit_error_ratio,
+    get_circuit_min_requests,
+    get_circuit_window_seconds,
+    get_circuit_open_seconds,
+    get_hedge_enabled,
+    get_hedge_min_delay,
+    get_hedge_min_samples,
+)
+from request.logger_setup import logger
+from request.metrics import metrics, QUANTILES
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 避險請求的延遲取成功請求耗時的這個分位數
+HEDGE_QUANTILE = 0.95
+LATENCY_WINDOW = 200
+
+
+class DeadlineExceeded(Exception):
+    """本回合的時間預算已用完"""
+
+
+class CircuitOpenError(Exception):
+    """模型端點的斷路器打開中，暫時不送請求"""
+
+    def __init__(self, key: str, retry_in: float) -> None:
+        super().__init__(f"circuit for {key} is open, retry in {retry_in:.1f}s")
+        self.key = key
+        self.retry_in = retry_in
+
+
+class ModelUnavailableError(Exception):
+    """模型在重試後仍回傳配額不足或伺服器錯誤，可以改用其他模型"""
+
+    def __init__(self, model: str, status_code: int, body: str) -> None:
+        super().__init__(body)
+        self.model = model
+        self.status_code = status_code
+
+
+# ---- deadline ----
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float] = None, at: Optional[float] = None) -> Iterator[None]:
+    """設定目前工作的截止時間 (time.perf_counter 時間軸)，巢狀時取較早者"""
+    if at is None and seconds is not None and seconds > 0:
+        at = time.perf_counter() + seconds
+    current = _deadline.get()
+    if at is None or (current is not None and current <= at):
+        yield
+        return
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """距離截止還有幾秒；沒有設定截止時間時回傳 None"""
+    at = _deadline.get()
+    if at is None:
+        return None
+    return at - time.perf_counter()
+
+
+def check_deadline() -> Optional[float]:
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        metrics.inc("deadline_exceeded")
+        raise DeadlineExceeded("turn deadline exceeded")
+    return remaining
+
+
+def bounded_timeout(default: float) -> float:
+    """HTTP timeout 不超過剩餘的時間預算"""
+    remaining = check_deadline()
+    return default if remaining is None else max(0.001, min(default, remaining))
+
+
+# ---- circuit breaker ----
+
+class CircuitBreaker:
+    """以滑動時間視窗的錯誤比例開關；打開一段時間後只放一個探測請求 (half-open)"""
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def _trim(self, now: float) -> None:
+        window = get_circuit_window_seconds()
+        while self._outcomes and now - self._outcomes[0][0] > window:
+            self._outcomes.popleft()
+
+    def before_request(self) -> None:
+        now = time.monotonic()
+        if self.state == OPEN:
+            retry_in = self.opened_at + get_circuit_open_seconds() - now
+            if retry_in > 0:
+                metrics.inc("circuit_rejected", key=self.key)
+                raise CircuitOpenError(self.key, retry_in)
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                metrics.inc("circuit_rejected", key=self.key)
+                raise CircuitOpenError(self.key, 0.0)
+            self._probe_in_flight = True
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        now = time.monotonic()
+        if ok and latency is not None:
+            self._latencies.append(latency)
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self._outcomes.clear()
+            self._transition(CLOSED if ok else OPEN, now)
+            return
+        self._outcomes.append((now, ok))
+        self._trim(now)
+        if self.state == CLOSED and not ok:
+            failures = sum(1 for _, success in self._outcomes if not success)
+            total = len(self._outcomes)
+            if total >= get_circuit_min_requests() and failures / total >= get_circuit_error_ratio():
+                self._transition(OPEN, now)
+
+    def release_probe(self) -> None:
+        # 探測請求在沒有結果前被取消，讓下一個請求接手探測
+        self._probe_in_flight = False
+
+    def _transition(self, state: str, now: Optional[float] = None) -> None:
+        if state == self.state:
+            return
+        logger.warning("Circuit %s: %s -> %s", self.key, self.state, state)
+        self.state = state
+        if state == OPEN:
+            self.opened_at = now if now is not None else time.monotonic()
+        metrics.inc("circuit_transitions", key=self.key, state=state)
+        metrics.set_gauge("circuit_open", 0 if state == CLOSED else 1, key=self.key)
+
+    @property
+    def available(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= get_circuit_open_seconds()
+        return not self._probe_in_flight
+
+    @property
+    def sample_count(self) -> int:
+        return len(self._latencies)
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    def hedge_delay(self) -> Optional[float]:
+        """可以避險時回傳第二個請求的延遲；樣本不足或斷路器不是 closed 時回傳 None"""
+        if not get_hedge_enabled() or self.state != CLOSED:
+            return None
+        if len(self._latencies) < get_hedge_min_samples():
+            return None
+        return max(get_hedge_min_delay(), self.latency_quantile(HEDGE_QUANTILE) or 0.0)
+
+
+class CircuitBreakerRegistry:
+    def __init__(self) -> None:
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, key: str) -> CircuitBreaker:
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker(key)
+        return breaker
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        result: Dict[str, Dict[str, object]] = {}
+        for key, breaker in self._breakers.items():
+            stats: Dict[str, object] = {"state": breaker.state}
+            for q in QUANTILES:
+                stats[f"p{int(q * 100)}"] = breaker.latency_quantile(q)
+            result[key] = stats
+        return result
+
+
+circuit_breakers = CircuitBreakerRegistry()
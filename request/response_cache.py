@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from request.config import (
+    get_response_cache_enabled,
+    get_response_cache_commands,
+    get_response_cache_ttl_seconds,
+    get_response_cache_max_entries,
+    get_response_cache_similarity,
+    get_response_cache_history_turns,
+)
+from request.metrics import metrics
+
+# MinHash 參數：NUM_PERM 個雜湊分成 BANDS 段做 LSH，相似度夠高的問題才會落在同一個桶
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 2
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def _permutations() -> List[Tuple[int, int]]:
+    # 固定的 (a, b) 係數，讓同一段文字每次得到相同的簽章
+    params = []
+    for i in range(NUM_PERM):
+        digest = hashlib.blake2b(f"minhash-{i}".encode("ascii"), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "big") % _MERSENNE_PRIME or 1
+        b = int.from_bytes(digest[8:], "big") % _MERSENNE_PRIME
+        params.append((a, b))
+    return params
+
+
+_PERMUTATIONS = _permutations()
+_PUNCTUATION = re.compile(r"[\W_]+", re.UNICODE)
+
+TIER_EXACT = "exact"
+TIER_SIMILAR = "similar"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """全半形統一、轉小寫、去掉標點與空白，讓只差格式的問題視為相同"""
+    text = unicodedata.normalize("NFKC", prompt).lower()
+    return _PUNCTUATION.sub("", text)
+
+
+def shingles(normalized: str) -> FrozenSet[str]:
+    # 中文沒有空白分詞，直接用字元 n-gram
+    if len(normalized) <= SHINGLE_SIZE:
+        return frozenset([normalized]) if normalized else frozenset()
+    return frozenset(normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1))
+
+
+def minhash(items: Iterable[str]) -> Tuple[int, ...]:
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in items]
+    if not hashes:
+        return (0,) * NUM_PERM
+    return tuple(min((a * h + b) % _MERSENNE_PRIME & _MAX_HASH for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def _bands(signature: Tuple[int, ...]) -> List[Tuple[int, ...]]:
+    return [signature[i * ROWS:(i + 1) * ROWS] for i in range(BANDS)]
+
+
+@lru_cache(maxsize=64)
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def context_key(system_prompt: Optional[str], history: Iterable[str], route: Optional[str] = None) -> str:
+    """system prompt + 相關歷史 + 路由的指紋；不同情境下的同一個問題不會互相命中"""
+    digest = hashlib.sha256(_text_hash(system_prompt or "").encode("ascii"))
+    digest.update((route or "").encode("utf-8"))
+    for item in history:
+        digest.update(b"\x00")
+        digest.update(item.encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+@dataclass
+class _Entry:
+    key: str
+    context: str
+    shingles: FrozenSet[str]
+    bands: List[Tuple[int, ...]]
+    text: str
+    created: float
+
+
+@dataclass
+class CacheLookup:
+    """一次查詢的結果；miss 時保留 key 與正規化後的問題，回應後直接用來寫入"""
+
+    context: str
+    key: str
+    normalized: str
+    text: Optional[str] = None
+    tier: Optional[str] = None
+    similarity: float = 0.0
+
+    @property
+    def hit(self) -> bool:
+        return self.text is not None
+
+
+class ResponseCache:
+    """重複的規則/設定問題直接回覆：先比對正規化後完全相同的問題，再用 MinHash 找字面相近的問題
+
+    以 LRU + TTL 淘汰；哪些指令使用快取由 RESPONSE_CACHE_COMMANDS 決定，也可以在執行中切換。
+    """
+
+    def __init__(self) -> None:
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[str]] = {}
+        self._overrides: Dict[str, bool] = {}
+
+    def enabled_for(self, command: Optional[str]) -> bool:
+        if not command or not get_response_cache_enabled():
+            return False
+        if command in self._overrides:
+            return self._overrides[command]
+        return command in get_response_cache_commands()
+
+    def set_enabled(self, command: str, enabled: bool) -> None:
+        self._overrides[command] = enabled
+
+    @staticmethod
+    def history_turns() -> int:
+        return get_response_cache_history_turns()
+
+    def lookup(self, prompt: str, context: str) -> CacheLookup:
+        normalized = normalize_prompt(prompt)
+        key = f"{context}:{_text_hash(normalized)}"
+        result = CacheLookup(context=context, key=key, normalized=normalized)
+        if not normalized:
+            return result
+
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and not self._expired(entry, now):
+            self._entries.move_to_end(key)
+            result.text, result.tier, result.similarity = entry.text, TIER_EXACT, 1.0
+            metrics.inc("response_cache", tier=TIER_EXACT)
+            return result
+
+        threshold = get_response_cache_similarity()
+        if 0 < threshold < 1:
+            best = self._similar(context, shingles(normalized), threshold, now)
+            if best is not None:
+                entry, similarity = best
+                self._entries.move_to_end(entry.key)
+                result.text, result.tier, result.similarity = entry.text, TIER_SIMILAR, similarity
+                metrics.inc("response_cache", tier=TIER_SIMILAR)
+                return result
+
+        metrics.inc("response_cache", tier="miss")
+        return result
+
+    def _similar(self, context: str, query: FrozenSet[str], threshold: float, now: float) -> Optional[Tuple[_Entry, float]]:
+        candidates: Set[str] = set()
+        for index, band in enumerate(_bands(minhash(query))):
+            candidates.update(self._buckets.get((context, index, band), ()))
+        best: Optional[Tuple[_Entry, float]] = None
+        for key in candidates:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry, now):
+                continue
+            # LSH 只負責找候選，實際相似度用 shingle 的 Jaccard 確認
+            union = len(query | entry.shingles)
+            similarity = len(query & entry.shingles) / union if union else 0.0
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (entry, similarity)
+        return best
+
+    def store(self, lookup: CacheLookup, text: str) -> None:
+        if not lookup.normalized or not text:
+            return
+        self._remove(lookup.key)
+        grams = shingles(lookup.normalized)
+        entry = _Entry(lookup.key, lookup.context, grams, _bands(minhash(grams)), text, time.monotonic())
+        self._entries[lookup.key] = entry
+        for index, band in enumerate(entry.bands):
+            self._buckets.setdefault((entry.context, index, band), set()).add(entry.key)
+        limit = get_response_cache_max_entries()
+        while len(self._entries) > limit:
+            self._remove(next(iter(self._entries)))
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        if now - entry.created <= get_response_cache_ttl_seconds():
+            return False
+        self._remove(entry.key)
+        return True
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for index, band in enumerate(entry.bands):
+            bucket = self._buckets.get((entry.context, index, band))
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[(entry.context, index, band)]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from request.config import get_state_backend, get_state_db_path, get_state_redis_url
+from request.logger_setup import logger
+
+Updater = Callable[[Optional[Any]], Any]
+# 欄位 -> 新的值；None 代表刪除該欄位
+FieldChanges = Dict[str, Optional[Any]]
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+class StateStore:
+    """遊戲狀態 (戰鬥、角色) 的 key/value 介面，值一律是可 JSON 序列化的物件
+
+    預設實作放在行程記憶體裡；多個行程共用時改用 SQLite 或 Redis 相容的實作。
+    除了整個值的 get/set，也可以把一個 key 當成欄位表 (Redis hash) 逐欄讀寫，只改一個欄位時不必重寫整份。
+    共用的實作會等待鎖或網路，在 event loop 上一律呼叫 a 開頭的 async 版本，阻塞的部分在執行緒裡執行。
+    """
+
+    shared = False
+
+    def __init__(self) -> None:
+        self._data: Dict[str, str] = {}
+        self._fields: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            raw = self._data.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = json.dumps(value, ensure_ascii=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._fields.pop(key, None)
+
+    def update(self, key: str, updater: Updater) -> Any:
+        """原子地讀出、修改並寫回；updater 收到目前的值 (或 None) 並回傳新值"""
+        with self._lock:
+            raw = self._data.get(key)
+            value = updater(json.loads(raw) if raw is not None else None)
+            self._data[key] = json.dumps(value, ensure_ascii=False)
+        return value
+
+    def get_field(self, key: str, field: str) -> Optional[Any]:
+        with self._lock:
+            raw = self._fields.get(key, {}).get(field)
+        return json.loads(raw) if raw is not None else None
+
+    def get_fields(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            fields = dict(self._fields.get(key, {}))
+        return {name: json.loads(raw) for name, raw in fields.items()}
+
+    def set_fields_if(self, key: str, field: str, expected: Optional[Any], changes: FieldChanges, replace: bool = False) -> bool:
+        """field 目前的值等於 expected (不存在時是 None) 才原子地套用 changes，回傳是否寫入
+
+        replace=True 時先清掉 key 的所有欄位，等於整份取代。
+        """
+        with self._lock:
+            fields = self._fields.get(key, {})
+            raw = fields.get(field)
+            if (json.loads(raw) if raw is not None else None) != expected:
+                return False
+            fields = {} if replace else dict(fields)
+            for name, value in changes.items():
+                if value is None:
+                    fields.pop(name, None)
+                else:
+                    fields[name] = _dumps(value)
+            self._fields[key] = fields
+        return True
+
+    def close(self) -> None:
+        pass
+
+    async def _call(self, func: Callable[..., Any], *args: Any) -> Any:
+        # 行程內的實作只是一把鎖與 dict，直接執行比切換執行緒便宜
+        if not self.shared:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return await self._call(self.get, key)
+
+    async def aset(self, key: str, value: Any) -> None:
+        await self._call(self.set, key, value)
+
+    async def adelete(self, key: str) -> None:
+        await self._call(self.delete, key)
+
+    async def aupdate(self, key: str, updater: Updater) -> Any:
+        """同 update；共用的實作中 updater 在執行緒裡執行，不要在裡面碰 event loop 上的物件"""
+        return await self._call(self.update, key, updater)
+
+    async def aget_field(self, key: str, field: str) -> Optional[Any]:
+        return await self._call(self.get_field, key, field)
+
+    async def aget_fields(self, key: str) -> Dict[str, Any]:
+        return await self._call(self.get_fields, key)
+
+    async def aset_fields_if(self, key: str, field: str, expected: Optional[Any], changes: FieldChanges, replace: bool = False) -> bool:
+        return await self._call(self.set_fields_if, key, field, expected, changes, replace)
+
+
+class SQLiteStateStore(StateStore):
+    """同一台機器上多個行程共用的 SQLite (WAL) 實作，update 以 BEGIN IMMEDIATE 取得寫鎖"""
+
+    shared = True
+
+    def __init__(self, path: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state_fields ("
+                " key TEXT NOT NULL,"
+                " field TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " PRIMARY KEY (key, field))"
+            )
+
+    def _read(self, key: str) -> Optional[Any]:
+        row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, key: str, value: Any) -> None:
+        self._conn.execute(
+            "INSERT INTO state (key, value) VALUES (?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value, ensure_ascii=False)),
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            return self._read(key)
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._write(key, value)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+                self._conn.execute("DELETE FROM state_fields WHERE key = ?", (key,))
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def update(self, key: str, updater: Updater) -> Any:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = updater(self._read(key))
+                self._write(key, value)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return value
+
+    def _read_field(self, key: str, field: str) -> Optional[Any]:
+        row = self._conn.execute(
+            "SELECT value FROM state_fields WHERE key = ? AND field = ?", (key, field)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_field(self, key: str, field: str) -> Optional[Any]:
+        with self._lock:
+            return self._read_field(key, field)
+
+    def get_fields(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT field, value FROM state_fields WHERE key = ?", (key,)).fetchall()
+        return {field: json.loads(raw) for field, raw in rows}
+
+    def set_fields_if(self, key: str, field: str, expected: Optional[Any], changes: FieldChanges, replace: bool = False) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._read_field(key, field) != expected:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                if replace:
+                    self._conn.execute("DELETE FROM state_fields WHERE key = ?", (key,))
+                removed = [(key, name) for name, value in changes.items() if value is None]
+                written = [(key, name, _dumps(value)) for name, value in changes.items() if value is not None]
+                if removed:
+                    self._conn.executemany("DELETE FROM state_fields WHERE key = ? AND field = ?", removed)
+                if written:
+                    self._conn.executemany(
+                        "INSERT INTO state_fields (key, field, value) VALUES (?, ?, ?)"
+                        " ON CONFLICT(key, field) DO UPDATE SET value = excluded.value",
+                        written,
+                    )
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisStateStore(StateStore):
+    """Redis (或相容服務) 實作，update 用 WATCH/MULTI 樂觀鎖，衝突時重試"""
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "trpg:") -> None:
+        import redis  # 選用相依，只有設定 STATE_BACKEND=redis 時才需要
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._watch_error = redis.WatchError
+
+    def get(self, key: str) -> Optional[Any]:
+        raw = self._client.get(self._prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any) -> None:
+        self._client.set(self._prefix + key, json.dumps(value, ensure_ascii=False))
+
+    def delete(self, key: str) -> None:
+        self._client.delete(self._prefix + key)
+
+    def update(self, key: str, updater: Updater) -> Any:
+        name = self._prefix + key
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.get(name)
+                    value = updater(json.loads(raw) if raw is not None else None)
+                    pipe.multi()
+                    pipe.set(name, json.dumps(value, ensure_ascii=False))
+                    pipe.execute()
+                    return value
+                except self._watch_error:
+                    continue
+
+    def get_field(self, key: str, field: str) -> Optional[Any]:
+        raw = self._client.hget(self._prefix + key, field)
+        return json.loads(raw) if raw is not None else None
+
+    def get_fields(self, key: str) -> Dict[str, Any]:
+        fields = self._client.hgetall(self._prefix + key)
+        return {name.decode("utf-8") if isinstance(name, bytes) else name: json.loads(raw) for name, raw in fields.items()}
+
+    def set_fields_if(self, key: str, field: str, expected: Optional[Any], changes: FieldChanges, replace: bool = False) -> bool:
+        name = self._prefix + key
+        removed = [f for f, value in changes.items() if value is None]
+        written = {f: _dumps(value) for f, value in changes.items() if value is not None}
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.hget(name, field)
+                    if (json.loads(raw) if raw is not None else None) != expected:
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    if replace:
+                        pipe.delete(name)
+                    if removed:
+                        pipe.hdel(name, *removed)
+                    if written:
+                        pipe.hset(name, mapping=written)
+                    pipe.execute()
+                    return True
+                except self._watch_error:
+                    continue
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def create_state_store_from_env() -> StateStore:
+    kind = get_state_backend()
+    if kind == "sqlite":
+        return SQLiteStateStore(get_state_db_path())
+    if kind == "redis":
+        try:
+            return RedisStateStore(get_state_redis_url())
+        except ImportError:
+            logger.warning("STATE_BACKEND=redis but the redis package is not installed, using memory")
+            return StateStore()
+    if kind != "memory":
+        logger.warning("Unknown STATE_BACKEND '%s', using memory", kind)
+    return StateStore()
+
+
+state_store = create_state_store_from_env()
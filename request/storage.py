@@ -0,0 +1,343 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from queue import Queue, Empty
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from request.config import (
+    get_conversation_backend,
+    get_conversation_db_path,
+    get_conversation_log_dir,
+    get_conversation_flush_interval,
+    get_conversation_flush_batch,
+)
+from request.logger_setup import logger
+
+ConversationTurn = Dict[str, Any]
+
+
+class ConversationBackend:
+    """對話持久化介面；預設實作什麼都不做(純記憶體)"""
+
+    persistent = False
+    # 可以被多個行程同時使用，並提供 head() 判斷別的行程是否寫過
+    shared = False
+
+    def load_tail(self, session_id: str, limit: int) -> List[ConversationTurn]:
+        return []
+
+    def iter_turns(self, session_id: str) -> Iterator[ConversationTurn]:
+        """依序走過 session 的完整歷史 (匯出用)"""
+        return iter(())
+
+    def append(self, items: List[Tuple[str, ConversationTurn]]) -> None:
+        pass
+
+    def clear(self, session_id: str) -> None:
+        pass
+
+    def load_summary(self, session_id: str) -> str:
+        return ""
+
+    def save_summary(self, session_id: str, summary: str) -> None:
+        pass
+
+    def head(self, session_id: str) -> int:
+        """session 的寫入序號，每次 append 一個回合、clear 或更新摘要都會增加"""
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBackend(ConversationBackend):
+    """SQLite (WAL) 後端，每個回合一列，只追加不改寫"""
+
+    persistent = True
+    shared = True
+
+    def __init__(self, path: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            # 多個行程共用時，遇到別的行程持有寫鎖就等待而不是立刻失敗
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " session_id TEXT NOT NULL,"
+                " payload TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_turns_session ON turns(session_id, id)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                " session_id TEXT PRIMARY KEY,"
+                " summary TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_heads ("
+                " session_id TEXT PRIMARY KEY,"
+                " seq INTEGER NOT NULL)"
+            )
+
+    def load_tail(self, session_id: str, limit: int) -> List[ConversationTurn]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT payload FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def iter_turns(self, session_id: str, page_size: int = 500) -> Iterator[ConversationTurn]:
+        # 依 id 分頁讀取，每頁之間放開鎖，匯出大 session 時不會卡住寫入
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, payload FROM turns WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?",
+                    (session_id, last_id, page_size),
+                ).fetchall()
+            for row_id, payload in rows:
+                yield json.loads(payload)
+                last_id = row_id
+            if len(rows) < page_size:
+                return
+
+    def append(self, items: List[Tuple[str, ConversationTurn]]) -> None:
+        rows = [(sid, json.dumps(turn, ensure_ascii=False)) for sid, turn in items]
+        counts: Dict[str, int] = {}
+        for sid, _ in items:
+            counts[sid] = counts.get(sid, 0) + 1
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT INTO turns (session_id, payload) VALUES (?, ?)", rows)
+                self._bump(counts.items())
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _bump(self, counts) -> None:
+        self._conn.executemany(
+            "INSERT INTO session_heads (session_id, seq) VALUES (?, ?)"
+            " ON CONFLICT(session_id) DO UPDATE SET seq = seq + excluded.seq",
+            list(counts),
+        )
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                self._conn.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+                self._bump([(session_id, 1)])
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def load_summary(self, session_id: str) -> str:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary FROM summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0] if row else ""
+
+    def save_summary(self, session_id: str, summary: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO summaries (session_id, summary) VALUES (?, ?)"
+                    " ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary",
+                    (session_id, summary),
+                )
+                self._bump([(session_id, 1)])
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def head(self, session_id: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT seq FROM session_heads WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class AppendLogBackend(ConversationBackend):
+    """每個 session 一個 JSON Lines 檔，只在檔尾追加"""
+
+    persistent = True
+
+    def __init__(self, directory: str) -> None:
+        self._dir = Path(directory)
+        self._dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, session_id: str) -> Path:
+        return self._dir / f"{_SAFE_NAME.sub('_', session_id)}.jsonl"
+
+    def load_tail(self, session_id: str, limit: int) -> List[ConversationTurn]:
+        path = self._path(session_id)
+        if limit <= 0 or not path.exists():
+            return []
+        # 從檔尾往回讀，只讀到足夠的行數
+        block = 8192
+        data = b""
+        with path.open("rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            while pos > 0 and data.count(b"\n") <= limit:
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        lines = [line for line in data.splitlines() if line.strip()]
+        if pos > 0:
+            lines = lines[1:]
+        return [json.loads(line) for line in lines[-limit:]]
+
+    def iter_turns(self, session_id: str) -> Iterator[ConversationTurn]:
+        path = self._path(session_id)
+        if not path.exists():
+            return
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def append(self, items: List[Tuple[str, ConversationTurn]]) -> None:
+        grouped: Dict[str, List[str]] = {}
+        for sid, turn in items:
+            grouped.setdefault(sid, []).append(json.dumps(turn, ensure_ascii=False))
+        for sid, lines in grouped.items():
+            with self._path(sid).open("a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+    def _summary_path(self, session_id: str) -> Path:
+        return self._dir / f"{_SAFE_NAME.sub('_', session_id)}.summary.txt"
+
+    def clear(self, session_id: str) -> None:
+        for path in (self._path(session_id), self._summary_path(session_id)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def load_summary(self, session_id: str) -> str:
+        try:
+            return self._summary_path(session_id).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return ""
+
+    def save_summary(self, session_id: str, summary: str) -> None:
+        # 摘要是整份覆寫，先寫暫存檔再替換避免寫到一半
+        path = self._summary_path(session_id)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(summary, encoding="utf-8")
+        os.replace(tmp, path)
+
+
+class BatchingWriter:
+    """背景執行緒批次寫入，避免磁碟 I/O 卡住 event loop"""
+
+    def __init__(self, backend: ConversationBackend, interval: float, batch_size: int) -> None:
+        self._backend = backend
+        self._interval = interval
+        self._batch_size = batch_size
+        self._queue: Queue = Queue()
+        self._thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, session_id: str, turn: ConversationTurn) -> None:
+        self._queue.put(("append", session_id, turn))
+
+    def clear(self, session_id: str) -> None:
+        self._queue.put(("clear", session_id, None))
+
+    def save_summary(self, session_id: str, summary: str) -> None:
+        self._queue.put(("summary", session_id, summary))
+
+    def flush(self) -> None:
+        done = threading.Event()
+        self._queue.put(("flush", None, done))
+        done.wait()
+
+    def close(self) -> None:
+        self._queue.put(("stop", None, None))
+        self._thread.join()
+
+    def _run(self) -> None:
+        pending: List[Tuple[str, ConversationTurn]] = []
+        while True:
+            try:
+                op, session_id, payload = self._queue.get(timeout=self._interval)
+            except Empty:
+                self._write(pending)
+                continue
+
+            if op == "append":
+                pending.append((session_id, payload))
+                if len(pending) >= self._batch_size:
+                    self._write(pending)
+                continue
+
+            # 其他操作前先把累積的寫入送出，維持順序
+            self._write(pending)
+            if op == "clear":
+                self._safe(self._backend.clear, session_id)
+            elif op == "summary":
+                self._safe(self._backend.save_summary, session_id, payload)
+            elif op == "flush":
+                payload.set()
+            elif op == "stop":
+                self._safe(self._backend.close)
+                return
+
+    def _write(self, pending: List[Tuple[str, ConversationTurn]]) -> None:
+        if not pending:
+            return
+        batch = list(pending)
+        pending.clear()
+        self._safe(self._backend.append, batch)
+
+    @staticmethod
+    def _safe(func, *args) -> None:
+        try:
+            func(*args)
+        except Exception as exc:
+            logger.exception("Conversation backend error: %s", exc)
+
+
+def create_backend_from_env() -> ConversationBackend:
+    kind = get_conversation_backend()
+    if kind == "sqlite":
+        return SQLiteBackend(get_conversation_db_path())
+    if kind == "log":
+        return AppendLogBackend(get_conversation_log_dir())
+    if kind != "memory":
+        logger.warning("Unknown CONVERSATION_BACKEND '%s', using memory", kind)
+    return ConversationBackend()
+
+
+def create_writer(backend: ConversationBackend) -> Optional[BatchingWriter]:
+    if not backend.persistent:
+        return None
+    return BatchingWriter(backend, get_conversation_flush_interval(), get_conversation_flush_batch())
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, List
+
+from request.config import get_summary_enabled, get_summary_max_tokens
+from request.google_chat import google_request
+from request.logger_setup import logger
+from request.memory import ConversationStore, ConversationTurn, conversation_store
+from request.model import ChatRequest
+from request.turns import ROLE_USER
+from request.model_router import ROUTE_SUMMARY
+from request.rate_limiter import PRIORITY_BACKGROUND
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你是 TRPG 劇情紀錄員。請把「既有摘要」與「新的對話紀錄」合併成一份精簡的劇情摘要，"
+    "保留角色、地點、重要物品、未解的伏筆與檢定結果，省略修辭與重複內容。只輸出摘要本身，使用中文。"
+)
+
+
+def _format_turn(turn: ConversationTurn) -> str:
+    lines: List[str] = []
+    if turn.text:
+        speaker = "玩家" if turn.role == ROLE_USER else "GM"
+        lines.append(f"{speaker}: {turn.text}")
+    for call in turn.function_calls or ():
+        lines.append(f"GM 呼叫 {call.get('name')}({call.get('args')})")
+    for resp in turn.function_responses or ():
+        lines.append(f"{resp.get('name')} 結果: {resp.get('response')}")
+    return "\n".join(lines)
+
+
+class RollingSummarizer:
+    """把移出送出窗口的回合在背景合併成每個 session 的滾動摘要"""
+
+    def __init__(self, store: ConversationStore) -> None:
+        self._store = store
+        self._pending: Dict[str, List[ConversationTurn]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def attach(self) -> None:
+        if get_summary_enabled():
+            self._store.set_eviction_handler(self.schedule)
+
+    def detach(self) -> None:
+        self._store.set_eviction_handler(None)
+
+    def schedule(self, session_id: str, turns: List[ConversationTurn]) -> None:
+        # 由 ConversationStore 同步呼叫，只排程不等待，不佔用回合的關鍵路徑
+        self._pending.setdefault(session_id, []).extend(turns)
+        if session_id in self._tasks:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._tasks[session_id] = loop.create_task(self._run(session_id))
+
+    async def _run(self, session_id: str) -> None:
+        try:
+            while self._pending.get(session_id):
+                turns = self._pending.pop(session_id)
+                if not await self._summarize(session_id, turns):
+                    break
+        finally:
+            self._tasks.pop(session_id, None)
+
+    async def _summarize(self, session_id: str, turns: List[ConversationTurn]) -> bool:
+        await self._store.preload(session_id)
+        previous = self._store.get_summary(session_id)
+        transcript = "\n".join(line for line in map(_format_turn, turns) if line)
+        if not transcript:
+            return True
+        prompt = f"既有摘要:\n{previous or '(無)'}\n\n新的對話紀錄:\n{transcript}"
+        req = ChatRequest(
+            prompt=prompt,
+            route=ROUTE_SUMMARY,
+            system_prompt=SUMMARY_SYSTEM_PROMPT,
+            use_history=False,
+            max_output_tokens=get_summary_max_tokens(),
+            temperature=0.2,
+            priority=PRIORITY_BACKGROUND,
+        )
+        try:
+            resp = await google_request(req)
+        except Exception as exc:
+            # 失敗就把回合放回去，下次有回合移出窗口時一起重試
+            logger.warning("Rolling summary failed for %s: %s", session_id, exc)
+            self._pending.setdefault(session_id, [])[:0] = turns
+            return False
+        summary = (resp.get("text") or "").strip()
+        if summary:
+            self._store.set_summary(session_id, summary)
+            logger.info("Updated rolling summary for %s (%s turns folded)", session_id, len(turns))
+        return True
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+rolling_summarizer = RollingSummarizer(conversation_store)
@@ -0,0 +1,31 @@
+import json
+
+from request.turns import Turn
+
+
+def _is_wide(ch: str) -> bool:
+    code = ord(ch)
+    return (
+        0x3000 <= code <= 0x9FFF
+        or 0xAC00 <= code <= 0xD7AF
+        or 0xF900 <= code <= 0xFAFF
+        or 0xFF00 <= code <= 0xFFEF
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數：中日韓字元約一字一 token，其餘約四個字元一 token"""
+    if not text:
+        return 0
+    wide = sum(1 for ch in text if _is_wide(ch))
+    narrow = len(text) - wide
+    return wide + (narrow + 3) // 4
+
+
+def estimate_turn_tokens(turn: Turn) -> int:
+    text = turn.text or ""
+    for parts in (turn.function_calls, turn.function_responses):
+        if parts:
+            text += json.dumps(parts, ensure_ascii=False)
+    # 每個 content 另有少量結構開銷
+    return estimate_tokens(text) + 4
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import sys
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, overload
+
+ROLE_USER = sys.intern("user")
+ROLE_MODEL = sys.intern("model")
+ROLE_TOOL = sys.intern("tool")
+
+_ROLES = {ROLE_USER: ROLE_USER, ROLE_MODEL: ROLE_MODEL, ROLE_TOOL: ROLE_TOOL}
+
+FunctionParts = Tuple[Dict[str, Any], ...]
+
+
+@dataclass(slots=True)
+class Turn:
+    """一個對話回合。function_call / function_response 一律以 tuple 存放 (單一呼叫就是長度 1)"""
+
+    role: str
+    text: str = ""
+    function_calls: Optional[FunctionParts] = None
+    function_responses: Optional[FunctionParts] = None
+    # 寫入時估算一次的 token 數
+    tokens: int = 0
+    # 送給 API 的 content 編碼結果，第一次組請求時產生後重用
+    encoded: Optional[bytes] = field(default=None, repr=False, compare=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """持久化用的 dict 格式"""
+        data: Dict[str, Any] = {"role": self.role}
+        if self.text:
+            data["text"] = self.text
+        if self.function_calls:
+            data["function_calls"] = list(self.function_calls)
+        if self.function_responses:
+            data["function_responses"] = list(self.function_responses)
+        data["tokens"] = self.tokens
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Turn":
+        # 相容舊格式的單一 function_call / function_response
+        calls = list(data.get("function_calls") or [])
+        if "function_call" in data:
+            calls.insert(0, data["function_call"])
+        responses = list(data.get("function_responses") or [])
+        if "function_response" in data:
+            responses.insert(0, data["function_response"])
+        role = data.get("role") or ROLE_USER
+        return cls(
+            role=_ROLES.get(role, role),
+            text=data.get("text") or "",
+            function_calls=tuple(calls) or None,
+            function_responses=tuple(responses) or None,
+            tokens=int(data.get("tokens") or 0),
+        )
+
+
+class TurnRing:
+    """固定容量的環狀緩衝區，滿了之後新回合直接覆寫最舊的位置，不重建 list"""
+
+    __slots__ = ("_slots", "_start", "_size")
+
+    def __init__(self, capacity: int) -> None:
+        self._slots: List[Optional[Turn]] = [None] * max(1, capacity)
+        self._start = 0
+        self._size = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self._slots)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, turn: Turn) -> Optional[Turn]:
+        """加入一個回合；容量已滿時回傳被擠掉的最舊回合"""
+        capacity = len(self._slots)
+        if self._size < capacity:
+            self._slots[(self._start + self._size) % capacity] = turn
+            self._size += 1
+            return None
+        evicted = self._slots[self._start]
+        self._slots[self._start] = turn
+        self._start = (self._start + 1) % capacity
+        return evicted
+
+    def extend(self, turns: Sequence[Turn]) -> None:
+        for turn in turns:
+            self.append(turn)
+
+    def clear(self) -> None:
+        self._slots = [None] * len(self._slots)
+        self._start = 0
+        self._size = 0
+
+    def at(self, index: int) -> Turn:
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(index)
+        return self._slots[(self._start + index) % len(self._slots)]
+
+    def view(self, start: int = 0, stop: Optional[int] = None) -> "TurnView":
+        stop = self._size if stop is None else min(stop, self._size)
+        start = max(0, min(start, stop))
+        return TurnView(self, start, stop - start)
+
+    def __iter__(self) -> Iterator[Turn]:
+        return iter(self.view())
+
+
+class TurnView(Sequence[Turn]):
+    """TurnRing 某一段的唯讀視圖，不複製回合；ring 之後再寫入會讓視圖內容跟著變動"""
+
+    __slots__ = ("_ring", "_offset", "_length")
+
+    def __init__(self, ring: TurnRing, offset: int, length: int) -> None:
+        self._ring = ring
+        self._offset = offset
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    @overload
+    def __getitem__(self, index: int) -> Turn: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Turn]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._ring.at(self._offset + index)
+
+    def __iter__(self) -> Iterator[Turn]:
+        ring = self._ring
+        for i in range(self._offset, self._offset + self._length):
+            yield ring.at(i)
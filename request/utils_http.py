@@ -1,33 +1,194 @@
 from __future__ import annotations
 
 import asyncio
+import json as jsonlib
 import random
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, AsyncIterator, Optional
 
 import httpx
 
+from request.config import get_timeout_seconds
+from request.http_client import http_client_manager
 from request.logger_setup import logger
+from request.metrics import metrics, HttpTrace
+from request.rate_limiter import rate_limiter, parse_retry_after, PRIORITY_INTERACTIVE
+from request.resilience import (
+    CircuitBreaker,
+    DeadlineExceeded,
+    ModelUnavailableError,
+    bounded_timeout,
+    check_deadline,
+    circuit_breakers,
+    remaining_time,
+)
 
 
 TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
 
 
-async def post_json_with_retries(
+def _estimate_request_tokens(content: bytes) -> int:
+    # 中文 UTF-8 約三個 bytes 一個 token，英文會被高估，對限流來說寧可保守
+    return len(content) // 3
+
+
+def _report_status(model: Optional[str], status_code: int, headers: Any, body: bytes) -> Optional[float]:
+    """把回應狀態交給共用的限流器；429 時回傳所有呼叫者共同的等待秒數"""
+    if not model:
+        return None
+    retry_after = None
+    if status_code == 429:
+        try:
+            retry_after = parse_retry_after(headers, jsonlib.loads(body))
+        except ValueError:
+            retry_after = parse_retry_after(headers)
+    return rate_limiter.on_response(model, status_code, retry_after)
+
+
+async def _acquire(model: Optional[str], tokens: int, priority: int) -> None:
+    # 排隊等額度也算在回合的時間預算內
+    if not model:
+        return
+    remaining = check_deadline()
+    if remaining is None:
+        await rate_limiter.acquire(model, tokens, priority)
+        return
+    try:
+        await asyncio.wait_for(rate_limiter.acquire(model, tokens, priority), timeout=remaining)
+    except asyncio.TimeoutError:
+        metrics.inc("deadline_exceeded")
+        raise DeadlineExceeded("turn deadline exceeded while waiting for rate limiter")
+
+
+async def _sleep_before_retry(delay: float) -> None:
+    remaining = remaining_time()
+    if remaining is not None and delay >= remaining:
+        metrics.inc("deadline_exceeded")
+        raise DeadlineExceeded("turn deadline leaves no time for another retry")
+    await asyncio.sleep(delay)
+
+
+def _record(breaker: Optional[CircuitBreaker], status_code: int, latency: float) -> None:
+    # 429 是配額問題，交給限流器處理，不算端點故障
+    if breaker is not None and status_code != 429:
+        breaker.record(status_code < 500, latency)
+
+
+async def _post_once(
     client: httpx.AsyncClient,
     url: str,
-    json: Dict[str, Any],
+    content: bytes,
+    headers: Dict[str, str],
+    breaker: Optional[CircuitBreaker],
+) -> httpx.Response:
+    timeout = bounded_timeout(get_timeout_seconds())
+    if breaker is not None:
+        breaker.before_request()
+    started = time.perf_counter()
+    try:
+        with metrics.stage("http_total"):
+            response = await client.post(url, content=content, headers=headers, timeout=timeout, extensions={"trace": HttpTrace()})
+    except httpx.RequestError:
+        if breaker is not None:
+            breaker.record(False)
+        raise
+    except BaseException:
+        # 例如避險請求輸掉後被取消
+        if breaker is not None:
+            breaker.release_probe()
+        raise
+    _record(breaker, response.status_code, time.perf_counter() - started)
+    return response
+
+
+async def _post_hedged(
+    client: httpx.AsyncClient,
+    url: str,
+    content: bytes,
+    headers: Dict[str, str],
+    breaker: Optional[CircuitBreaker],
+    model: Optional[str],
+    tokens: int,
+    priority: int,
+) -> httpx.Response:
+    """超過 p95 耗時仍沒有回應就再送一次，取先成功的那個"""
+    delay = breaker.hedge_delay() if breaker is not None else None
+    remaining = remaining_time()
+    if delay is None or (remaining is not None and delay >= remaining) or rate_limiter.queue_depth(model):
+        return await _post_once(client, url, content, headers, breaker)
+
+    async def hedge() -> httpx.Response:
+        await _acquire(model, tokens, priority)
+        return await _post_once(client, url, content, headers, breaker)
+
+    first = asyncio.create_task(_post_once(client, url, content, headers, breaker))
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+        metrics.inc("http_hedges")
+        pending.add(asyncio.create_task(hedge()))
+        fallback: Optional[httpx.Response] = None
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                response = task.result()
+                if response.status_code not in TRANSIENT_STATUS_CODES:
+                    if task is not first:
+                        metrics.inc("http_hedge_wins")
+                    return response
+                fallback = response
+        if fallback is not None:
+            return fallback
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def post_json_with_retries(
+    client: Optional[httpx.AsyncClient],
+    url: str,
+    json: Optional[Dict[str, Any]] = None,
     headers: Optional[Dict[str, str]] = None,
     max_retries: int = 2,
     backoff_base: float = 0.8,
+    model: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    content: Optional[bytes] = None,
 ) -> httpx.Response:
     attempt = 0
     headers = headers or {"content-type": "application/json"}
+    if client is None:
+        client = await http_client_manager.get_client()
+
+    # 只序列化一次，重試時直接重用同一份 bytes；呼叫端也可以直接給已編碼的 content
+    if content is None:
+        with metrics.stage("serialize"):
+            content = jsonlib.dumps(json, ensure_ascii=False).encode("utf-8")
+    tokens = _estimate_request_tokens(content)
+    breaker = circuit_breakers.get(model) if model else None
 
     while True:
+        if breaker is not None and not breaker.available:
+            # 斷路器打開中就直接失敗，不佔用限流額度
+            breaker.before_request()
+        await _acquire(model, tokens, priority)
         try:
-            response = await client.post(url, json=json, headers=headers)
+            response = await _post_hedged(client, url, content, headers, breaker, model, tokens, priority)
+            metrics.inc("http_responses", status=response.status_code)
+            throttle = _report_status(model, response.status_code, response.headers, response.content)
             if response.status_code in TRANSIENT_STATUS_CODES and attempt < max_retries:
-                delay = backoff_base * (2 ** attempt) + random.uniform(0, 0.2)
+                metrics.inc("http_retries", reason=response.status_code)
+                # 429 的等待由限流器統一排程，其餘錯誤照舊指數退避
+                delay = throttle if throttle is not None else backoff_base * (2 ** attempt) + random.uniform(0, 0.2)
                 logger.info(
                     "Transient response %s, retrying in %.2fs (attempt %s/%s)",
                     response.status_code,
@@ -35,13 +196,16 @@ async def post_json_with_retries(
                     attempt + 1,
                     max_retries,
                 )
-                await asyncio.sleep(delay)
+                if throttle is None:
+                    await _sleep_before_retry(delay)
                 attempt += 1
                 continue
             return response
         except (httpx.TimeoutException, httpx.TransportError, httpx.RequestError) as exc:
+            metrics.inc("http_errors", error=type(exc).__name__)
             if attempt >= max_retries:
                 raise
+            metrics.inc("http_retries", reason=type(exc).__name__)
             delay = backoff_base * (2 ** attempt) + random.uniform(0, 0.2)
             logger.info(
                 "HTTP error %s, retrying in %.2fs (attempt %s/%s)",
@@ -50,8 +214,113 @@ async def post_json_with_retries(
                 attempt + 1,
                 max_retries,
             )
-            await asyncio.sleep(delay)
+            await _sleep_before_retry(delay)
             attempt += 1
 
 
+async def stream_sse_json(
+    client: Optional[httpx.AsyncClient],
+    url: str,
+    json: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None,
+    max_retries: int = 2,
+    backoff_base: float = 0.8,
+    model: Optional[str] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    content: Optional[bytes] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """POST 並逐一產出 SSE `data:` 事件解析後的 JSON。
+
+    只有在尚未收到任何事件前才會重試，避免重複輸出已送出的片段。
+    """
+    attempt = 0
+    headers = headers or {"content-type": "application/json"}
+    if client is None:
+        client = await http_client_manager.get_client()
+
+    if content is None:
+        with metrics.stage("serialize"):
+            content = jsonlib.dumps(json, ensure_ascii=False).encode("utf-8")
+    tokens = _estimate_request_tokens(content)
+    breaker = circuit_breakers.get(model) if model else None
 
+    while True:
+        yielded = False
+        if breaker is not None and not breaker.available:
+            breaker.before_request()
+        await _acquire(model, tokens, priority)
+        timeout = bounded_timeout(get_timeout_seconds())
+        if breaker is not None:
+            breaker.before_request()
+        started = time.perf_counter()
+        settled = False
+        try:
+            async with client.stream("POST", url, content=content, headers=headers, timeout=timeout, extensions={"trace": HttpTrace()}) as response:
+                metrics.inc("http_responses", status=response.status_code)
+                if response.status_code != 200:
+                    raw = await response.aread()
+                    _record(breaker, response.status_code, time.perf_counter() - started)
+                    settled = True
+                    throttle = _report_status(model, response.status_code, response.headers, raw)
+                    body = raw.decode("utf-8", errors="replace")
+                    if response.status_code in TRANSIENT_STATUS_CODES and attempt < max_retries:
+                        metrics.inc("http_retries", reason=response.status_code)
+                        delay = throttle if throttle is not None else backoff_base * (2 ** attempt) + random.uniform(0, 0.2)
+                        logger.info(
+                            "Transient stream response %s, retrying in %.2fs (attempt %s/%s)",
+                            response.status_code,
+                            delay,
+                            attempt + 1,
+                            max_retries,
+                        )
+                        if throttle is None:
+                            await _sleep_before_retry(delay)
+                        attempt += 1
+                        continue
+                    logger.warning("stream non-200 status=%s body=%s", response.status_code, body)
+                    if model and (response.status_code == 429 or response.status_code >= 500):
+                        raise ModelUnavailableError(model, response.status_code, body)
+                    raise Exception(body)
+                _report_status(model, response.status_code, response.headers, b"")
+
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if not payload or payload == "[DONE]":
+                        continue
+                    try:
+                        data = jsonlib.loads(payload)
+                    except ValueError:
+                        logger.warning("Skipping malformed SSE payload: %s", payload[:200])
+                        continue
+                    if not yielded:
+                        metrics.observe("stage_seconds", time.perf_counter() - started, stage="stream_first_event")
+                    yielded = True
+                    yield data
+                metrics.observe("stage_seconds", time.perf_counter() - started, stage="http_total")
+                _record(breaker, response.status_code, time.perf_counter() - started)
+                settled = True
+                return
+        except (httpx.TimeoutException, httpx.TransportError, httpx.RequestError) as exc:
+            if breaker is not None and not settled:
+                breaker.record(False)
+                settled = True
+            metrics.inc("http_errors", error=type(exc).__name__)
+            if yielded or attempt >= max_retries:
+                raise
+            metrics.inc("http_retries", reason=type(exc).__name__)
+            delay = backoff_base * (2 ** attempt) + random.uniform(0, 0.2)
+            logger.info(
+                "Stream HTTP error %s, retrying in %.2fs (attempt %s/%s)",
+                type(exc).__name__,
+                delay,
+                attempt + 1,
+                max_retries,
+            )
+            await _sleep_before_retry(delay)
+            attempt += 1
+        finally:
+            if breaker is not None and not settled:
+                # 呼叫端提前關閉串流或被取消
+                breaker.release_probe()
@@ -0,0 +1,46 @@
+"""串流中的 ☆FUNC:{args}☆ 指令偵測：跨段切開、相連與不完整的標記"""
+from game.game_core import CommandScanner, GameCore
+
+
+def _scanner() -> CommandScanner:
+    return CommandScanner(GameCore.COMMAND_PATTERN, GameCore.COMMAND_PREFIX_PATTERN)
+
+
+def _feed(chunks):
+    scanner = _scanner()
+    commands = []
+    for chunk in chunks:
+        commands.extend(scanner.feed(chunk))
+    return scanner, commands
+
+
+def test_marker_split_across_chunks():
+    text = "你揮劍☆DICE:{1d20+5}☆，結果是"
+    for cut in range(1, len(text)):
+        scanner, commands = _feed([text[:cut], text[cut:]])
+        assert commands == [{"func": "DICE", "args": "1d20+5"}], cut
+        assert scanner.visible_text() == "你揮劍，結果是"
+
+
+def test_partial_marker_is_hidden_until_closed():
+    scanner = _scanner()
+    assert scanner.feed("攻擊☆DICE:{1d") == []
+    assert scanner.visible_text() == "攻擊"
+    assert scanner.feed("6}☆") == [{"func": "DICE", "args": "1d6"}]
+    assert scanner.visible_text() == "攻擊"
+
+
+def test_adjacent_and_overlapping_markers():
+    _, commands = _feed(["☆DICE:{1d6}☆☆", "DICE:{2d8}☆"])
+    assert commands == [{"func": "DICE", "args": "1d6"}, {"func": "DICE", "args": "2d8"}]
+
+    # 多出來的 ☆ 不可能成為指令，照原文顯示
+    scanner, commands = _feed(["☆", "☆DICE:{1d4}☆"])
+    assert commands == [{"func": "DICE", "args": "1d4"}]
+    assert scanner.visible_text() == "☆"
+
+
+def test_stray_star_is_visible():
+    scanner, commands = _feed(["評價：☆☆", "☆ 三顆星"])
+    assert commands == []
+    assert scanner.visible_text() == "評價：☆☆☆ 三顆星"
@@ -0,0 +1,82 @@
+"""context cache 對本機 Gemini stub 的建立、重用、續期與過期"""
+import asyncio
+import time
+
+from bench.stub_server import GeminiStubServer
+from request.body_builder import PreparedBody
+from request.context_cache import ContextCacheManager
+from request.http_client import http_client_manager
+
+MODEL = "gemini-stub"
+API_KEY = "test-key"
+
+
+def _body(system_prompt: str) -> PreparedBody:
+    return PreparedBody(contents=[], generation_config={}, safety_settings=None, system_prompt=system_prompt)
+
+
+def _run(monkeypatch, scenario):
+    monkeypatch.setenv("CONTEXT_CACHE_ENABLED", "1")
+    monkeypatch.setenv("CONTEXT_CACHE_TTL_SECONDS", "3600")
+    monkeypatch.setenv("CONTEXT_CACHE_REFRESH_MARGIN_SECONDS", "300")
+
+    async def main():
+        async with GeminiStubServer() as stub:
+            monkeypatch.setenv("GEMINI_BASE_URL", stub.base_url)
+            try:
+                await scenario(stub, ContextCacheManager())
+            finally:
+                await http_client_manager.close()
+
+    asyncio.run(main())
+
+
+def test_create_and_reuse(monkeypatch):
+    async def scenario(stub, manager):
+        first = _body("你是主持人")
+        key = await manager.apply(first, MODEL, API_KEY)
+        assert key is not None
+        assert first.cached_content == "cachedContents/stub-1"
+
+        second = _body("你是主持人")
+        assert await manager.apply(second, MODEL, API_KEY) == key
+        assert second.cached_content == first.cached_content
+        assert stub.stats.requests["cachedContents.create"] == 1
+
+    _run(monkeypatch, scenario)
+
+
+def test_refresh_before_expiry(monkeypatch):
+    async def scenario(stub, manager):
+        key = await manager.apply(_body("你是主持人"), MODEL, API_KEY)
+        # 進入續期範圍但還沒過期：延長 TTL，不重新建立
+        manager._entries[key].expires_at = time.monotonic() + 10
+        body = _body("你是主持人")
+        await manager.apply(body, MODEL, API_KEY)
+        assert body.cached_content == "cachedContents/stub-1"
+        assert stub.stats.requests["cachedContents.patch"] == 1
+        assert stub.stats.requests["cachedContents.create"] == 1
+
+    _run(monkeypatch, scenario)
+
+
+def test_expired_entry_is_recreated_and_lock_pruned(monkeypatch):
+    async def scenario(stub, manager):
+        key = await manager.apply(_body("你是主持人"), MODEL, API_KEY)
+        other = await manager.apply(_body("另一個戰役"), MODEL, API_KEY)
+        assert set(manager._locks) == {key, other}
+
+        manager._entries[key].expires_at = time.monotonic() - 1
+        manager._entries[other].expires_at = time.monotonic() - 1
+        body = _body("你是主持人")
+        await manager.apply(body, MODEL, API_KEY)
+        assert body.cached_content == "cachedContents/stub-3"
+        assert stub.stats.requests["cachedContents.create"] == 3
+        # 過期的另一組 key 連同鎖一起淘汰
+        assert other not in manager._entries
+        assert other not in manager._locks
+
+        manager.invalidate(key)
+        assert not manager._locks
+
+    _run(monkeypatch, scenario)
@@ -0,0 +1,63 @@
+"""ConversationStore 的歷史窗口：token 預算與 function_call / 結果不被切開"""
+from request.memory import ConversationStore
+from request.turns import ROLE_MODEL, ROLE_TOOL, ROLE_USER
+
+SESSION = "test-window"
+
+
+def _store() -> ConversationStore:
+    store = ConversationStore(max_history_per_session=40)
+    store.add_turn(SESSION, "user", "我要攻擊哥布林")
+    store.add_func_calls(SESSION, [{"name": "roll_dice", "args": {"notation": "1d20"}}])
+    store.add_tool_responses(SESSION, [{"name": "roll_dice", "response": {"total": 17}}])
+    store.add_turn(SESSION, "model", "你命中了哥布林。")
+    return store
+
+
+def _roles(turns):
+    return [turn.role for turn in turns]
+
+
+def test_turn_limit_does_not_start_at_tool_response():
+    store = _store()
+    # 最近兩個回合會從工具結果開始，往後略過
+    assert _roles(store.get_recent(SESSION, 2)) == [ROLE_MODEL]
+    assert _roles(store.get_recent(SESSION, 3)) == [ROLE_MODEL, ROLE_TOOL, ROLE_MODEL]
+
+
+def test_tool_response_tail_keeps_its_call():
+    store = _store()
+    store.add_func_calls(SESSION, [{"name": "roll_dice", "args": {"notation": "2d6"}}])
+    store.add_tool_responses(SESSION, [{"name": "roll_dice", "response": {"total": 9}}])
+    # 窗口只剩工具結果時往前帶上對應的呼叫
+    window = store.get_recent(SESSION, 1)
+    assert _roles(window) == [ROLE_MODEL, ROLE_TOOL]
+    assert window[0].function_calls[0]["args"] == {"notation": "2d6"}
+
+
+def test_budget_smaller_than_one_turn_keeps_last_turn():
+    store = _store()
+    window = store.get_recent(SESSION, 40, max_tokens=1)
+    assert _roles(window) == [ROLE_MODEL]
+    assert window[0].text == "你命中了哥布林。"
+
+
+def test_budget_cut_inside_pair_moves_past_response():
+    store = _store()
+    turns = store.get_recent(SESSION, 40)
+    # 預算剛好容納最後兩個回合 (工具結果 + 敘述)，切點不能留下沒有呼叫的結果
+    budget = turns[-1].tokens + turns[-2].tokens
+    assert _roles(store.get_recent(SESSION, 40, max_tokens=budget)) == [ROLE_MODEL]
+    budget += turns[-3].tokens
+    assert _roles(store.get_recent(SESSION, 40, max_tokens=budget)) == [ROLE_MODEL, ROLE_TOOL, ROLE_MODEL]
+
+
+def test_window_folds_cut_turns_once():
+    store = _store()
+    folded = []
+    store.set_eviction_handler(lambda session_id, turns: folded.append(_roles(turns)))
+    store.get_window(SESSION, 40)
+    store.add_turn(SESSION, "user", "再攻擊一次")
+    store.get_window(SESSION, 2)
+    store.get_window(SESSION, 2)
+    assert folded == [[ROLE_USER, ROLE_MODEL, ROLE_TOOL]]
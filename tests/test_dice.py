@@ -0,0 +1,45 @@
+"""骰子表示法的解析與邊界情況"""
+import pytest
+
+from game.dice import MAX_DICE, DiceEngine, DiceError, parse
+
+
+def test_percentile_dice():
+    expression = parse("d%")
+    assert (expression.count, expression.sides) == (1, 100)
+    assert parse("2d%").count == 2
+
+
+def test_advantage_and_disadvantage():
+    adv = parse("adv")
+    assert (adv.count, adv.sides, adv.keep, adv.keep_n) == (2, 20, "h", 1)
+    assert adv.evaluate([3, 17]).total == 17
+    dis = parse(" DIS ")
+    assert dis.keep == "l"
+    assert dis.evaluate([3, 17]).total == 3
+
+
+def test_keep_modifier_and_pool():
+    expression = parse("4d6kh3+2-1")
+    assert expression.keep_n == 3 and expression.modifier == 1
+    assert expression.evaluate([1, 6, 4, 5]).total == 16
+    pool = parse("5d10>=7")
+    assert pool.evaluate([7, 10, 3, 6, 8]).total == 3
+    # 保留數量不超過骰子數
+    assert parse("2d6kh5").keep_n == 2
+
+
+@pytest.mark.parametrize("notation", ["", "d", "1d", "abc", "1d20+", "1d0", "0d6", f"{MAX_DICE + 1}d6", "1d6;rm -rf"])
+def test_bad_notation(notation):
+    with pytest.raises(DiceError):
+        parse(notation)
+
+
+def test_seeded_rolls_repeat_and_stay_in_range():
+    first = DiceEngine()
+    second = DiceEngine()
+    first.seed("s", 42)
+    second.seed("s", 42)
+    rolls = [first.roll("d%", "s").total for _ in range(50)]
+    assert rolls == [second.roll("d%", "s").total for _ in range(50)]
+    assert all(1 <= total <= 100 for total in rolls)
@@ -0,0 +1,16 @@
+"""Prometheus 輸出不帶 session label，各 session 的累計另外保留且有上限"""
+from request.metrics import MetricsRegistry
+
+
+def test_session_totals_are_capped_and_not_exported():
+    registry = MetricsRegistry(max_sessions=2)
+    for session_id in ("a", "b", "c"):
+        registry.inc("turns")
+        registry.inc_session(session_id, "turns")
+    registry.inc_session("b", "total_tokens", 30)
+
+    assert registry.session_totals("a") == {}
+    assert registry.session_totals("b") == {"turns": 1, "total_tokens": 30}
+    text = registry.render_prometheus()
+    assert "aichat_turns_total 3" in text
+    assert "session" not in text